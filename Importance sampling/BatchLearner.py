@@ -4,7 +4,8 @@ import time
 
 
 class BatchLearner:
-    def __init__(self, gamma, policy_factory, q_estimator, v_estimator, gradient_estimator, seed, init_source, init_target):
+    def __init__(self, gamma, policy_factory, q_estimator, v_estimator, gradient_estimator, seed, init_source, init_target,
+                 warm_start=False):
         self.gamma = gamma
         self.policy_factory = policy_factory
         self.q_estimator = q_estimator
@@ -14,6 +15,8 @@ class BatchLearner:
         self.seed = seed
         self.init_source = init_source
         self.init_target = init_target
+        # Policy evaluation restarts from the previous solution, consecutive policies being close to each other
+        self.warm_start = warm_start
 
 
 
@@ -23,6 +26,11 @@ class BatchLearner:
         self.out_stream = out_stream
 
         results = np.zeros((n_runs, len(n_target_samples), 2), dtype=np.float64)
+        if target_task.env.discrete:
+            # The critics gather the features of the samples from the tables of the grid
+            self.q_estimator.set_grid(target_task.env.state_reps, target_task.env.action_reps)
+            self.v_estimator.set_grid(target_task.env.state_reps)
+
         for run_idx in range(n_runs):
             print("Run:", run_idx + 1, file=self.out_stream)
             np.random.seed(self.seed)
@@ -43,10 +51,12 @@ class BatchLearner:
                 for i in range(len(source_tasks)):
                     samples = self.collect_samples(source_tasks[i], n_samples, source_policies[i])
                     source_samples.append(samples)
-                    phi_source_q.append(self.q_estimator.map_to_feature_space(samples['fs'], samples['a']))
-                    phi_ns_source_q.append(self.q_estimator.map_to_feature_space(samples['ns'], samples['na']))
-                    phi_source_v.append(self.v_estimator.map_to_feature_space(samples['fs']))
-                    phi_ns_source_v.append(self.v_estimator.map_to_feature_space(samples['ns']))
+                    phi_sa, phi_nsa = self.q_estimator.sample_features(samples)
+                    phi_source_q.append(phi_sa)
+                    phi_ns_source_q.append(phi_nsa)
+                    phi_s, phi_ns = self.v_estimator.sample_features(samples)
+                    phi_source_v.append(phi_s)
+                    phi_ns_source_v.append(phi_ns)
 
             for size_idx, target_size in enumerate(n_target_samples):
                 print("No. samples:", target_size, file=self.out_stream)
@@ -134,9 +144,12 @@ class BatchLearner:
                         self.q_estimator.source_phi_sa = np.vstack(phi_source_q_sel)
                         self.q_estimator.source_phi_nsa = np.vstack(phi_ns_source_q_sel)
                         self.q_estimator.source_rewards = np.hstack(selected_samples['r'])
+                        # The selected features are per sample, not per distinct transition
+                        self.q_estimator.source_inverse = None
                         self.v_estimator.source_phi_s = np.vstack(phi_source_v_sel)
                         self.v_estimator.source_phi_ns = np.vstack(phi_ns_source_v_sel)
                         self.v_estimator.source_rewards = np.hstack(selected_samples['r'])
+                        self.v_estimator.source_inverse = None
 
                     transfer_samples = {'fs': np.vstack([target_samples['fs']] + selected_samples['fs']),
                                         'a': np.vstack([target_samples['a']] + selected_samples['a']),
@@ -201,7 +214,7 @@ class BatchLearner:
     def collect_samples(self, task, n_samples, policy):
         np.random.seed(self.seed)
         task.env._seed(self.seed)
-        task.env.set_policy(policy, self.gamma)
+        task.env.set_policy(policy, self.gamma, warm_start=self.warm_start)
         return task.env.sample_step(n_samples)
 
 
@@ -211,7 +224,7 @@ class BatchLearner:
         action_idx = dataset['ai']
         next_state_idx = dataset['nsi']
         source_task.env.set_policy(source_policy, self.gamma)
-        probs = source_task.env.transition_matrix[state_idx, action_idx, next_state_idx]
+        probs = source_task.env.transition_probs(state_idx, action_idx, next_state_idx)
         sorted_idx = np.lexsort((action_idx, state_idx))
         probs = probs[sorted_idx]
         state_sorted = state_idx[sorted_idx]
@@ -232,5 +245,5 @@ class BatchLearner:
         action_idx = dataset['ai']
         next_state_idx = dataset['nsi']
         target_task.env.set_policy(target_policy, self.gamma)
-        probs = target_task.env.transition_matrix[state_idx, action_idx, next_state_idx]
+        probs = target_task.env.transition_probs(state_idx, action_idx, next_state_idx)
         return probs
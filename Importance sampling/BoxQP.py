@@ -0,0 +1,222 @@
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+
+# Box-constrained minimization of the squared bias plus variance of the weighted source estimates of the weights
+# estimators, which is a quadratic in the weights w of the groups of identical source samples:
+#   f(w) = ||c - Z^T w / n||^2 + (sum_k d_k w_k^2 - sum_j ||Z_j^T w_j||^2 / N_j) / n^2
+# with a row z_k of Z per group, d_k = ||z_k||^2 / (size of group k), and Z_j, w_j, N_j the groups, weights and number
+# of samples of source j. The Hessian is a diagonal plus m + 1 terms of rank at most Z.shape[1], so it is only used
+# through products, each costing O(groups * Z.shape[1])
+
+
+
+class GroupedQuadratic:
+    def __init__(self, Z, group_sizes, reduced_source_sizes, source_sizes):
+        self.Z = Z
+        self.source_sizes = np.asarray(source_sizes, dtype=np.float64)
+        self.offsets = np.hstack((0, np.cumsum(reduced_source_sizes))).astype(np.int64)
+        self.group_norms = (Z ** 2).sum(axis=1)
+        self.d = self.group_norms / group_sizes
+        self.group_source_sizes = np.repeat(self.source_sizes, reduced_source_sizes)
+        self.c = None
+        self.n = None
+        # Workspaces of the products, so that evaluating the objective does not allocate
+        self.Zw = np.empty(Z.shape[1], dtype=np.float64)
+        self.source_Zw = np.empty((self.source_sizes.shape[0], Z.shape[1]), dtype=np.float64)
+        self.group_buffer = np.empty(Z.shape[0], dtype=np.float64)
+
+
+
+    def set_target(self, target, n):
+        # target is the estimate computed on the target samples alone, n the number of target and source samples
+        self.c = target * (self.source_sizes.sum() / n)
+        self.n = n
+
+
+
+    def source_products(self, w, out=None):
+        # Z_j^T w_j for every source j
+        if out is None:
+            out = np.empty((self.source_sizes.shape[0], self.Z.shape[1]), dtype=np.float64)
+        for j in range(self.source_sizes.shape[0]):
+            np.dot(self.Z[self.offsets[j]:self.offsets[j + 1]].T, w[self.offsets[j]:self.offsets[j + 1]], out=out[j])
+        return out
+
+
+
+    def grouped_products(self, V, out=None):
+        # Z_j v_j for every source j, stacked as w is
+        if out is None:
+            out = np.empty(self.Z.shape[0], dtype=np.float64)
+        for j in range(self.source_sizes.shape[0]):
+            np.dot(self.Z[self.offsets[j]:self.offsets[j + 1]], V[j], out=out[self.offsets[j]:self.offsets[j + 1]])
+        return out
+
+
+
+    def variance(self, w):
+        # Variance term of f, leaving Z_j^T w_j / N_j in source_Zw for the gradient
+        self.source_products(w, out=self.source_Zw)
+        np.multiply(w, w, out=self.group_buffer)
+        value = self.d.dot(self.group_buffer)
+        self.source_Zw /= self.source_sizes[:, None]
+        return (value - np.einsum('jf,jf,j->', self.source_Zw, self.source_Zw, self.source_sizes)) / self.n ** 2
+
+
+
+    def bias(self, w):
+        # c - Z^T w / n in Zw, returning its squared norm and leaving in Zw the vector the gradient multiplies by -2 Z / n
+        np.dot(self.Z.T, w, out=self.Zw)
+        self.Zw /= -self.n
+        self.Zw += self.c
+        return self.Zw.dot(self.Zw)
+
+
+
+    def value_and_gradient(self, w, out=None):
+        # f and its gradient in one pass, which is what both the solvers of the estimators call
+        if out is None:
+            out = np.empty(self.Z.shape[0], dtype=np.float64)
+        value = self.bias(w) + self.variance(w)
+        self.grouped_products(self.source_Zw, out=out)
+        np.dot(self.Z, self.Zw, out=self.group_buffer)
+        self.group_buffer *= self.n
+        out += self.group_buffer
+        np.multiply(self.d, w, out=self.group_buffer)
+        np.subtract(self.group_buffer, out, out=out)
+        out *= 2. / self.n ** 2
+        return value, out
+
+
+
+    def hessian_dot(self, v, out=None):
+        if out is None:
+            out = np.empty(self.Z.shape[0], dtype=np.float64)
+        np.dot(self.Z.T, v, out=self.Zw)
+        np.dot(self.Z, self.Zw, out=out)
+        np.multiply(self.d, v, out=self.group_buffer)
+        out += self.group_buffer
+        self.source_products(v, out=self.source_Zw)
+        self.source_Zw /= self.source_sizes[:, None]
+        out -= self.grouped_products(self.source_Zw, out=self.group_buffer)
+        out *= 2. / self.n ** 2
+        return out
+
+
+
+    def hessian_diagonal(self):
+        return 2. * (self.group_norms * (1. - 1. / self.group_source_sizes) + self.d) / self.n ** 2
+
+
+
+    def gradient_scale(self):
+        # Largest gradient entry at w = 0, the reference of the stopping tolerance
+        return 2. * np.abs(self.Z.dot(self.c)).max() / self.n
+
+
+
+class GroupedMinMaxObjective(GroupedQuadratic):
+    # Objective of MinMaxWeightsEstimator, where the bias is bounded by |c - Z^T w / n| + delta, delta being the worst
+    # case bias of the sources due to the model and policy mismatch:
+    #   f(w) = || |c - Z^T w / n| + delta ||^2 + (same variance as GroupedQuadratic)
+    # It is not a quadratic, so it is only evaluated through value_and_gradient
+    def __init__(self, Z, group_sizes, reduced_source_sizes, source_sizes):
+        GroupedQuadratic.__init__(self, Z, group_sizes, reduced_source_sizes, source_sizes)
+        self.delta = None
+        self.non_positive = np.empty(Z.shape[1], dtype=bool)
+
+
+
+    def set_target(self, c, delta, n):
+        self.c = c
+        self.delta = delta
+        self.n = n
+
+
+
+    def bias(self, w):
+        # The derivative of |x| is taken as -1 at x = 0, as where all the weights are one
+        np.dot(self.Z.T, w, out=self.Zw)
+        self.Zw /= -self.n
+        self.Zw += self.c
+        np.less_equal(self.Zw, 0., out=self.non_positive)
+        np.abs(self.Zw, out=self.Zw)
+        self.Zw += self.delta
+        value = self.Zw.dot(self.Zw)
+        np.negative(self.Zw, out=self.Zw, where=self.non_positive)
+        return value
+
+
+
+def solve_box_qp(quadratic, lower, upper, w0, active0=None, tol=1e-8, max_iter=200, max_cg_iter=100):
+    # Projected Newton. The weights within eps of a bound that the gradient pushes against are moved onto it by a scaled
+    # gradient step, the Newton step on the others is found by preconditioned conjugate gradient, and the whole step is
+    # projected back in the box with a backtracking line search. active0, the active set of a previous solution w0 was
+    # taken from, keeps its weights that are still on a bound fixed in the first Newton step
+    w = np.clip(w0, lower, upper)
+    # Two gradient buffers, swapped when a step is accepted, and the workspaces of the conjugate gradient
+    g, g_new = np.empty_like(w), np.empty_like(w)
+    f, g = quadratic.value_and_gradient(w, out=g)
+    h_diag = np.maximum(quadratic.hessian_diagonal(), np.finfo(np.float64).tiny)
+    g_tol = tol * max(quadratic.gradient_scale(), np.finfo(np.float64).tiny)
+    step, r, z, p, Hp, w_new = (np.empty_like(w) for _ in range(6))
+    n_cg = 0
+    converged = False
+    for it in range(max_iter):
+        projected_g = np.where(np.logical_or(np.logical_and(w <= lower, g > 0.), np.logical_and(w >= upper, g < 0.)), 0., g)
+        if np.abs(projected_g).max(initial=0.) <= g_tol:
+            converged = True
+            break
+        scaled_g = g / h_diag
+        eps = min(1e-3, np.abs(w - np.clip(w - scaled_g, lower, upper)).max())
+        active = np.logical_or(np.logical_and(w <= lower + eps, g > 0.), np.logical_and(w >= upper - eps, g < 0.))
+        if it == 0 and active0 is not None:
+            active = np.logical_or(active, np.logical_and(active0, np.logical_or(w <= lower, w >= upper)))
+
+        step.fill(0.)
+        np.negative(g, out=r)
+        r[active] = 0.
+        np.divide(r, h_diag, out=z)
+        p[:] = z
+        rz = r.dot(z)
+        r_norm = np.linalg.norm(r)
+        r_tol = min(0.5, np.sqrt(r_norm / g_tol)) * r_norm if r_norm > 0. else 0.
+        for k in range(max_cg_iter):
+            quadratic.hessian_dot(p, out=Hp)
+            Hp[active] = 0.
+            pHp = p.dot(Hp)
+            n_cg += 1
+            if pHp <= 0.:
+                break
+            alpha = rz / pHp
+            step += alpha * p
+            r -= alpha * Hp
+            if np.linalg.norm(r) <= r_tol:
+                break
+            np.divide(r, h_diag, out=z)
+            rz_new = r.dot(z)
+            p *= rz_new / rz
+            p += z
+            rz = rz_new
+        if not step.any():
+            np.negative(scaled_g, out=step)
+        step[active] = -scaled_g[active]
+
+        alpha = 1.
+        while True:
+            np.multiply(step, alpha, out=w_new)
+            w_new += w
+            np.clip(w_new, lower, upper, out=w_new)
+            f_new, g_new = quadratic.value_and_gradient(w_new, out=g_new)
+            if f_new <= f + 1e-4 * g.dot(w_new - w) or alpha < 1e-10:
+                break
+            alpha *= 0.5
+        if f_new > f:
+            break
+        w, w_new = w_new, w
+        f = f_new
+        g, g_new = g_new, g
+
+    active = np.logical_or(np.logical_and(w <= lower, g > 0.), np.logical_and(w >= upper, g < 0.))
+    return OptimizeResult(x=w, fun=f, jac=g, active=active, nit=it, ncg=n_cg, success=converged)
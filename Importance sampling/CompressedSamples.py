@@ -0,0 +1,56 @@
+import numpy as np
+
+
+# Samples of the discrete tasks grouped by their (fsi, ai, nsi, nai) tuple, which fixes every other field of a sample,
+# so that the LSTD estimators and the gradient estimator work once per distinct transition. A compressed dataset has
+# the fields of the samples for one sample of each group, with 'r' replaced by the sum of the weighted rewards of the
+# group, plus 'count', the number of samples of the group, 'w', the sum of their weights, 'inverse', the group of every
+# sample, and 'n', the number of samples
+
+index_fields = ['fsi', 'ai', 'nsi', 'nai']
+
+
+
+def is_compressed(dataset):
+    return isinstance(dataset, dict) and 'inverse' in dataset
+
+
+
+def compress_samples(dataset, weights=None):
+    # weights, one per sample, default to ones. Samples without indices, as those of the continuous tasks, are each a
+    # group of their own
+    if is_compressed(dataset):
+        assert weights is None
+        return dataset
+    n = dataset['r'].shape[0]
+    if all(k in dataset for k in index_fields) and n > 0:
+        idx = [dataset[k] for k in index_fields]
+        keys = np.ravel_multi_index(idx, tuple(int(i.max()) + 1 for i in idx))
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    else:
+        first = inverse = np.arange(n)
+    compressed = {k: v[first] for k, v in dataset.items()}
+    compressed['count'] = np.bincount(inverse, minlength=first.shape[0]).astype(np.float64)
+    if weights is None:
+        compressed['w'] = compressed['count']
+        compressed['r'] = np.bincount(inverse, dataset['r'], minlength=first.shape[0])
+    else:
+        compressed['w'] = np.bincount(inverse, weights, minlength=first.shape[0])
+        compressed['r'] = np.bincount(inverse, weights * dataset['r'], minlength=first.shape[0])
+    compressed['inverse'] = inverse
+    compressed['n'] = n
+    return compressed
+
+
+
+def concatenate_samples(datasets):
+    # Joins sample dicts, e.g. those of several sources, field by field
+    return {k: np.concatenate([d[k] for d in datasets]) for k in datasets[0]}
+
+
+
+def group_sums(inverse, values, n_groups):
+    # Sums of values, one per sample, over the groups given by inverse, None meaning that every sample is a group
+    if inverse is None:
+        return values
+    return np.bincount(inverse, values, minlength=n_groups)
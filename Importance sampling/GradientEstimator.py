@@ -1,4 +1,5 @@
 import numpy as np
+from CompressedSamples import is_compressed
 
 class GradientEstimator:
     def __init__(self, gamma, baseline_type):
@@ -18,8 +19,14 @@ class GradientEstimator:
 
 
 
-    # Weights are for the sources; log_gradient, Q and V are for [target, source]
+    # Weights are for the sources; log_gradient, Q and V are for [target, source], or for the groups of dataset when it
+    # is compressed, each group then counting with the sum of the weights of its samples
     def estimate_gradient(self, dataset, log_gradient, Q, V=None, source_weights=None):
+        if is_compressed(dataset):
+            assert source_weights is None
+            advantage = Q if self.baseline_type == 0 else Q - V
+            return log_gradient.T.dot(advantage * dataset['w']) / (dataset['n'] * (1. - self.gamma))
+
         if source_weights is not None:
             target_size = dataset['fsi'].shape[0]
             weights = np.hstack((np.ones(target_size, dtype=np.float64), source_weights))
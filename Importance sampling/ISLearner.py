@@ -7,7 +7,7 @@ import time
 
 class ISLearner:
     def __init__(self, gamma, policy_factory, q_estimator, v_estimator, gradient_estimator, weights_estimator,
-                 app_w_critic_Q, app_w_critic_V, app_w_actor, seed, init_source, init_target):
+                 app_w_critic_Q, app_w_critic_V, app_w_actor, seed, init_source, init_target, warm_start=False):
         self.gamma = gamma
         self.policy_factory = policy_factory
         self.q_estimator = q_estimator
@@ -23,6 +23,8 @@ class ISLearner:
         self.seed = seed
         self.init_source = init_source
         self.init_target = init_target
+        # Policy evaluation restarts from the previous solution, consecutive policies being close to each other
+        self.warm_start = warm_start
 
 
 
@@ -35,16 +37,16 @@ class ISLearner:
         all_phi_Q = None
         all_phi_V = None
 
+        if target_task.env.discrete and self.q_estimator is not None and self.v_estimator is not None:
+            # The critics gather the features of the samples from the tables of the grid
+            self.q_estimator.set_grid(target_task.env.state_reps, target_task.env.action_reps)
+            self.v_estimator.set_grid(target_task.env.state_reps)
+
         if source_tasks is not None:
             if self.app_w_critic_Q or self.app_w_actor:
-                idx_grid = np.dstack(np.meshgrid(np.arange(source_tasks[0].env.state_reps.shape[0]),
-                                                 np.arange(source_tasks[0].env.action_reps.shape[0]),
-                                                 indexing='ij')).reshape(-1, 2)
-                all_phi_Q = self.q_estimator.map_to_feature_space(source_tasks[0].env.state_reps[idx_grid[:, 0]],
-                                                                  source_tasks[0].env.action_reps[idx_grid[:, 1]])
-                del idx_grid
+                all_phi_Q = self.q_estimator.set_grid(source_tasks[0].env.state_reps, source_tasks[0].env.action_reps)
             if self.app_w_critic_V:
-                all_phi_V = self.v_estimator.map_to_feature_space(source_tasks[0].env.state_reps)
+                all_phi_V = self.v_estimator.set_grid(source_tasks[0].env.state_reps)
 
         for run_idx in range(n_runs):
             print("Run:", run_idx+1, file=self.out_stream)
@@ -67,7 +69,7 @@ class ISLearner:
                     source_samples.append(samples)
                     source_samples_probs_zeta.append(source_tasks[i].env.zeta_distr[samples['fsi'], samples['ai']])
                     if self.v_estimator is not None and self.q_estimator is not None:
-                        source_samples_probs_p.append(source_tasks[i].env.transition_matrix[samples['fsi'], samples['ai'], samples['nsi']])
+                        source_samples_probs_p.append(source_tasks[i].env.transition_probs(samples['fsi'], samples['ai'], samples['nsi']))
                         source_samples_probs_pi.append(source_policies[i].choice_matrix[samples['nsi'], samples['nai']])
                 self.gradient_estimator.add_sources()
                 if self.v_estimator is not None and self.q_estimator is not None:
@@ -266,7 +268,7 @@ class ISLearner:
     def collect_samples(self, task, n_samples, policy):
         np.random.seed(self.seed)
         task.env._seed(self.seed)
-        task.env.set_policy(policy, self.gamma)
+        task.env.set_policy(policy, self.gamma, warm_start=self.warm_start)
         return task.env.sample_step(n_samples)
 
 
@@ -292,8 +294,8 @@ class ISLearner:
         next_state_idx = dataset['nsi']
         if source_sample_probs is None:
             source_task.env.set_policy(source_policy, self.gamma)
-            source_sample_probs = source_task.env.transition_matrix[state_idx, action_idx, next_state_idx]
-        target_sample_probs = target_task.env.transition_matrix[state_idx, action_idx, next_state_idx]
+            source_sample_probs = source_task.env.transition_probs(state_idx, action_idx, next_state_idx)
+        target_sample_probs = target_task.env.transition_probs(state_idx, action_idx, next_state_idx)
         return target_sample_probs / source_sample_probs
 
 
@@ -320,10 +322,10 @@ class ISLearner:
         if source_sample_probs is None:
             source_task.env.set_policy(source_policy, self.gamma)
             source_sample_probs = \
-                source_task.env.transition_matrix[state_idx, action_idx, next_state_idx] * source_policy.choice_matrix[
+                source_task.env.transition_probs(state_idx, action_idx, next_state_idx) * source_policy.choice_matrix[
                     next_state_idx, next_action_idx]
         target_sample_probs = \
-            target_task.env.transition_matrix[state_idx, action_idx, next_state_idx] * target_policy.choice_matrix[
+            target_task.env.transition_probs(state_idx, action_idx, next_state_idx) * target_policy.choice_matrix[
                 next_state_idx, next_action_idx]
         return target_sample_probs / source_sample_probs
 
@@ -336,8 +338,8 @@ class ISLearner:
         next_state_idx = dataset['nsi']
         if source_sample_probs is None:
             source_task.env.set_policy(source_policy, self.gamma)
-            source_sample_probs = source_task.env.transition_matrix[state_idx, action_idx, next_state_idx]
-        target_sample_probs = target_task.env.transition_matrix[state_idx, action_idx, next_state_idx]
+            source_sample_probs = source_task.env.transition_probs(state_idx, action_idx, next_state_idx)
+        target_sample_probs = target_task.env.transition_probs(state_idx, action_idx, next_state_idx)
         return target_sample_probs / source_sample_probs
 
 
@@ -360,11 +362,13 @@ class ISLearner:
         if source_sample_probs is None:
             source_task.env.set_policy(source_policy, self.gamma)
             source_sample_probs = \
-                (source_policy.choice_matrix[state_idx, :] * source_task.env.transition_matrix[state_idx, :,
-                                                             next_state_idx]).sum(axis=1)
+                (source_policy.choice_matrix[state_idx, :] *
+                 source_task.env.transition_probs(state_idx[:, None], np.arange(source_policy.choice_matrix.shape[1])[None, :],
+                                                  next_state_idx[:, None])).sum(axis=1)
         target_sample_probs = \
-            (target_policy.choice_matrix[state_idx, :] * target_task.env.transition_matrix[state_idx, :,
-                                                         next_state_idx]).sum(axis=1)
+            (target_policy.choice_matrix[state_idx, :] *
+             target_task.env.transition_probs(state_idx[:, None], np.arange(target_policy.choice_matrix.shape[1])[None, :],
+                                              next_state_idx[:, None])).sum(axis=1)
         return target_sample_probs / source_sample_probs
 
 
@@ -377,9 +381,9 @@ class ISLearner:
         if source_sample_probs is None:
             source_task.env.set_policy(source_policy, self.gamma)
             source_sample_probs = source_policy.choice_matrix[state_idx, action_idx] * \
-                                  source_task.env.transition_matrix[state_idx, action_idx, next_state_idx]
-        target_sample_probs = target_policy.choice_matrix[state_idx, action_idx] * target_task.env.transition_matrix[
-            state_idx, action_idx, next_state_idx]
+                                  source_task.env.transition_probs(state_idx, action_idx, next_state_idx)
+        target_sample_probs = target_policy.choice_matrix[state_idx, action_idx] * target_task.env.transition_probs(
+            state_idx, action_idx, next_state_idx)
 
 
         return target_sample_probs / source_sample_probs
\ No newline at end of file
@@ -1,11 +1,12 @@
 import numpy as np
 import scipy as sp
 import time
+from CompressedSamples import compress_samples, concatenate_samples, group_sums
 
 class LSTD_Q_Estimator:
 
     def __init__(self, n_kernels_pos, n_kernels_vel, n_kernels_act, eps, fit_bias, gamma, lam, min_pos, max_pos, min_vel,
-                 max_vel, min_act, max_act):
+                 max_vel, min_act, max_act, dtype=np.float64):
         self.n_kernels_pos = n_kernels_pos
         self.n_kernels_vel = n_kernels_vel
         self.n_kernels_act = n_kernels_act
@@ -16,6 +17,8 @@ class LSTD_Q_Estimator:
         self.max_pos = max_pos
         self.min_vel = min_vel
         self.max_vel = max_vel
+        # Storage precision of the feature matrices, A and b are returned in float64
+        self.dtype = dtype
         self.min_act = min_act
         self.max_act = max_act
         self.pos_kernels = np.linspace(min_pos, max_pos, n_kernels_pos)
@@ -32,6 +35,40 @@ class LSTD_Q_Estimator:
         self.source_phi_sa = None
         self.source_phi_nsa = None
         self.source_rewards = None
+        # Row of source_phi_sa of every source sample, the rows being the distinct source transitions, None when they
+        # are the samples themselves
+        self.source_inverse = None
+        # Features of every state and action of a discrete grid, state major, and the representatives they were taken at
+        self.phi_table = None
+        self.grid_reps = None
+
+
+
+    def set_grid(self, state_reps, action_reps):
+        # Tabulates the features of the grid, so that samples carrying their state and action indices gather them
+        # instead of evaluating the kernels
+        if self.grid_reps is None or not np.array_equal(self.grid_reps[0], state_reps) or \
+                not np.array_equal(self.grid_reps[1], action_reps):
+            idx_grid = np.dstack(np.meshgrid(np.arange(state_reps.shape[0]), np.arange(action_reps.shape[0]),
+                                             indexing='ij')).reshape(-1, 2)
+            self.phi_table = self.map_to_feature_space(state_reps[idx_grid[:, 0]], action_reps[idx_grid[:, 1]])
+            self.grid_reps = (state_reps.copy(), action_reps.copy())
+        return self.phi_table
+
+
+
+    def features(self, s, a, s_idx=None, a_idx=None):
+        # Rows of phi_table when the indices of the samples on the grid are given, the kernels otherwise
+        if self.phi_table is None or s_idx is None or a_idx is None:
+            return self.map_to_feature_space(s, a)
+        return self.phi_table[np.ravel_multi_index((s_idx, a_idx), (self.grid_reps[0].shape[0], self.grid_reps[1].shape[0]))]
+
+
+
+    def sample_features(self, dataset):
+        # Features of the first and of the next state-action pairs of dataset
+        return self.features(dataset['fs'], dataset['a'], dataset.get('fsi'), dataset.get('ai')), \
+               self.features(dataset['ns'], dataset['na'], dataset.get('nsi'), dataset.get('nai'))
 
 
 
@@ -58,76 +95,89 @@ class LSTD_Q_Estimator:
             phi = np.exp(-dists / self.eps ** 2)
             if self.fit_bias:
                 phi = np.append(phi, 1.)
-        return phi
+        return phi.astype(self.dtype, copy=False)
 
 
 
     def add_sources(self, source_datasets):
+        samples = concatenate_samples(source_datasets)
+        sources = compress_samples(samples)
+        phi_sa, phi_nsa = self.sample_features(sources)
         if self.source_phi_sa is None and self.source_phi_nsa is None and self.source_rewards is None:
-            self.source_phi_sa = self.map_to_feature_space(np.vstack([sd['fs'] for sd in source_datasets]),
-                                                           np.hstack([sd['a'] for sd in source_datasets]))
-            self.source_phi_nsa = self.map_to_feature_space(np.vstack([sd['ns'] for sd in source_datasets]),
-                                                            np.hstack([sd['na'] for sd in source_datasets]))
-            self.source_rewards = np.hstack([sd['r'] for sd in source_datasets])
+            self.source_phi_sa = phi_sa
+            self.source_phi_nsa = phi_nsa
+            self.source_rewards = samples['r']
+            self.source_inverse = sources['inverse']
         else:
-            self.source_phi_sa = np.vstack([self.source_phi_sa] +
-                                           self.map_to_feature_space(np.vstack([sd['fs'] for sd in source_datasets]),
-                                                                     np.hstack([sd['a'] for sd in source_datasets])))
-            self.source_phi_nsa = np.vstack([self.source_phi_nsa] +
-                                            self.map_to_feature_space(np.vstack([sd['ns'] for sd in source_datasets]),
-                                                                      np.hstack([sd['na'] for sd in source_datasets])))
-            self.source_rewards = np.hstack([self.source_rewards] +
-                                            np.hstack([sd['r'] for sd in source_datasets]))
+            if self.source_inverse is None:
+                self.source_inverse = np.arange(self.source_phi_sa.shape[0])
+            self.source_inverse = np.concatenate((self.source_inverse, sources['inverse'] + self.source_phi_sa.shape[0]))
+            self.source_phi_sa = np.vstack((self.source_phi_sa, phi_sa))
+            self.source_phi_nsa = np.vstack((self.source_phi_nsa, phi_nsa))
+            self.source_rewards = np.hstack((self.source_rewards, samples['r']))
 
 
 
     def clean_sources(self):
-        self.source_phi_sa = self.source_phi_nsa = self.source_rewards = None
+        self.source_phi_sa = self.source_phi_nsa = self.source_rewards = self.source_inverse = None
+
+
+
+    def weighted_matrices(self, phi_sa, phi_nsa, weights, rewards):
+        # Sums over the rows of weights * phi_sa (phi_sa - gamma phi_nsa)^T and of rewards * phi_sa, the rows being
+        # groups of samples and rewards the sums of their weighted rewards
+        A = (phi_sa * weights.reshape((-1, 1))).T.dot(phi_sa - self.gamma * phi_nsa)
+        return A.astype(np.float64, copy=False), phi_sa.T.dot(rewards).astype(np.float64, copy=False)
 
 
 
     def produce_matrices(self, dataset):
-        first_states = dataset['fs']
-        actions = dataset['a']
-        next_states = dataset['ns']
-        next_actions = dataset['na']
-        phi_sa = self.map_to_feature_space(first_states, actions)
-        phi_nsa = self.map_to_feature_space(next_states, next_actions)
-        rewards = dataset['r']
-        delta_phi = phi_sa - self.gamma * phi_nsa
-        A = (phi_sa / phi_sa.shape[0]).T.dot(delta_phi)
-        b = phi_sa * rewards.reshape((-1, 1))
-        b = b.mean(axis=0)
-        return A, b
+        # Datasets and blocks may be compressed, and are compressed here otherwise
+        if not isinstance(dataset, dict):
+            # An iterable of sample blocks (e.g. env.iter_sample_steps), accumulated without joining them
+            A = 0.
+            b = 0.
+            n = 0
+            for block in dataset:
+                block = compress_samples(block)
+                A_block, b_block = self.weighted_matrices(*self.sample_features(block), block['w'], block['r'])
+                A = A + A_block
+                b = b + b_block
+                n += block['n']
+            return np.asarray(A, dtype=np.float64) / n, b / n
+        dataset = compress_samples(dataset)
+        A, b = self.weighted_matrices(*self.sample_features(dataset), dataset['w'], dataset['r'])
+        return A / dataset['n'], b / dataset['n']
 
 
 
     def fit(self, dataset, source_weights=None, predict=False): #Direct transfer works here because reward function is the same
-        first_states = dataset['fs']
-        actions = dataset['a']
-        next_states = dataset['ns']
-        next_actions = dataset['na']
-        phi_sa = self.map_to_feature_space(first_states, actions)
-        phi_nsa = self.map_to_feature_space(next_states, next_actions)
-        rewards = dataset['r']
+        # A and b take one term per distinct transition of dataset and of the sources. The predictions are for the rows
+        # of dataset as given, i.e. for its groups when it is passed compressed, followed by the source samples
+        compressed = compress_samples(dataset)
+        phi_sa, phi_nsa = self.sample_features(compressed)
+        weights = compressed['w']
+        rewards = compressed['r']
+        n = compressed['n']
 
         if source_weights is not None:
             phi_sa = np.vstack((phi_sa, self.source_phi_sa))
             phi_nsa = np.vstack((phi_nsa, self.source_phi_nsa))
-            rewards = np.hstack((rewards, self.source_rewards))
-            weights = np.hstack((np.ones(first_states.shape[0], dtype=np.float64), source_weights))
+            n_groups = self.source_phi_sa.shape[0]
+            weights = np.hstack((weights, group_sums(self.source_inverse, source_weights, n_groups)))
+            rewards = np.hstack((rewards, group_sums(self.source_inverse, source_weights * self.source_rewards, n_groups)))
+            n += self.source_rewards.shape[0]
 
-        delta_phi = phi_sa - self.gamma * phi_nsa
-        if source_weights is not None:
-            delta_phi *= weights.reshape((-1,1))
-        A = (phi_sa/phi_sa.shape[0]).T.dot(delta_phi)
-        b = phi_sa * rewards.reshape((-1,1))
-        if source_weights is not None:
-            b *= weights.reshape((-1,1))
-        b = b.mean(axis=0)
-        self.theta = sp.linalg.pinv2(A).dot(b)
+        A, b = self.weighted_matrices(phi_sa, phi_nsa, weights, rewards)
+        self.theta = sp.linalg.pinv2(A / n).dot(b / n)
         if predict:
-            return phi_sa.dot(self.theta)
+            Q = phi_sa.dot(self.theta)
+            n_target = compressed['w'].shape[0]
+            Q_target = Q[:n_target] if compressed is dataset else Q[:n_target][compressed['inverse']]
+            if source_weights is None:
+                return Q_target
+            Q_source = Q[n_target:] if self.source_inverse is None else Q[n_target:][self.source_inverse]
+            return np.hstack((Q_target, Q_source))
 
 
 
@@ -147,7 +197,7 @@ class LSTD_Q_Estimator:
                                         task.env.action_reps[idx_grid[:, 1]].reshape((-1, 1)))
         delta_phi = np.zeros_like(phi, dtype=np.float64)
         for i in range(delta_phi.shape[0]):
-            p = task.env.transition_matrix[idx_grid[i, 0], idx_grid[i, 1]]
+            p = task.env.transition_rows(idx_grid[i, 0], idx_grid[i, 1])
             dseta_pi = p[idx_grid[:, 0]] * policy.choice_matrix[idx_grid[:, 0], idx_grid[:, 1]]
             delta_phi[i] = phi[i] - self.gamma * dseta_pi.dot(phi)
         del p, dseta_pi
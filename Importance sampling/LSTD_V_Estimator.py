@@ -1,9 +1,10 @@
 import numpy as np
 import scipy as sp
+from CompressedSamples import compress_samples, concatenate_samples, group_sums
 
 
 class LSTD_V_Estimator:
-    def __init__(self, n_kernels_pos, n_kernels_vel, eps, fit_bias, gamma, lam, min_pos, max_pos, min_vel, max_vel):
+    def __init__(self, n_kernels_pos, n_kernels_vel, eps, fit_bias, gamma, lam, min_pos, max_pos, min_vel, max_vel, dtype=np.float64):
         self.n_kernels_pos = n_kernels_pos
         self.n_kernels_vel = n_kernels_vel
         self.eps = eps
@@ -14,6 +15,8 @@ class LSTD_V_Estimator:
         self.max_pos = max_pos
         self.min_vel = min_vel
         self.max_vel = max_vel
+        # Storage precision of the feature matrices, A and b are returned in float64
+        self.dtype = dtype
         self.pos_kernels = np.linspace(min_pos, max_pos, n_kernels_pos)
         self.vel_kernels = np.linspace(min_vel, max_vel, n_kernels_vel)
         self.idx_grid = np.dstack(np.meshgrid(np.arange(self.pos_kernels.shape[0]),
@@ -22,6 +25,36 @@ class LSTD_V_Estimator:
         self.source_phi_s = None
         self.source_phi_ns = None
         self.source_rewards = None
+        # Row of source_phi_s of every source sample, the rows being the distinct source transitions, None when they
+        # are the samples themselves
+        self.source_inverse = None
+        # Features of every state of a discrete grid and the representatives they were taken at
+        self.phi_table = None
+        self.grid_reps = None
+
+
+
+    def set_grid(self, state_reps):
+        # Tabulates the features of the grid, so that samples carrying their state indices gather them instead of
+        # evaluating the kernels
+        if self.grid_reps is None or not np.array_equal(self.grid_reps, state_reps):
+            self.phi_table = self.map_to_feature_space(state_reps)
+            self.grid_reps = state_reps.copy()
+        return self.phi_table
+
+
+
+    def features(self, s, s_idx=None):
+        # Rows of phi_table when the indices of the states on the grid are given, the kernels otherwise
+        if self.phi_table is None or s_idx is None:
+            return self.map_to_feature_space(s)
+        return self.phi_table[s_idx]
+
+
+
+    def sample_features(self, dataset):
+        # Features of the first and of the next states of dataset
+        return self.features(dataset['fs'], dataset.get('fsi')), self.features(dataset['ns'], dataset.get('nsi'))
 
 
 
@@ -40,69 +73,89 @@ class LSTD_V_Estimator:
             phi = np.exp(-dists / self.eps ** 2)
             if self.fit_bias:
                 phi = np.append(phi, 1.)
-        return phi
+        return phi.astype(self.dtype, copy=False)
 
 
 
     def add_sources(self, source_datasets):
+        samples = concatenate_samples(source_datasets)
+        sources = compress_samples(samples)
+        phi_s, phi_ns = self.sample_features(sources)
         if self.source_phi_s is None and self.source_phi_ns is None and self.source_rewards is None:
-            self.source_phi_s = self.map_to_feature_space(np.vstack([sd['fs'] for sd in source_datasets]))
-            self.source_phi_ns = self.map_to_feature_space(np.vstack([sd['ns'] for sd in source_datasets]))
-            self.source_rewards = np.hstack([sd['r'] for sd in source_datasets])
+            self.source_phi_s = phi_s
+            self.source_phi_ns = phi_ns
+            self.source_rewards = samples['r']
+            self.source_inverse = sources['inverse']
         else:
-            self.source_phi_s = np.vstack([self.source_phi_s] +
-                                          self.map_to_feature_space(np.vstack([sd['fs'] for sd in source_datasets])))
-            self.source_phi_ns = np.vstack([self.source_phi_ns] +
-                                           self.map_to_feature_space(np.vstack([sd['ns'] for sd in source_datasets])))
-            self.source_rewards = np.hstack([self.source_rewards] +
-                                            np.hstack([sd['r'] for sd in source_datasets]))
+            if self.source_inverse is None:
+                self.source_inverse = np.arange(self.source_phi_s.shape[0])
+            self.source_inverse = np.concatenate((self.source_inverse, sources['inverse'] + self.source_phi_s.shape[0]))
+            self.source_phi_s = np.vstack((self.source_phi_s, phi_s))
+            self.source_phi_ns = np.vstack((self.source_phi_ns, phi_ns))
+            self.source_rewards = np.hstack((self.source_rewards, samples['r']))
 
 
 
     def clean_sources(self):
-        self.source_phi_s = self.source_phi_ns = self.source_rewards = None
+        self.source_phi_s = self.source_phi_ns = self.source_rewards = self.source_inverse = None
+
+
 
 
+    def weighted_matrices(self, phi_s, phi_ns, weights, rewards):
+        # Sums over the rows of weights * phi_s (phi_s - gamma phi_ns)^T and of rewards * phi_s, the rows being groups of
+        # samples and rewards the sums of their weighted rewards
+        A = (phi_s * weights.reshape((-1, 1))).T.dot(phi_s - self.gamma * phi_ns)
+        return A.astype(np.float64, copy=False), phi_s.T.dot(rewards).astype(np.float64, copy=False)
+
 
 
     def produce_matrices(self, dataset):
-        first_states = dataset['fs']
-        next_states = dataset['ns']
-        phi_s = self.map_to_feature_space(first_states)
-        phi_ns = self.map_to_feature_space(next_states)
-        rewards = dataset['r']
-        delta_phi = phi_s - self.gamma * phi_ns
-        A = (phi_s / phi_s.shape[0]).T.dot(delta_phi)
-        b = phi_s * rewards.reshape((-1, 1))
-        b = b.mean(axis=0)
-        return A, b
+        # Datasets and blocks may be compressed, and are compressed here otherwise
+        if not isinstance(dataset, dict):
+            # An iterable of sample blocks (e.g. env.iter_sample_steps), accumulated without joining them
+            A = 0.
+            b = 0.
+            n = 0
+            for block in dataset:
+                block = compress_samples(block)
+                A_block, b_block = self.weighted_matrices(*self.sample_features(block), block['w'], block['r'])
+                A = A + A_block
+                b = b + b_block
+                n += block['n']
+            return np.asarray(A, dtype=np.float64) / n, b / n
+        dataset = compress_samples(dataset)
+        A, b = self.weighted_matrices(*self.sample_features(dataset), dataset['w'], dataset['r'])
+        return A / dataset['n'], b / dataset['n']
 
 
 
     def fit(self, dataset, source_weights=None, predict=False):
-        first_states = dataset['fs']
-        next_states = dataset['ns']
-        phi_s = self.map_to_feature_space(first_states)
-        phi_ns = self.map_to_feature_space(next_states)
-        rewards = dataset['r']
+        # As LSTD_Q_Estimator.fit, with the predictions for the rows of dataset as given followed by the source samples
+        compressed = compress_samples(dataset)
+        phi_s, phi_ns = self.sample_features(compressed)
+        weights = compressed['w']
+        rewards = compressed['r']
+        n = compressed['n']
 
         if source_weights is not None:
             phi_s = np.vstack((phi_s, self.source_phi_s))
             phi_ns = np.vstack((phi_ns, self.source_phi_ns))
-            rewards = np.hstack((rewards, self.source_rewards))
-            weights = np.hstack((np.ones(first_states.shape[0], dtype=np.float64), source_weights))
+            n_groups = self.source_phi_s.shape[0]
+            weights = np.hstack((weights, group_sums(self.source_inverse, source_weights, n_groups)))
+            rewards = np.hstack((rewards, group_sums(self.source_inverse, source_weights * self.source_rewards, n_groups)))
+            n += self.source_rewards.shape[0]
 
-        delta_phi = phi_s - self.gamma * phi_ns
-        if source_weights is not None:
-            delta_phi *= weights.reshape((-1, 1))
-        A = (phi_s/phi_s.shape[0]).T.dot(delta_phi)
-        b = phi_s * rewards.reshape((-1,1))
-        if source_weights is not None:
-            b *= weights.reshape((-1, 1))
-        b = b.mean(axis=0)
-        self.theta = sp.linalg.pinv2(A).dot(b)
+        A, b = self.weighted_matrices(phi_s, phi_ns, weights, rewards)
+        self.theta = sp.linalg.pinv2(A / n).dot(b / n)
         if predict:
-            return phi_s.dot(self.theta)
+            V = phi_s.dot(self.theta)
+            n_target = compressed['w'].shape[0]
+            V_target = V[:n_target] if compressed is dataset else V[:n_target][compressed['inverse']]
+            if source_weights is None:
+                return V_target
+            V_source = V[n_target:] if self.source_inverse is None else V[n_target:][self.source_inverse]
+            return np.hstack((V_target, V_source))
 
 
 
@@ -116,8 +169,7 @@ class LSTD_V_Estimator:
     def calculate_theta(self, task, policy):
         task.env.set_policy(policy, self.gamma)
         phi = self.map_to_feature_space(task.env.state_reps)
-        P_pi = np.transpose(task.env.transition_matrix, axes=(2, 0, 1)).copy()
-        P_pi = (P_pi * policy.choice_matrix).sum(axis=2).T
+        P_pi = task.env.policy_transition_matrix(policy.choice_matrix, dense=True)
         delta_phi = phi - self.gamma*P_pi.dot(phi)
         D = np.diag(task.env.delta_distr.flatten())
         A = phi.T.dot(D.dot(delta_phi))
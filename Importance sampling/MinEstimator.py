@@ -1,18 +1,34 @@
 import numpy as np
 import math
-from scipy.optimize import minimize, fixed_point, root, brentq
-from scipy.special import erf, iv
-from scipy.special import gamma as gam_fun
-from scipy.stats import ncx2, norm, moment, chi2
+from scipy.optimize import fixed_point, root
+from scipy.special import erf
+from scipy.stats import moment
 import gym
+from functools import partial
+from TransitionBounds import lipschitz_bounds, cached_lipschitz_bounds, lipschitz_bounds_key, fill_lipschitz_bounds_cache, \
+    bin_geometry, delta_d_q_entries
+from BoxQP import GroupedQuadratic, solve_box_qp
+from NoncentralChiCI import noncentral_chi_ci
 import subprocess
 import time
 
 
 
 class MinWeightsEstimator():
-    def __init__(self, gamma):
+    def __init__(self, gamma, dtype=np.float64, cache_dir=None, warm_start=True, executor=None, process_executor=None):
         self.gamma = gamma
+        # Whether each weights objective starts from its previous solution rather than from all ones
+        self.warm_start = warm_start
+        # Precision of the (S, A, S[, A]) bound tensors, the weights themselves are always optimized in float64
+        self.dtype = dtype
+        # Directory where the Lipschitz bounds of the sources are kept across runs and processes, None recomputes them
+        self.cache_dir = cache_dir
+        # Executor (e.g. a concurrent.futures.ThreadPoolExecutor) the per-source stages of add_sources and prepare_* are
+        # mapped on, None runs the sources in turn. Every source only writes its own slices, so results do not depend on it
+        self.executor = executor
+        # Process executor the Lipschitz bounds are built on in add_sources. The workers write them to cache_dir, which
+        # must be set, and the sources map the files, so the arrays are shared rather than sent back
+        self.process_executor = process_executor
 
 
 
@@ -46,7 +62,14 @@ class MinWeightsEstimator():
                               n_action_bins=source_tasks[0].env.action_bins.shape[0],
                               position_noise=0.025, velocity_noise=0.025)
 
-        self.source_samples = source_samples
+        # Target power the policy-independent terms of prepare_lstd and prepare_gradient were computed for
+        self.target_power = None
+        # Quadratic objectives of estimate_weights_lstdq/v, built at their first call
+        self.quadratic_q = None
+        self.quadratic_v = None
+        # Last solution and (iterations, CG iterations, seconds) of every solver call, per objective
+        self.last_solutions = {'grad': None, 'q': None, 'v': None}
+        self.solver_stats = {'grad': [], 'q': [], 'v': []}
         self.source_tasks = source_tasks
         self.source_policies = source_policies
         self.m = len(source_tasks)
@@ -58,7 +81,8 @@ class MinWeightsEstimator():
             self.all_phi_V = all_phi_V
             self.n_features_v = all_phi_V.shape[1]
 
-        self.L_P_eps_s_a_s_prime = np.zeros((self.m,) + source_tasks[0].env.transition_matrix.shape, dtype=np.float64)
+        # One (S, A, S) tensor per source, which may be a memory map of the bounds cache
+        self.L_P_eps_s_a_s_prime = [None] * self.m
         self.L_P_eps_s_prime = np.zeros((self.m, source_tasks[0].env.V.shape[0]), dtype=np.float64)
         self.delta_P_eps_theta_s_s_prime = np.zeros((self.m, source_tasks[0].env.V.shape[0], source_tasks[0].env.V.shape[0]), dtype=np.float64)
         self.delta_P_eps_theta_s = np.zeros((self.m, source_tasks[0].env.V.shape[0]), dtype=np.float64)
@@ -73,420 +97,144 @@ class MinWeightsEstimator():
         if self.for_LSTDQ or self.for_LSTDV:
             self.reduced_source_sizes_q = np.zeros(self.m, dtype=np.int64)
             self.reduced_source_sizes_v = np.zeros(self.m, dtype=np.int64)
-            self.M_P_eps_s_a_s_prime = np.zeros((self.m,) + source_tasks[0].env.transition_matrix.shape, dtype=np.float64)
+            self.M_P_eps_s_a_s_prime = np.zeros((self.m,) + source_tasks[0].env.transition_shape, dtype=self.dtype)
 
         if self.for_LSTDQ:
-            self.zeta_rep = np.zeros((self.m,) + source_tasks[0].env.Q.shape + source_tasks[0].env.Q.shape, dtype=np.float64)
-            self.p_rep = np.zeros((self.m,) + source_tasks[0].env.Q.shape + source_tasks[0].env.Q.shape, dtype=np.float64)
-            self.L_p_rep = np.zeros((self.m,) + source_tasks[0].env.Q.shape + source_tasks[0].env.Q.shape, dtype=np.float64)
-            self.M_p_rep = np.zeros((self.m,) + source_tasks[0].env.Q.shape + source_tasks[0].env.Q.shape, dtype=np.float64)
-            self.delta_d_q = np.zeros((self.m,) + source_tasks[0].env.Q.shape + source_tasks[0].env.Q.shape, dtype=np.float64)
-            self.delta_d_q_b = np.zeros((self.m,) + source_tasks[0].env.Q.shape + source_tasks[0].env.V.shape, dtype=np.float64)
             self.delta_A_q = np.zeros((self.m, self.n_features_q, self.n_features_q), dtype=np.float64)
             self.delta_b_q = np.zeros((self.m, self.n_features_q), dtype=np.float64)
 
         if self.for_LSTDV:
-            self.delta_d_v = np.zeros((self.m,) + source_tasks[0].env.Q.shape + source_tasks[0].env.V.shape, dtype=np.float64)
             self.delta_A_v = np.zeros((self.m, self.n_features_v, self.n_features_v), dtype=np.float64)
             self.delta_b_v = np.zeros((self.m, self.n_features_v), dtype=np.float64)
 
-        for j in range(self.m):
-            for s in range(source_tasks[0].env.transition_matrix.shape[0]):
-                mu_peak_pos_e = np.zeros(source_tasks[j].env.position_reps.shape[0], dtype=np.float64)
-                mu_peak_vel_e = np.zeros(source_tasks[j].env.velocity_reps.shape[0], dtype=np.float64)
-                for pos_prime in range(source_tasks[j].env.position_reps.shape[0]):
-                    if pos_prime != 0 and pos_prime != source_tasks[j].env.position_reps.shape[0] - 1:
-                        p1 = source_tasks[j].env.position_bins[pos_prime]
-                        p2 = source_tasks[j].env.position_bins[pos_prime + 1]
-
-                        def f(x):
-                            return (np.log(p2 - x) - np.log(p1 - x) + (p1 ** 2 - p2 ** 2) / (
-                            2. * source_tasks[j].env.position_noise ** 2)) / (
-                                   (p1 - p2) / source_tasks[j].env.position_noise ** 2) - x
-
-                        mu_peak_pos_e[pos_prime] = root(f, p1 - 0.1).x
-                for vel_prime in range(source_tasks[j].env.velocity_reps.shape[0]):
-                    if vel_prime != 0 and vel_prime != source_tasks[j].env.velocity_reps.shape[0] - 1:
-                        v1 = source_tasks[j].env.velocity_bins[vel_prime]
-                        v2 = source_tasks[j].env.velocity_bins[vel_prime + 1]
-
-                        def f(x):
-                            return (np.log(v2 - x) - np.log(v1 - x) + (v1 ** 2 - v2 ** 2) / (
-                            2. * source_tasks[j].env.velocity_noise ** 2)) / (
-                                   (v1 - v2) / source_tasks[j].env.velocity_noise ** 2) - x
-
-                        mu_peak_vel_e[vel_prime] = root(f, v1 - 0.01).x
-                for a in range(source_tasks[0].env.transition_matrix.shape[1]):
-                    M_e_pos = np.zeros(source_tasks[j].env.position_reps.shape[0], dtype=np.float64)
-                    M_e_vel = np.zeros(source_tasks[j].env.velocity_reps.shape[0], dtype=np.float64)
-                    M_P_pos = np.zeros(source_tasks[j].env.position_reps.shape[0], dtype=np.float64)
-                    M_P_vel = np.zeros(source_tasks[j].env.velocity_reps.shape[0], dtype=np.float64)
-                    mu_min_source = min_source.env.clean_step(source_tasks[j].env.state_reps[s],
-                                                              source_tasks[j].env.action_reps[a:a + 1])
-                    mu_max_source = max_source.env.clean_step(source_tasks[j].env.state_reps[s],
-                                                              source_tasks[j].env.action_reps[a:a + 1])
-                    for pos_prime in range(source_tasks[j].env.position_reps.shape[0]):
-                        if pos_prime == 0:
-                            eps_peak = \
-                                (source_tasks[j].env.position_bins[1] - source_tasks[j].env.state_reps[s].sum() +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if eps_peak < min_power or eps_peak > max_power:
-                                M_e_pos[pos_prime] = max(
-                                    np.exp(-(source_tasks[j].env.position_bins[1] - mu_min_source[0]) ** 2 /
-                                           (2. * source_tasks[j].env.position_noise ** 2)),
-                                    np.exp(-(source_tasks[j].env.position_bins[1] - mu_max_source[0]) ** 2 /
-                                           (2. * source_tasks[j].env.position_noise ** 2)))
-                            else:
-                                M_e_pos[pos_prime] = 1.
-                            eps_peak = \
-                                (source_tasks[j].env.position_bins[0] - source_tasks[j].env.state_reps[s].sum() +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if eps_peak < min_power or eps_peak > max_power:
-                                M_P_pos[pos_prime] = max(
-                                    (1. + erf((source_tasks[j].env.position_bins[1] - mu_min_source[0]) /
-                                              (np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.,
-                                    (1. + erf((source_tasks[j].env.position_bins[1] - mu_max_source[0]) /
-                                              (np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.)
-                            else:
-                                M_P_pos[pos_prime] = (1. + erf(
-                                    (source_tasks[j].env.position_bins[1] - source_tasks[j].env.position_bins[0]) /
-                                    (np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.
-                        elif pos_prime == source_tasks[j].env.position_reps.shape[0] - 1:
-                            eps_peak = \
-                                (source_tasks[j].env.position_bins[-2] - source_tasks[j].env.state_reps[s].sum() +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if eps_peak < min_power or eps_peak > max_power:
-                                M_e_pos[pos_prime] = max(
-                                    np.exp(-(source_tasks[j].env.position_bins[-2] - mu_min_source[0]) ** 2 /
-                                           (2. * source_tasks[j].env.position_noise ** 2)),
-                                    np.exp(-(source_tasks[j].env.position_bins[-2] - mu_max_source[0]) ** 2 /
-                                           (2. * source_tasks[j].env.position_noise ** 2)))
-                            else:
-                                M_e_pos[pos_prime] = 1.
-                            eps_peak = \
-                                (source_tasks[j].env.position_bins[-1] - source_tasks[j].env.state_reps[s].sum() +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if eps_peak < min_power or eps_peak > max_power:
-                                M_P_pos[pos_prime] = max(
-                                    (1. - erf((source_tasks[j].env.position_bins[-2] - mu_min_source[0]) /
-                                              (np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.,
-                                    (1. - erf((source_tasks[j].env.position_bins[-2] - mu_max_source[0]) /
-                                              (np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.)
-                            else:
-                                M_P_pos[pos_prime] = (1. - erf(
-                                    (source_tasks[j].env.position_bins[-2] - source_tasks[j].env.position_bins[-1]) /
-                                    (np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.
-                        else:
-                            p1 = source_tasks[j].env.position_bins[pos_prime]
-                            p2 = source_tasks[j].env.position_bins[pos_prime + 1]
-                            pm = (p1 + p2) / 2.
-                            mu_peak = mu_peak_pos_e[pos_prime]
-                            if mu_peak < p1:
-                                mu_peak1 = mu_peak
-                                mu_peak2 = 2 * pm - mu_peak
-                            else:
-                                mu_peak2 = mu_peak
-                                mu_peak1 = 2 * pm - mu_peak
-                            eps_peak1 = \
-                                (mu_peak1 - source_tasks[j].env.state_reps[s].sum() +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            eps_peak2 = \
-                                (mu_peak2 - source_tasks[j].env.state_reps[s].sum() +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if (eps_peak1 < min_power or eps_peak1 > max_power) and (
-                                    eps_peak2 < min_power or eps_peak2 > max_power):
-                                M_e_pos[pos_prime] = max(np.abs(np.exp(-(p1 - mu_min_source[0]) ** 2 /
-                                                                       (2 * source_tasks[j].env.position_noise ** 2)) -
-                                                                np.exp(-(p2 - mu_min_source[0]) ** 2 /
-                                                                       (2 * source_tasks[j].env.position_noise ** 2))),
-                                                         np.abs(np.exp(-(p1 - mu_max_source[0]) ** 2 /
-                                                                       (2 * source_tasks[j].env.position_noise ** 2))
-                                                                - np.exp(-(p2 - mu_max_source[0]) ** 2 /
-                                                                         (
-                                                                         2 * source_tasks[j].env.position_noise ** 2))))
-                            else:
-                                M_e_pos[pos_prime] = \
-                                    np.abs(
-                                        np.exp(-(p1 - mu_peak) ** 2 / (2 * source_tasks[j].env.position_noise ** 2)) -
-                                        np.exp(-(p2 - mu_peak) ** 2 / (2 * source_tasks[j].env.position_noise ** 2)))
-                            eps_peak = \
-                                (pm - source_tasks[j].env.state_reps[s].sum() +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if eps_peak < min_power or eps_peak > max_power:
-                                M_P_pos[pos_prime] = \
-                                    max((erf(
-                                        (p2 - mu_min_source[0]) / (np.sqrt(2.) * source_tasks[j].env.position_noise)) -
-                                         erf((p1 - mu_min_source[0]) / (
-                                         np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.,
-                                        (erf((p2 - mu_max_source[0]) / (
-                                        np.sqrt(2.) * source_tasks[j].env.position_noise)) -
-                                         erf((p1 - mu_max_source[0]) / (
-                                         np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.)
-                            else:
-                                M_P_pos[pos_prime] = (erf(
-                                    (p2 - pm) / (np.sqrt(2.) * source_tasks[j].env.position_noise)) -
-                                                      erf((p1 - pm) / (
-                                                      np.sqrt(2.) * source_tasks[j].env.position_noise))) / 2.
-                    for vel_prime in range(source_tasks[j].env.velocity_reps.shape[0]):
-                        real_vel_min_source = \
-                            source_tasks[j].env.state_reps[s][1] + source_tasks[j].env.action_reps[a] * 0. - \
-                            source_tasks[j].env.rescale(0.0025) * math.cos(
-                                3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))
-                        real_vel_max_source = \
-                            source_tasks[j].env.state_reps[s][1] + source_tasks[j].env.action_reps[a] * 0.5 - \
-                            source_tasks[j].env.rescale(0.0025) * math.cos(
-                                3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))
-                        real_vel_min_source, real_vel_max_source = np.clip([real_vel_min_source, real_vel_max_source],
-                                                                           source_tasks[j].env.min_speed,
-                                                                           source_tasks[j].env.max_speed)
-                        if vel_prime == 0:
-                            eps_peak = \
-                                (source_tasks[j].env.velocity_bins[1] - source_tasks[j].env.state_reps[s][1] +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if (eps_peak < min_power or eps_peak > max_power) and \
-                                    (not (real_vel_min_source < 0 and mu_min_source[0] <=
-                                        source_tasks[j].env.position_bins[1]) and
-                                         not (real_vel_max_source < 0 and mu_max_source[0] <=
-                                             source_tasks[j].env.position_bins[1])):
-                                M_e_vel[vel_prime] = max(
-                                    np.exp(-(source_tasks[j].env.velocity_bins[1] - mu_min_source[1]) ** 2 /
-                                           (2. * source_tasks[j].env.velocity_noise ** 2)),
-                                    np.exp(-(source_tasks[j].env.velocity_bins[1] - mu_max_source[1]) ** 2 /
-                                           (2. * source_tasks[j].env.velocity_noise ** 2)))
-                            else:
-                                M_e_vel[vel_prime] = 1.
-                            eps_peak = \
-                                (source_tasks[j].env.velocity_bins[0] - source_tasks[j].env.state_reps[s][1] +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if (eps_peak < min_power or eps_peak > max_power) and \
-                                    (not (real_vel_min_source < 0 and mu_min_source[0] <=
-                                        source_tasks[j].env.position_bins[1]) and
-                                         not (real_vel_max_source < 0 and mu_max_source[0] <=
-                                             source_tasks[j].env.position_bins[1])):
-                                M_P_vel[vel_prime] = max(
-                                    (1. + erf((source_tasks[j].env.velocity_bins[1] - mu_min_source[1]) /
-                                              (np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.,
-                                    (1. + erf((source_tasks[j].env.velocity_bins[1] - mu_max_source[1]) /
-                                              (np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.)
-                            else:
-                                M_P_vel[vel_prime] = (1. + erf(
-                                    (source_tasks[j].env.velocity_bins[1] - source_tasks[j].env.velocity_bins[0]) /
-                                    (np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.
-                        elif vel_prime == source_tasks[j].env.velocity_reps.shape[0] - 1:
-                            eps_peak = \
-                                (source_tasks[j].env.velocity_bins[-2] - source_tasks[j].env.state_reps[s][1] +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if (eps_peak < min_power or eps_peak > max_power) and \
-                                    (not (real_vel_min_source < 0 and mu_min_source[0] <=
-                                        source_tasks[j].env.position_bins[1]) and
-                                         not (real_vel_max_source < 0 and mu_max_source[0] <=
-                                             source_tasks[j].env.position_bins[1])):
-                                M_e_vel[vel_prime] = max(
-                                    np.exp(-(source_tasks[j].env.velocity_bins[-2] - mu_min_source[1]) ** 2 /
-                                           (2. * source_tasks[j].env.velocity_noise ** 2)),
-                                    np.exp(-(source_tasks[j].env.velocity_bins[-2] - mu_max_source[1]) ** 2 /
-                                           (2. * source_tasks[j].env.velocity_noise ** 2)))
-                            else:
-                                M_e_vel[vel_prime] = 1.
-                            eps_peak = \
-                                (source_tasks[j].env.velocity_bins[-1] - source_tasks[j].env.state_reps[s][1] +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if (eps_peak < min_power or eps_peak > max_power) and \
-                                    (not (real_vel_min_source < 0 and mu_min_source[0] <=
-                                        source_tasks[j].env.position_bins[1]) and
-                                         not (real_vel_max_source < 0 and mu_max_source[0] <=
-                                             source_tasks[j].env.position_bins[1])):
-                                M_P_vel[vel_prime] = max(
-                                    (1. - erf((source_tasks[j].env.velocity_bins[-2] - mu_min_source[1]) /
-                                              (np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.,
-                                    (1. - erf((source_tasks[j].env.velocity_bins[-2] - mu_max_source[1]) /
-                                              (np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.)
-                            else:
-                                M_P_vel[vel_prime] = (1. - erf(
-                                    (source_tasks[j].env.velocity_bins[-2] - source_tasks[j].env.velocity_bins[-1]) /
-                                    (np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.
-                        else:
-                            v1 = source_tasks[j].env.velocity_bins[vel_prime]
-                            v2 = source_tasks[j].env.velocity_bins[vel_prime + 1]
-                            vm = (v1 + v2) / 2.
-                            mu_peak = mu_peak_vel_e[vel_prime]
-                            if mu_peak < v1:
-                                mu_peak1 = mu_peak
-                                mu_peak2 = 2 * vm - mu_peak
-                            else:
-                                mu_peak2 = mu_peak
-                                mu_peak1 = 2 * vm - mu_peak
-                            eps_peak1 = \
-                                (mu_peak1 - source_tasks[j].env.state_reps[s][1] +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            eps_peak2 = \
-                                (mu_peak2 - source_tasks[j].env.state_reps[s][1] +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if (eps_peak1 < min_power or eps_peak1 > max_power) and (
-                                    eps_peak2 < min_power or eps_peak2 > max_power) and \
-                                    (not (real_vel_min_source < 0 and mu_min_source[0] ==
-                                        source_tasks[j].env.position_bins[1]) and
-                                         not (real_vel_max_source < 0 and mu_max_source[0] ==
-                                             source_tasks[j].env.position_bins[1])):
-                                M_e_vel[vel_prime] = \
-                                    max(np.abs(np.exp(
-                                        -(v1 - mu_min_source[1]) ** 2 / (2 * source_tasks[j].env.velocity_noise ** 2)) -
-                                               np.exp(-(v2 - mu_min_source[1]) ** 2 / (
-                                               2 * source_tasks[j].env.velocity_noise ** 2))),
-                                        np.abs(np.exp(-(v1 - mu_max_source[1]) ** 2 / (
-                                        2 * source_tasks[j].env.velocity_noise ** 2)) -
-                                               np.exp(-(v2 - mu_max_source[1]) ** 2 / (
-                                               2 * source_tasks[j].env.velocity_noise ** 2))))
-                            else:
-                                M_e_vel[vel_prime] = \
-                                    np.abs(
-                                        np.exp(-(v1 - mu_peak) ** 2 / (2 * source_tasks[j].env.velocity_noise ** 2)) -
-                                        np.exp(-(v2 - mu_peak) ** 2 / (2 * source_tasks[j].env.velocity_noise ** 2)))
-                            eps_peak = \
-                                (vm - source_tasks[j].env.state_reps[s][1] +
-                                 source_tasks[j].env.rescale(0.0025) * math.cos(
-                                     3 * source_tasks[j].env.inverse_transform(source_tasks[j].env.state_reps[s][0]))) / \
-                                source_tasks[j].env.action_reps[a]
-                            if (eps_peak < min_power or eps_peak > max_power) and \
-                                    (not (real_vel_min_source < 0 and mu_min_source[0] ==
-                                        source_tasks[j].env.position_bins[1]) and
-                                         not (real_vel_max_source < 0 and mu_max_source[0] ==
-                                             source_tasks[j].env.position_bins[1])):
-                                M_P_vel[vel_prime] = \
-                                    max((erf(
-                                        (v2 - mu_min_source[1]) / (np.sqrt(2.) * source_tasks[j].env.velocity_noise)) -
-                                         erf((v1 - mu_min_source[1]) / (
-                                         np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.,
-                                        (erf((v2 - mu_max_source[1]) / (
-                                        np.sqrt(2.) * source_tasks[j].env.velocity_noise)) -
-                                         erf((v1 - mu_max_source[1]) / (
-                                         np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.)
-                            else:
-                                M_P_vel[vel_prime] = \
-                                    (erf((v2 - vm) / (np.sqrt(2.) * source_tasks[j].env.velocity_noise)) -
-                                     erf((v1 - vm) / (np.sqrt(2.) * source_tasks[j].env.velocity_noise))) / 2.
-                    self.L_P_eps_s_a_s_prime[j, s, a] = \
-                        ((np.abs(source_tasks[j].env.action_reps[a]) / (
-                        np.sqrt(2. * np.pi) * source_tasks[j].env.velocity_noise)) * M_e_vel.reshape((-1, 1)).dot(
-                            M_P_pos.reshape((1, -1))) +
-                         (np.abs(source_tasks[j].env.action_reps[a]) / (
-                         np.sqrt(2. * np.pi) * source_tasks[j].env.position_noise)) * M_P_vel.reshape((-1, 1)).dot(
-                             M_e_pos.reshape((1, -1)))).flatten()
-
-            self.L_P_eps_s_prime[j] = self.L_P_eps_s_a_s_prime[j].max(axis=(0, 1))
-
-            self.source_sizes[j] = self.source_samples[j]['fs'].shape[0]
-
-            state_idx = source_samples[j]['fsi']
-            action_idx = source_samples[j]['ai']
-            next_state_idx = source_samples[j]['nsi']
-            next_action_idx = source_samples[j]['nai']
-            sorted_idx = np.lexsort((next_action_idx, next_state_idx, action_idx, state_idx))
-            state_sorted = state_idx[sorted_idx]
-            action_sorted = action_idx[sorted_idx]
-            next_state_sorted = next_state_idx[sorted_idx]
-            next_action_sorted = next_action_idx[sorted_idx]
-            state_groups = np.ones(state_idx.shape[0], dtype=bool)
-            action_groups = np.ones(state_idx.shape[0], dtype=bool)
-            next_state_groups = np.ones(state_idx.shape[0], dtype=bool)
-            next_action_groups = np.ones(state_idx.shape[0], dtype=bool)
-            state_groups[1:] = state_sorted[1:] != state_sorted[:-1]
-            action_groups[1:] = action_sorted[1:] != action_sorted[:-1]
-            next_state_groups[1:] = next_state_sorted[1:] != next_state_sorted[:-1]
-            next_action_groups[1:] = next_action_sorted[1:] != next_action_sorted[:-1]
+        assert self.process_executor is None or self.cache_dir is not None
+        if self.cache_dir is not None and (self.executor is not None or self.process_executor is not None):
+            # One job per distinct bound before fanning out, the sources on the same grid sharing it, so that no two jobs
+            # build the same files. They run in worker processes when there is a process executor
+            executor = self.process_executor if self.process_executor is not None else self.executor
+            jobs = {lipschitz_bounds_key(source_tasks[j].env, min_source.env, max_source.env, min_power, max_power, self.dtype):
+                        source_tasks[j].env for j in range(self.m)}
+            list(executor.map(partial(fill_lipschitz_bounds_cache, min_env=min_source.env, max_env=max_source.env,
+                                      min_power=min_power, max_power=max_power, cache_dir=self.cache_dir, dtype=self.dtype),
+                              list(jobs.values())))
+
+        self.source_samples = [{} for _ in range(self.m)]
+
+        def add_source(j):
+            if self.cache_dir is None:
+                self.L_P_eps_s_a_s_prime[j] = lipschitz_bounds(source_tasks[j].env, min_source.env, max_source.env, min_power,
+                                                               max_power, bin_geometry(source_tasks[j].env)).astype(self.dtype, copy=False)
+                self.L_P_eps_s_prime[j] = self.L_P_eps_s_a_s_prime[j].max(axis=(0, 1))
+            else:
+                self.L_P_eps_s_a_s_prime[j], self.L_P_eps_s_prime[j] = \
+                    cached_lipschitz_bounds(source_tasks[j].env, min_source.env, max_source.env, min_power, max_power,
+                                            self.cache_dir, self.dtype)
+            self.append_source_samples(j, source_samples[j])
 
-            if self.for_gradient:
-                groups = np.logical_or(state_groups, action_groups)
-                groups = np.arange(groups.shape[0])[groups]
-                self.source_samples[j]['idx_s_grad'] = sorted_idx
-                self.source_samples[j]['grps_grad'] = groups
-                self.source_samples[j]['grp_szs_grad'] = np.diff(np.append(groups, self.source_sizes[j]))
-                self.reduced_source_sizes_grad[j] = groups.size
+        self.for_each_source(add_source)
+
+
+
+    def for_each_source(self, f):
+        # Runs f(j) for every source, through the executor if there is one
+        if self.executor is None:
+            for j in range(self.m):
+                f(j)
+        else:
+            list(self.executor.map(f, range(self.m)))
 
-            if self.for_LSTDQ:
-                groups = np.logical_or.reduce((state_groups, action_groups, next_state_groups, next_action_groups))
-                groups = np.arange(groups.shape[0])[groups]
-                self.source_samples[j]['idx_s_q'] = sorted_idx
-                self.source_samples[j]['grps_q'] = groups
-                self.source_samples[j]['grp_szs_q'] = np.diff(np.append(groups, self.source_sizes[j]))
-                self.reduced_source_sizes_q[j] = groups.size
-
-                all_phi_Q_rsp = all_phi_Q.reshape(source_tasks[0].env.Q.shape + (self.n_features_q,))
-                self.source_samples[j]['var_phi_q'] = np.zeros((self.reduced_source_sizes_q[j], self.n_features_q, self.n_features_q),
-                                                               dtype=np.float64)
-                for k in range(self.n_features_q):
-                    self.source_samples[j]['var_phi_q'][:, k] = \
-                        np.add.reduceat(all_phi_Q_rsp[state_sorted, action_sorted][:, k][:, None] * \
-                                        (all_phi_Q_rsp[state_sorted, action_sorted] -
-                                         self.gamma * all_phi_Q_rsp[next_state_sorted, next_action_sorted]), groups, axis=0)
-                self.source_samples[j]['var_phi_q_sq'] = self.source_samples[j]['var_phi_q'] ** 2
-                '''self.B_mat_A_q = 0.
-                for k in range(self.n_features_q):
-                    curr_mat = self.source_samples[j]['var_phi_q'][:,k,:]
-                    self.B_mat_A_q += np.einsum('ij,ik->jk', curr_mat.T, curr_mat.T) + \
-                                      np.diag(((curr_mat**2)/self.source_samples[0]['grp_szs_q'][:,None]).sum(axis=1)) - \
-                                      np.einsum('ij,ik->jk', curr_mat.T, curr_mat.T)/self.source_sizes[0]'''
-                self.source_samples[j]['rho_q'] = \
-                    np.add.reduceat(all_phi_Q_rsp[state_sorted, action_sorted] * source_samples[j]['r'][sorted_idx, None], groups, axis=0)
-                '''self.B_mat_b_q = np.einsum('ij,ik->jk', self.source_samples[j]['rho_q'].T, self.source_samples[j]['rho_q'].T) + \
-                                 np.diag(((self.source_samples[j]['rho_q']**2)/self.source_samples[0]['grp_szs_q'][:,None]).sum(axis=1)) - \
-                                 np.einsum('ij,ik->jk', self.source_samples[j]['rho_q'].T, self.source_samples[j]['rho_q'].T)/self.source_sizes[0]'''
 
-            if self.for_LSTDV:
-                groups = np.logical_or.reduce((state_groups, action_groups, next_state_groups))
-                groups = np.arange(groups.shape[0])[groups]
-                self.source_samples[j]['idx_s_v'] = sorted_idx
-                self.source_samples[j]['grps_v'] = groups
-                self.source_samples[j]['grp_szs_v'] = np.diff(np.append(groups, self.source_sizes[j]))
-                self.reduced_source_sizes_v[j] = groups.size
-
-                self.source_samples[j]['var_phi_v'] = np.zeros((self.reduced_source_sizes_v[j], self.n_features_v, self.n_features_v),
-                                                               dtype=np.float64)
-                for k in range(self.n_features_v):
-                    self.source_samples[j]['var_phi_v'][:, k] = \
-                        np.add.reduceat(all_phi_V[state_sorted][:, k][:, None] * \
-                                        (all_phi_V[state_sorted] - self.gamma * all_phi_V[next_state_sorted]), groups, axis=0)
-                self.source_samples[j]['var_phi_v_sq'] = self.source_samples[j]['var_phi_v'] ** 2
-
-                '''self.B_mat_A_v = 0.
-                for k in range(self.n_features_v):
-                    curr_mat = self.source_samples[j]['var_phi_v'][:, k, :]
-                    self.B_mat_A_v += np.einsum('ij,ik->jk', curr_mat.T, curr_mat.T) + \
-                                      np.diag(((curr_mat ** 2) / self.source_samples[0]['grp_szs_v'][:, None]).sum(axis=1)) - \
-                                      np.einsum('ij,ik->jk', curr_mat.T, curr_mat.T) / self.source_sizes[0]'''
-
-                self.source_samples[j]['rho_v'] = \
-                    np.add.reduceat(all_phi_V[state_sorted] * source_samples[j]['r'][sorted_idx, None], groups, axis=0)
-                '''self.B_mat_b_v = np.einsum('ij,ik->jk', self.source_samples[j]['rho_v'].T, self.source_samples[j]['rho_v'].T) + \
-                                 np.diag(((self.source_samples[j]['rho_v'] ** 2) / self.source_samples[0]['grp_szs_v'][:, None]).sum(axis=1)) - \
-                                 np.einsum('ij,ik->jk', self.source_samples[j]['rho_v'].T, self.source_samples[j]['rho_v'].T) / self.source_sizes[0]'''
 
+    def append_source_samples(self, j, samples):
+        # Merges a batch of samples of source j into its groups of identical samples. Only the group keys, sizes and
+        # reward sums are kept, with the group of every sample for expand_weights, so the pool can grow online without
+        # sorting it again and without holding the samples. Weights of source j are returned in the order the batches
+        # were appended
+        shape = self.source_tasks[j].env.Q.shape
+        self.source_sizes[j] += samples['fsi'].shape[0]
+        if self.for_gradient:
+            self.merge_groups(j, np.ravel_multi_index((samples['fsi'], samples['ai']), shape), None, 'grad')
+            self.reduced_source_sizes_grad[j] = self.source_samples[j]['keys_grad'].size
+        if self.for_LSTDQ:
+            self.merge_groups(j, np.ravel_multi_index((samples['fsi'], samples['ai'], samples['nsi'], samples['nai']), shape + shape),
+                              samples['r'], 'q')
+            self.reduced_source_sizes_q[j] = self.source_samples[j]['keys_q'].size
+            s, a, s_prime, a_prime = np.unravel_index(self.source_samples[j]['keys_q'], shape + shape)
+            all_phi_Q_rsp = self.all_phi_Q.reshape(shape + (self.n_features_q,))
+            phi = all_phi_Q_rsp[s, a]
+            self.source_samples[j]['var_phi_q'] = self.source_samples[j]['grp_szs_q'][:, None, None] * phi[:, :, None] *\
+                                                  (phi - self.gamma * all_phi_Q_rsp[s_prime, a_prime])[:, None, :]
+            self.source_samples[j]['rho_q'] = phi * self.source_samples[j]['r_sums_q'][:, None]
+        if self.for_LSTDV:
+            self.merge_groups(j, np.ravel_multi_index((samples['fsi'], samples['ai'], samples['nsi']), shape + shape[:1]),
+                              samples['r'], 'v')
+            self.reduced_source_sizes_v[j] = self.source_samples[j]['keys_v'].size
+            s, a, s_prime = np.unravel_index(self.source_samples[j]['keys_v'], shape + shape[:1])
+            phi = self.all_phi_V[s]
+            self.source_samples[j]['var_phi_v'] = self.source_samples[j]['grp_szs_v'][:, None, None] * phi[:, :, None] *\
+                                                  (phi - self.gamma * self.all_phi_V[s_prime])[:, None, :]
+            self.source_samples[j]['rho_v'] = phi * self.source_samples[j]['r_sums_v'][:, None]
+
+        # Everything sized by the groups is rebuilt at the next call
+        self.target_power = None
+        self.quadratic_q = None
+        self.quadratic_v = None
+        self.last_solutions = {'grad': None, 'q': None, 'v': None}
+
+
+
+    def merge_groups(self, j, keys, r, suffix):
+        # keys are the int64 codes of the samples in the batch, their groups are kept sorted by key as the lexicographic
+        # sort of the samples would. The rewards r are summed over the groups unless None
+        groups = self.source_samples[j]
+        batch_keys, batch_inv, batch_sizes = np.unique(keys, return_inverse=True, return_counts=True)
+        if 'keys_' + suffix not in groups:
+            groups['keys_' + suffix] = batch_keys
+            groups['grp_szs_' + suffix] = batch_sizes
+            groups['grp_idx_' + suffix] = batch_inv
+            if r is not None:
+                groups['r_sums_' + suffix] = np.bincount(batch_inv, weights=r, minlength=batch_keys.size)
+            return
+
+        old_keys = groups['keys_' + suffix]
+        pos = np.searchsorted(old_keys, batch_keys)
+        new = old_keys[np.minimum(pos, old_keys.size - 1)] != batch_keys
+        new_pos = pos[new]
+        merged_keys = np.insert(old_keys, new_pos, batch_keys[new])
+        if new_pos.size > 0:
+            # Old groups shift by the number of new groups inserted before them
+            old_to_merged = np.arange(old_keys.size) + np.searchsorted(new_pos, np.arange(old_keys.size), side='right')
+            groups['grp_idx_' + suffix] = old_to_merged[groups['grp_idx_' + suffix]]
+        batch_to_merged = np.searchsorted(merged_keys, batch_keys)
+        groups['keys_' + suffix] = merged_keys
+        groups['grp_szs_' + suffix] = np.insert(groups['grp_szs_' + suffix], new_pos, 0)
+        groups['grp_szs_' + suffix][batch_to_merged] += batch_sizes
+        if r is not None:
+            groups['r_sums_' + suffix] = np.insert(groups['r_sums_' + suffix], new_pos, 0.)
+            groups['r_sums_' + suffix][batch_to_merged] += np.bincount(batch_inv, weights=r, minlength=batch_keys.size)
+        groups['grp_idx_' + suffix] = np.concatenate((groups['grp_idx_' + suffix], batch_to_merged[batch_inv]))
+
+
+
+    def prepare_target_power(self, target_power):
+        # Terms of prepare_lstd and prepare_gradient that do not depend on the target policy. The target power is fixed
+        # during a learn call, so they are computed at its first policy update and reused by all the following ones
+        if self.target_power == target_power:
+            return
+        self.target_power = target_power
+        self.L_P_eps_delta = [None] * self.m
+        if self.for_gradient:
+            self.sample_idx_grad = [None] * self.m
+            self.source_zeta_grad = [None] * self.m
+        if self.for_LSTDQ or self.for_LSTDV:
+            self.zeta_L_P_eps = [None] * self.m
+        if self.for_LSTDQ:
+            self.zeta_P = [None] * self.m
+            self.sample_idx_q = [None] * self.m
+            self.source_d_distr_q = [None] * self.m
+        if self.for_LSTDV:
+            self.sample_idx_v = [None] * self.m
+            self.source_d_distr_v = [None] * self.m
         if self.for_gradient:
             self.l_bounds_grad = np.zeros(self.reduced_source_sizes_grad.sum(), dtype=np.float64)
             self.u_bounds_grad = np.zeros(self.reduced_source_sizes_grad.sum(), dtype=np.float64)
@@ -497,438 +245,168 @@ class MinWeightsEstimator():
             self.l_bounds_lstdv = np.zeros(self.reduced_source_sizes_v.sum(), dtype=np.float64)
             self.u_bounds_lstdv = np.zeros(self.reduced_source_sizes_v.sum(), dtype=np.float64)
 
+        def prepare_source(i):
+            env = self.source_tasks[i].env
+            groups = self.source_samples[i]
+            self.L_P_eps_delta[i] = self.L_P_eps_s_a_s_prime[i] * float(np.abs(env.power - target_power))
+            if self.for_gradient:
+                self.sample_idx_grad[i] = np.unravel_index(groups['keys_grad'], env.Q.shape)
+                self.source_zeta_grad[i] = env.zeta_distr[self.sample_idx_grad[i]]
+            if self.for_LSTDQ or self.for_LSTDV:
+                # Operands of the (S, A, S) broadcasts in the estimator precision
+                P = env.transition_tensor().astype(self.dtype, copy=False)
+                zeta_distr = env.zeta_distr.astype(self.dtype)
+                self.M_P_eps_s_a_s_prime[i] = np.clip(P + self.L_P_eps_delta[i], 0., 1.)
+                self.zeta_L_P_eps[i] = zeta_distr[:, :, None] * np.clip(self.L_P_eps_delta[i], 0., 1.)
+            if self.for_LSTDQ:
+                self.zeta_P[i] = zeta_distr[:, :, None] * P
+                self.sample_idx_q[i] = np.unravel_index(groups['keys_q'], env.Q.shape + env.Q.shape)
+                s, a, s_prime, a_prime = self.sample_idx_q[i]
+                self.source_d_distr_q[i] = env.zeta_distr[s, a] * env.transition_probs(s, a, s_prime) * \
+                                           self.source_policies[i].choice_matrix[s_prime, a_prime]
+            if self.for_LSTDV:
+                self.sample_idx_v[i] = np.unravel_index(groups['keys_v'], env.Q.shape + env.Q.shape[:1])
+                s, a, s_prime = self.sample_idx_v[i]
+                self.source_d_distr_v[i] = env.zeta_distr[s, a] * env.transition_probs(s, a, s_prime)
+
+        self.for_each_source(prepare_source)
+
+
+
+    def prepare_delta_zeta(self, target_policy, i):
+        delta_pi = np.abs(self.source_policies[i].choice_matrix - target_policy.choice_matrix)
+        self.delta_P_eps_theta_s_s_prime[i] = \
+            self.source_tasks[i].env.policy_transition_matrix(delta_pi, dense=True) + \
+            np.einsum('sa,san->sn', target_policy.choice_matrix, self.L_P_eps_delta[i])
+        self.delta_P_eps_theta_s[i] = self.delta_P_eps_theta_s_s_prime[i].max(axis=0)
+        self.delta_delta[i] = \
+            (1. - self.gamma) * self.source_tasks[i].env.solve_evaluation(0. + self.gamma * np.clip(self.delta_P_eps_theta_s[i], 0., 1.), transpose=True)
+        self.delta_zeta[i] = \
+            self.source_tasks[i].env.delta_distr[:, None] * delta_pi + target_policy.choice_matrix * np.clip(self.delta_delta[i], 0., 1.)[:, None]
+        return delta_pi
+
 
 
     def prepare_lstd(self, target_policy, target_power):
-        w_idx = np.hstack((0., self.source_sizes)).cumsum().astype(np.int64)
-        for i in range(self.m):
-            self.delta_P_eps_theta_s_s_prime[i] = \
-                (self.source_tasks[i].env.transition_matrix * np.abs(self.source_policies[i].choice_matrix - target_policy.choice_matrix)[:, :, None] +
-                 target_policy.choice_matrix[:, :, None] *
-                 self.L_P_eps_s_a_s_prime[i] * np.abs(self.source_tasks[i].env.power - target_power)).sum(axis=1)
-            self.delta_P_eps_theta_s[i] = self.delta_P_eps_theta_s_s_prime[i].max(axis=0)
-            self.delta_delta[i] = \
-                (1. - self.gamma) * self.source_tasks[i].env.P_pi_inv.T.dot(0. + self.gamma * np.clip(self.delta_P_eps_theta_s[i], 0., 1.))
-            self.delta_zeta[i] = \
-                self.source_tasks[i].env.delta_distr[:, None] * np.abs(self.source_policies[i].choice_matrix - target_policy.choice_matrix) + \
-                target_policy.choice_matrix * np.clip(self.delta_delta[i], 0., 1.)[:, None]
-            if self.for_LSTDV or self.for_LSTDQ:
-                self.M_P_eps_s_a_s_prime[i] = np.clip(self.source_tasks[i].env.transition_matrix +
-                                                      self.L_P_eps_s_a_s_prime[i] * np.abs(self.source_tasks[i].env.power - target_power), 0., 1.)
+        self.prepare_target_power(target_power)
+
+        def prepare_source(i):
+            delta_pi = self.prepare_delta_zeta(target_policy, i)
+            if self.for_LSTDQ or self.for_LSTDV:
+                # delta_d_v, which is also the factor of delta_d_q multiplying target_pi
+                delta_d_v = self.zeta_L_P_eps[i] + self.M_P_eps_s_a_s_prime[i] * np.clip(self.delta_zeta[i], 0., 1.).astype(self.dtype)[:, :, None]
             if self.for_LSTDQ:
                 reduced_w_idx = np.hstack((0., self.reduced_source_sizes_q)).cumsum().astype(np.int64)
-                self.delta_d_q[i] = self.source_tasks[i].env.zeta_distr[:, :, None, None] * \
-                                   self.source_tasks[i].env.transition_matrix[:, :, :, None] * \
-                                   np.abs(target_policy.choice_matrix - self.source_policies[i].choice_matrix)[None, None, :, :] + \
-                                   target_policy.choice_matrix[None, None, :, :] * self.source_tasks[i].env.zeta_distr[:, :, None, None] * \
-                                   np.clip(self.L_P_eps_s_a_s_prime[i] * np.abs(self.source_tasks[i].env.power - target_power), 0., 1.)[:, :, :, None] + \
-                                   target_policy.choice_matrix[None, None, :, :] * self.M_P_eps_s_a_s_prime[i][:, :, :, None] * \
-                                   np.clip(self.delta_zeta[i], 0., 1.)[:, :, None, None]
-                self.delta_d_q[i] = self.source_tasks[i].env.zeta_distr[:, :, None, None] * \
-                                    self.source_tasks[i].env.transition_matrix[:, :, :, None] * \
-                                    np.abs(target_policy.choice_matrix - self.source_policies[i].choice_matrix)[None, None, :, :]
-                self.delta_d_q[i] += target_policy.choice_matrix[None, None, :, :] * self.source_tasks[i].env.zeta_distr[:, :, None, None] * \
-                                     np.clip(self.L_P_eps_s_a_s_prime[i] * np.abs(self.source_tasks[i].env.power - target_power), 0., 1.)[:, :, :, None]
-                self.delta_d_q[i] += target_policy.choice_matrix[None, None, :, :] * self.M_P_eps_s_a_s_prime[i][:, :, :, None] * \
-                                     np.clip(self.delta_zeta[i], 0., 1.)[:, :, None, None]
-                source_d_distr = (self.source_tasks[i].env.zeta_distr[self.source_samples[i]['fsi'], self.source_samples[i]['ai']] *
-                                  self.source_tasks[i].env.transition_matrix[self.source_samples[i]['fsi'], self.source_samples[i]['ai'],
-                                                                             self.source_samples[i]['nsi']] *
-                                  self.source_policies[i].choice_matrix[self.source_samples[i]['nsi'], self.source_samples[i]['nai']])[self.source_samples[i]['idx_s_q']][self.source_samples[i]['grps_q']]
+                delta_d_q = delta_d_q_entries(self.zeta_P[i], delta_d_v, delta_pi, target_policy.choice_matrix, *self.sample_idx_q[i])
                 self.l_bounds_lstdq[reduced_w_idx[i]:reduced_w_idx[i + 1]] = np.clip(np.ones(self.reduced_source_sizes_q[i], dtype=np.float64) -
-                                                                                     np.clip(self.delta_d_q[i], 0., 1.)[self.source_samples[i]['fsi'],
-                                                                                                                        self.source_samples[i]['ai'],
-                                                                                                                        self.source_samples[i]['nsi'],
-                                                                                                                        self.source_samples[i]['nai']][self.source_samples[i]['idx_s_q']][self.source_samples[i]['grps_q']] /
-                                                                                     source_d_distr, 0., 1.)
+                                                                                     delta_d_q / self.source_d_distr_q[i], 0., 1.)
                 self.u_bounds_lstdq[reduced_w_idx[i]:reduced_w_idx[i + 1]] = np.ones(self.reduced_source_sizes_q[i], dtype=np.float64) + \
-                                                                             np.clip(self.delta_d_q[i], 0., 1.)[self.source_samples[i]['fsi'],
-                                                                                                                self.source_samples[i]['ai'],
-                                                                                                                self.source_samples[i]['nsi'],
-                                                                                                                self.source_samples[i]['nai']][self.source_samples[i]['idx_s_q']][self.source_samples[i]['grps_q']] / \
-                                                                             source_d_distr
+                                                                             delta_d_q / self.source_d_distr_q[i]
 
             if self.for_LSTDV:
                 reduced_w_idx = np.hstack((0., self.reduced_source_sizes_v)).cumsum().astype(np.int64)
-                self.delta_d_v[i] = self.source_tasks[i].env.zeta_distr[:, :, None] * \
-                                    np.clip(self.L_P_eps_s_a_s_prime[i] * np.abs(self.source_tasks[i].env.power - target_power), 0., 1.) + \
-                                    self.M_P_eps_s_a_s_prime[i] * np.clip(self.delta_zeta[i], 0., 1.)[:, :, None]
-                self.delta_d_v[i] = self.source_tasks[i].env.zeta_distr[:, :, None] * \
-                                    np.clip(self.L_P_eps_s_a_s_prime[i] * np.abs(self.source_tasks[i].env.power - target_power), 0., 1.)
-                self.delta_d_v[i] += self.M_P_eps_s_a_s_prime[i] * np.clip(self.delta_zeta[i], 0., 1.)[:, :, None]
-                source_d_distr = (self.source_tasks[i].env.zeta_distr[self.source_samples[i]['fsi'], self.source_samples[i]['ai']] *
-                                  self.source_tasks[i].env.transition_matrix[self.source_samples[i]['fsi'], self.source_samples[i]['ai'],
-                                                                             self.source_samples[i]['nsi']][self.source_samples[i]['idx_s_v']])[self.source_samples[i]['grps_v']]
+                delta_d_v = np.clip(delta_d_v[self.sample_idx_v[i]], 0., 1.)
                 self.l_bounds_lstdv[reduced_w_idx[i]:reduced_w_idx[i + 1]] = np.clip(np.ones(self.reduced_source_sizes_v[i], dtype=np.float64) -
-                                                                                     np.clip(self.delta_d_v[i], 0., 1.)[self.source_samples[i]['fsi'],
-                                                                                                                        self.source_samples[i]['ai'],
-                                                                                                                        self.source_samples[i]['nsi']][self.source_samples[i]['idx_s_v']][self.source_samples[i]['grps_v']] /
-                                                                                     source_d_distr, 0., 1.)
+                                                                                     delta_d_v / self.source_d_distr_v[i], 0., 1.)
                 self.u_bounds_lstdv[reduced_w_idx[i]:reduced_w_idx[i + 1]] = np.ones(self.reduced_source_sizes_v[i], dtype=np.float64) + \
-                                                                             np.clip(self.delta_d_v[i], 0., 1.)[self.source_samples[i]['fsi'],
-                                                                                                                self.source_samples[i]['ai'],
-                                                                                                                self.source_samples[i]['nsi']][self.source_samples[i]['idx_s_v']][self.source_samples[i]['grps_v']] / \
-                                                                             source_d_distr
+                                                                             delta_d_v / self.source_d_distr_v[i]
+
+        self.for_each_source(prepare_source)
 
 
 
     def prepare_gradient(self, target_policy, target_power, target_Q, target_V):
+        self.prepare_target_power(target_power)
         w_idx = np.hstack((0., self.source_sizes)).cumsum().astype(np.int64)
         reduced_w_idx = np.hstack((0., self.reduced_source_sizes_grad)).cumsum().astype(np.int64)
-        for i in range(self.m):
+
+        def prepare_source(i):
             if not self.for_LSTDQ and not self.for_LSTDV:
-                self.delta_P_eps_theta_s_s_prime[i] = \
-                    (self.source_tasks[i].env.transition_matrix * np.abs(self.source_policies[i].choice_matrix - target_policy.choice_matrix)[:, :, None] +
-                     target_policy.choice_matrix.reshape(target_policy.choice_matrix.shape + (1,)) *
-                     self.L_P_eps_s_a_s_prime[i] * np.abs(self.source_tasks[i].env.power - target_power)).sum(axis=1)
-                self.delta_P_eps_theta_s[i] = self.delta_P_eps_theta_s_s_prime[i].max(axis=0)
-                self.delta_delta[i] = \
-                    (1. - self.gamma) * self.source_tasks[i].env.P_pi_inv.T.dot(0. + self.gamma * np.minimum(self.delta_P_eps_theta_s[i],
-                                                                                                             np.ones_like(self.delta_P_eps_theta_s[i])))
-                self.delta_zeta[i] = \
-                    self.source_tasks[i].env.delta_distr[:, None] * np.abs(self.source_policies[i].choice_matrix - target_policy.choice_matrix) + \
-                    target_policy.choice_matrix * np.minimum(self.delta_delta[i], np.ones_like(self.delta_delta[i]))[:, None]
-
-            self.source_samples[i]['eta_1'] = \
-                np.add.reduceat((target_policy.log_gradient_matrix[self.source_samples[i]['fsi'], self.source_samples[i]['ai']] *
-                                 (target_Q[w_idx[i]:w_idx[i + 1]] - target_V[w_idx[i]:w_idx[i + 1]])[:, None])[self.source_samples[i]['idx_s_grad']],
-                                self.source_samples[i]['grps_grad'], axis=0)
+                self.prepare_delta_zeta(target_policy, i)
 
+            # log_gradient_matrix is the same on a whole group, so it multiplies the sums of Q - V over the groups
+            groups = self.source_samples[i]
+            groups['eta_1'] = \
+                target_policy.log_gradient_matrix[self.sample_idx_grad[i]] * \
+                np.bincount(groups['grp_idx_grad'], weights=target_Q[w_idx[i]:w_idx[i + 1]] - target_V[w_idx[i]:w_idx[i + 1]],
+                            minlength=self.reduced_source_sizes_grad[i])[:, None]
+
+            delta_zeta = np.clip(self.delta_zeta[i][self.sample_idx_grad[i]], 0., 1.)
             self.l_bounds_grad[reduced_w_idx[i]:reduced_w_idx[i + 1]] = np.clip(np.ones(self.reduced_source_sizes_grad[i], dtype=np.float64) -
-                                                                                np.clip(self.delta_zeta[i], 0., 1.)[self.source_samples[i]['fsi'],
-                                                                                                                    self.source_samples[i]['ai']][self.source_samples[i]['idx_s_grad']][self.source_samples[i]['grps_grad']] /
-                                                                                self.source_tasks[i].env.zeta_distr[self.source_samples[i]['fsi'],
-                                                                                                                    self.source_samples[i]['ai']][self.source_samples[i]['idx_s_grad']][self.source_samples[i]['grps_grad']],
-                                                                                0., 1.)
+                                                                                delta_zeta / self.source_zeta_grad[i], 0., 1.)
             self.u_bounds_grad[reduced_w_idx[i]:reduced_w_idx[i + 1]] = np.ones(self.reduced_source_sizes_grad[i], dtype=np.float64) + \
-                                                                        np.clip(self.delta_zeta[i], 0., 1.)[self.source_samples[i]['fsi'],
-                                                                                                            self.source_samples[i]['ai']][self.source_samples[i]['idx_s_grad']][self.source_samples[i]['grps_grad']] / \
-                                                                        self.source_tasks[i].env.zeta_distr[self.source_samples[i]['fsi'],
-                                                                                                            self.source_samples[i]['ai']][self.source_samples[i]['idx_s_grad']][self.source_samples[i]['grps_grad']]
+                                                                        delta_zeta / self.source_zeta_grad[i]
+
+        self.for_each_source(prepare_source)
 
 
 
 
     def estimate_weights_gradient(self, target_size, target_grad):
-        reduced_w_idx = np.hstack((0., self.reduced_source_sizes_grad)).cumsum().astype(np.int64)
         n = self.source_sizes.sum() + target_size
-        w0 = np.ones(self.reduced_source_sizes_grad.sum(), dtype=np.float64)
-        bias = 0.
-
-        def g(w):
-            nonlocal bias
-            bias = 0.
-            vari = 0.
-            for j in range(self.m):
-                bias += self.source_sizes[j] * (target_grad -
-                                                (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:,None] * self.source_samples[j]['eta_1']).sum(axis=0) /
-                                                (self.source_sizes[j] * (1. - self.gamma))) / n
-                vari += ((((w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None] * self.source_samples[j]['eta_1']) ** 2) / self.source_samples[j]['grp_szs_grad'][:,None]).sum(axis=0) -
-                         ((w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None] * self.source_samples[j]['eta_1']).sum(axis=0)) ** 2 / self.source_sizes[j]) / (n * (1. - self.gamma)) ** 2
-            #ax = (-2.*self.source_sizes.sum()/((1-self.gamma)*n**2))*target_grad.dot(self.source_samples[0]['eta_1'].T).dot(w) +\
-            #     w.dot((1/(n*(1-self.gamma))**2)*(np.einsum('ij,ik->jk', self.source_samples[0]['eta_1'].T, self.source_samples[0]['eta_1'].T) +
-            #                                      np.diag(((self.source_samples[0]['eta_1']**2)/self.source_samples[0]['grp_szs_grad'][:,None]).sum(axis=1)) -
-            #                                      np.einsum('ij,ik->jk', self.source_samples[0]['eta_1'].T, self.source_samples[0]['eta_1'].T)/self.source_sizes[0])).dot(w) +\
-            #     ((self.source_sizes.sum()/n)**2)*(target_grad**2).sum()
-            bias_sq = (bias ** 2).sum()
-            vari = vari.sum()
-            return bias_sq + vari
-
-        def grad_g(w):
-            bias_n = bias*n
-            grad = np.zeros(w.shape + (2,), dtype=np.float64)
-            for j in range(self.m):
-                grad[reduced_w_idx[j]:reduced_w_idx[j + 1]] = \
-                    2 * self.source_samples[j]['eta_1'] * (-bias_n / (1. - self.gamma))/n**2
-                grad[reduced_w_idx[j]:reduced_w_idx[j + 1]] +=\
-                    2 * self.source_samples[j]['eta_1'] *(self.source_samples[j]['eta_1'] * w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:,None] / (self.source_samples[j]['grp_szs_grad'][:,None]*(1. - self.gamma) ** 2) -
-                                                          (self.source_samples[j]['eta_1'] * w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:,None]).sum(axis=0) / (self.source_sizes[j] * (1. - self.gamma) ** 2))\
-                    / n ** 2
-                #ax = (-2.*self.source_sizes.sum()/((1-self.gamma)*n**2))*target_grad.dot(self.source_samples[0]['eta_1'].T) +\
-                #     ((2/(n*(1-self.gamma))**2)*(np.einsum('ij,ik->jk', self.source_samples[0]['eta_1'].T, self.source_samples[0]['eta_1'].T) +
-                #                                 np.diag((self.source_samples[0]['eta_1']**2/self.source_samples[0]['grp_szs_grad'][:,None]).sum(axis=1)) -
-                #                                 np.einsum('ij,ik->jk', self.source_samples[0]['eta_1'].T, self.source_samples[0]['eta_1'].T)/self.source_sizes[0])).dot(w)
-
-            grad = grad.sum(axis=1)
-            return grad
-
-        bounds = np.ones((self.l_bounds_grad.size + self.u_bounds_grad.size,), dtype=np.float64)
-        bounds[0::2] = self.l_bounds_grad
-        bounds[1::2] = self.u_bounds_grad
-        bounds = tuple(map(tuple, bounds.reshape((-1, 2))))
-        res = minimize(g, w0, jac=grad_g, bounds=bounds)
-
-        all_w = np.zeros(self.source_sizes.sum(), dtype=np.float64)
-        w_idx = np.hstack((0., self.source_sizes)).cumsum().astype(np.int64)
-        for j in range(self.m):
-            aux = np.repeat(res.x, self.source_samples[j]['grp_szs_grad'].astype(np.int32))
-            inv = np.empty(self.source_samples[j]['idx_s_grad'].shape[0], dtype=np.int64)
-            inv[self.source_samples[j]['idx_s_grad']] = np.arange(self.source_samples[j]['idx_s_grad'].shape[0])
-            all_w[w_idx[j]:w_idx[j + 1]] = aux[inv]
-
-        return all_w
+        # eta_1 depends on the target policy, so the quadratic is rebuilt at every call
+        quadratic = GroupedQuadratic(np.vstack([self.source_samples[j]['eta_1'] / (1. - self.gamma) for j in range(self.m)]),
+                                     np.concatenate([self.source_samples[j]['grp_szs_grad'] for j in range(self.m)]),
+                                     self.reduced_source_sizes_grad, self.source_sizes)
+        quadratic.set_target(target_grad, n)
+        return self.solve_weights(quadratic, self.l_bounds_grad, self.u_bounds_grad, self.reduced_source_sizes_grad, 'grad')
 
 
 
     def estimate_weights_lstdq(self, target_size, target_A, target_b):
-        reduced_w_idx = np.hstack((0., self.reduced_source_sizes_q)).cumsum().astype(np.int64)
         n = self.source_sizes.sum() + target_size
-        w0 = np.ones(self.reduced_source_sizes_q.sum(), dtype=np.float64)
-        bias_A = 0.
-        bias_b = 0.
-
-        def g(w):
-            nonlocal bias_A, bias_b
-            bias_A = np.zeros((self.n_features_q, self.n_features_q), dtype=np.float64)
-            bias_b = np.zeros(self.n_features_q, dtype=np.float64)
-            vari_A = np.zeros((self.n_features_q, self.n_features_q), dtype=np.float64)
-            vari_b = np.zeros(self.n_features_q, dtype=np.float64)
-            for j in range(self.m):
-                bias_A += self.source_sizes[j]*(target_A -
-                                                (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None, None]*self.source_samples[j]['var_phi_q']).sum(axis=0)/
-                                                self.source_sizes[j])\
-                          / n
-                vari_A += (((w[reduced_w_idx[j]:reduced_w_idx[j + 1]] ** 2 / self.source_samples[j]['grp_szs_q'])[:, None, None] * self.source_samples[j]['var_phi_q_sq']).sum(axis=0) -
-                           (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None, None] * self.source_samples[j]['var_phi_q']).sum(axis=0) ** 2 / self.source_sizes[j]) \
-                          / n ** 2
-                bias_b += self.source_sizes[j]*(target_b -
-                                                (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None]*self.source_samples[j]['rho_q']).sum(axis=0)/
-                                                self.source_sizes[j])\
-                          / n
-                vari_b += (((w[reduced_w_idx[j]:reduced_w_idx[j + 1]] ** 2 / self.source_samples[j]['grp_szs_q'])[:, None] * self.source_samples[j]['rho_q'] ** 2).sum(axis=0) -
-                           (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None] * self.source_samples[j]['rho_q']).sum(axis=0) ** 2 / self.source_sizes[j]) \
-                          / n ** 2
-            bias_A_sq = (bias_A ** 2).sum()
-            vari_A = vari_A.sum()
-            bias_b_sq = (bias_b ** 2).sum()
-            vari_b = vari_b.sum()
-            '''ax = (-2.*self.source_sizes.sum()/n**2)*(target_A[None,:,:]*self.source_samples[0]['var_phi_q']).sum(axis=(1,2)).dot(w) +\
-                 w.dot((1/n**2)*self.B_mat_A_q).dot(w) + ((self.source_sizes.sum()/n)**2)*(target_A**2).sum() + \
-                 (-2. * self.source_sizes.sum() / n ** 2) * (target_b.dot(self.source_samples[0]['rho_q'].T)).dot(w) + \
-                 w.dot((1 / n ** 2) * self.B_mat_b_q).dot(w) + ((self.source_sizes.sum() / n) ** 2) * (target_b ** 2).sum()
-            return ax'''
-            return bias_A_sq + bias_b_sq + vari_A + vari_b
-
-        def grad_g(w):
-            grad_A = np.zeros(w.shape + (self.n_features_q, self.n_features_q), dtype=np.float64)
-            grad_b = np.zeros(w.shape + (self.n_features_q,), dtype=np.float64)
-            bias_A_n = bias_A*n
-            bias_b_n = bias_b*n
-            for j in range(self.m):
-                grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] = (2 * self.source_samples[j]['var_phi_q']/n**2) * -bias_A_n
-                grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] += (2 * self.source_samples[j]['var_phi_q'] / n ** 2) * \
-                                                                 (self.source_samples[j]['var_phi_q'] * (w[reduced_w_idx[j]:reduced_w_idx[j + 1]] / self.source_samples[j]['grp_szs_q'])[:, None, None] -
-                                                                 (self.source_samples[j]['var_phi_q'] * w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None, None]).sum(axis=0) / self.source_sizes[j])
-                #grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] = (2 * self.source_samples[j]['var_phi_q']/n**2) * -bias_A_n
-                #grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] += (2 * self.source_samples[j]['var_phi_q']/n**2)*self.source_samples[j]['var_phi_q'] * (w[reduced_w_idx[j]:reduced_w_idx[j + 1]]/self.source_samples[j]['grp_szs_q'])[:,None,None]
-                #grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] -= (2 * self.source_samples[j]['var_phi_q']/n**2)*(self.source_samples[j]['var_phi_q'] * w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:,None,None]).sum(axis=0) / self.source_sizes[j]
-                grad_b[reduced_w_idx[j]:reduced_w_idx[j + 1]] = (2 * self.source_samples[j]['rho_q']/n**2) * - bias_b_n
-                grad_b[reduced_w_idx[j]:reduced_w_idx[j + 1]] += (2 * self.source_samples[j]['rho_q'] / n ** 2) *\
-                                                                 (self.source_samples[j]['rho_q'] * (w[reduced_w_idx[j]:reduced_w_idx[j + 1]] / self.source_samples[j]['grp_szs_q'])[:, None] -
-                                                                 (self.source_samples[j]['rho_q'] * w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None]).sum(axis=0) / self.source_sizes[j])
-            grad = grad_A.sum(axis=(1, 2)) + grad_b.sum(axis=1)
-            '''ax = (-2.*self.source_sizes.sum()/n**2)*(target_A[None,:,:]*self.source_samples[0]['var_phi_q']).sum(axis=(1,2)) + \
-                 ((2 / n ** 2) * self.B_mat_A_q).dot(w) + \
-                 (-2. * self.source_sizes.sum() / n ** 2) * (target_b.dot(self.source_samples[0]['rho_q'].T)) + \
-                 ((2 / n ** 2) * self.B_mat_b_q).dot(w)
-            return ax'''
-            return grad
-
-        bounds = np.ones((self.l_bounds_lstdq.size + self.u_bounds_lstdq.size,), dtype=np.float64)
-        bounds[0::2] = self.l_bounds_lstdq
-        bounds[1::2] = self.u_bounds_lstdq
-        bounds = tuple(map(tuple, bounds.reshape((-1, 2))))
-        res = minimize(g, w0, jac=grad_g, bounds=bounds)
-        all_w = np.zeros(self.source_sizes.sum(), dtype=np.float64)
-        w_idx = np.hstack((0., self.source_sizes)).cumsum().astype(np.int64)
-        for j in range(self.m):
-            aux = np.repeat(res.x, self.source_samples[j]['grp_szs_q'].astype(np.int32))
-            inv = np.empty(self.source_samples[j]['idx_s_q'].shape[0], dtype=np.int64)
-            inv[self.source_samples[j]['idx_s_q']] = np.arange(self.source_samples[j]['idx_s_q'].shape[0])
-            all_w[w_idx[j]:w_idx[j + 1]] = aux[inv]
-
-        return all_w
+        if self.quadratic_q is None:
+            self.quadratic_q = GroupedQuadratic(np.vstack([np.hstack((self.source_samples[j]['var_phi_q'].reshape((self.reduced_source_sizes_q[j], -1)),
+                                                                      self.source_samples[j]['rho_q'])) for j in range(self.m)]),
+                                                np.concatenate([self.source_samples[j]['grp_szs_q'] for j in range(self.m)]),
+                                                self.reduced_source_sizes_q, self.source_sizes)
+        self.quadratic_q.set_target(np.append(target_A.flatten(), target_b), n)
+        return self.solve_weights(self.quadratic_q, self.l_bounds_lstdq, self.u_bounds_lstdq, self.reduced_source_sizes_q, 'q')
 
 
 
     def estimate_weights_lstdv(self, target_size, target_A, target_b):
-        reduced_w_idx = np.hstack((0., self.reduced_source_sizes_v)).cumsum().astype(np.int64)
         n = self.source_sizes.sum() + target_size
-        w0 = np.ones(self.reduced_source_sizes_v.sum(), dtype=np.float64)
-        bias_A = 0.
-        bias_b = 0.
-
-        def g(w):
-            nonlocal bias_A, bias_b
-            bias_A = np.zeros((self.n_features_v, self.n_features_v), dtype=np.float64)
-            bias_b = np.zeros(self.n_features_v, dtype=np.float64)
-            vari_A = np.zeros((self.n_features_v, self.n_features_v), dtype=np.float64)
-            vari_b = np.zeros(self.n_features_v, dtype=np.float64)
-            for j in range(self.m):
-                bias_A += self.source_sizes[j] * (target_A -
-                                                  (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None, None] * self.source_samples[j]['var_phi_v']).sum(axis=0) /
-                                                  self.source_sizes[j]) \
-                          / n
-                vari_A += (((w[reduced_w_idx[j]:reduced_w_idx[j + 1]] ** 2 / self.source_samples[j]['grp_szs_v'])[:, None, None] * self.source_samples[j]['var_phi_v_sq']).sum(axis=0) -
-                           (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None, None] * self.source_samples[j]['var_phi_v']).sum(axis=0) ** 2 / self.source_sizes[j]) \
-                          / n ** 2
-                bias_b += self.source_sizes[j] * (target_b -
-                                                  (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None] * self.source_samples[j]['rho_v']).sum(axis=0) /
-                                                  self.source_sizes[j]) \
-                          / n
-                vari_b += (((w[reduced_w_idx[j]:reduced_w_idx[j + 1]] ** 2 / self.source_samples[j]['grp_szs_v'])[:, None] * self.source_samples[j]['rho_v'] ** 2).sum(axis=0) -
-                           (w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None] * self.source_samples[j]['rho_v']).sum(axis=0) ** 2 / self.source_sizes[j]) \
-                          / n ** 2
-            bias_A_sv = (bias_A ** 2).sum()
-            vari_A = vari_A.sum()
-            bias_b_sv = (bias_b ** 2).sum()
-            vari_b = vari_b.sum()
-            '''ax = (-2. * self.source_sizes.sum() / n ** 2) * (target_A[None, :, :] * self.source_samples[0]['var_phi_v']).sum(axis=(1, 2)).dot(w) + \
-                 w.dot((1 / n ** 2) * self.B_mat_A_v).dot(w) + ((self.source_sizes.sum() / n) ** 2) * (target_A ** 2).sum() + \
-                 (-2. * self.source_sizes.sum() / n ** 2) * (target_b.dot(self.source_samples[0]['rho_v'].T)).dot(w) + \
-                 w.dot((1 / n ** 2) * self.B_mat_b_v).dot(w) + ((self.source_sizes.sum() / n) ** 2) * (target_b ** 2).sum()
-            return ax'''
-            return bias_A_sv + bias_b_sv + vari_A + vari_b
-
-        def grad_g(w):
-            grad_A = np.zeros(w.shape + (self.n_features_v, self.n_features_v), dtype=np.float64)
-            grad_b = np.zeros(w.shape + (self.n_features_v,), dtype=np.float64)
-            bias_A_n = bias_A * n
-            bias_b_n = bias_b * n
-            for j in range(self.m):
-                grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] = (2 * self.source_samples[j]['var_phi_v'] / n ** 2) * -bias_A_n
-                grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] += (2 * self.source_samples[j]['var_phi_v'] / n ** 2) * \
-                                                                 (self.source_samples[j]['var_phi_v'] * (w[reduced_w_idx[j]:reduced_w_idx[j + 1]] / self.source_samples[j]['grp_szs_v'])[:, None, None] -
-                                                                  (self.source_samples[j]['var_phi_v'] * w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None, None]).sum(axis=0) / self.source_sizes[j])
-                # grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] = (2 * self.source_samples[j]['var_phi_v']/n**2) * -bias_A_n
-                # grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] += (2 * self.source_samples[j]['var_phi_v']/n**2)*self.source_samples[j]['var_phi_v'] * (w[reduced_w_idx[j]:reduced_w_idx[j + 1]]/self.source_samples[j]['grp_szs_v'])[:,None,None]
-                # grad_A[reduced_w_idx[j]:reduced_w_idx[j + 1]] -= (2 * self.source_samples[j]['var_phi_v']/n**2)*(self.source_samples[j]['var_phi_v'] * w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:,None,None]).sum(axis=0) / self.source_sizes[j]
-                grad_b[reduced_w_idx[j]:reduced_w_idx[j + 1]] = (2 * self.source_samples[j]['rho_v'] / n ** 2) * - bias_b_n
-                grad_b[reduced_w_idx[j]:reduced_w_idx[j + 1]] += (2 * self.source_samples[j]['rho_v'] / n ** 2) * \
-                                                                 (self.source_samples[j]['rho_v'] * (w[reduced_w_idx[j]:reduced_w_idx[j + 1]] / self.source_samples[j]['grp_szs_v'])[:, None] -
-                                                                  (self.source_samples[j]['rho_v'] * w[reduced_w_idx[j]:reduced_w_idx[j + 1]][:, None]).sum(axis=0) / self.source_sizes[j])
-            grad = grad_A.sum(axis=(1, 2)) + grad_b.sum(axis=1)
-            '''ax = (-2. * self.source_sizes.sum() / n ** 2) * (target_A[None, :, :] * self.source_samples[0]['var_phi_v']).sum(axis=(1, 2)) + \
-                 ((2 / n ** 2) * self.B_mat_A_v).dot(w) + \
-                 (-2. * self.source_sizes.sum() / n ** 2) * (target_b.dot(self.source_samples[0]['rho_v'].T)) + \
-                 ((2 / n ** 2) * self.B_mat_b_v).dot(w)
-            return ax'''
-            return grad
-
-        bounds = np.ones((self.l_bounds_lstdv.size + self.u_bounds_lstdv.size,), dtype=np.float64)
-        bounds[0::2] = self.l_bounds_lstdv
-        bounds[1::2] = self.u_bounds_lstdv
-        bounds = tuple(map(tuple, bounds.reshape((-1, 2))))
-        res = minimize(g, w0, jac=grad_g, bounds=bounds)
-        all_w = np.zeros(self.source_sizes.sum(), dtype=np.float64)
-        w_idx = np.hstack((0., self.source_sizes)).cumsum().astype(np.int64)
-        for j in range(self.m):
-            aux = np.repeat(res.x, self.source_samples[j]['grp_szs_v'].astype(np.int32))
-            inv = np.empty(self.source_samples[j]['idx_s_v'].shape[0], dtype=np.int64)
-            inv[self.source_samples[j]['idx_s_v']] = np.arange(self.source_samples[j]['idx_s_v'].shape[0])
-            all_w[w_idx[j]:w_idx[j + 1]] = aux[inv]
-
-        return all_w
-
-
-
-    def build_CI(self, y):
-        alpha = 0.1
-        dof = 1.
-        u0 = self.F_inv_ncx(1.-alpha, dof, 0.)
-        nu = (dof - 2.)/2.
-        zz = -norm.ppf(alpha/2.)
-        if y <= u0:
-            ll = 0.
-        else:
-            ly = self.lamfind(y, dof, 1.-alpha)
-            g0 = self.gr(0., nu, ly)
-            gy = self.gr(y, nu, ly)
-            if g0 >= gy:
-                ll = ly
-            else:
-                def f1(cd):
-                    return np.log(self.gr(y, nu, cd[0])/self.gr(cd[1], nu, cd[0]))**2 +\
-                           (self.F_ncx(y, dof, cd[0]) - self.F_ncx(cd[1], dof, cd[0]) - (1. - alpha))**2
-                st = np.array([y-zz, y-2*zz], dtype=np.float64)
-                if st[0] <= 0:
-                    st[0] = 0.1*(y + 0.1)
-                if st[1] <= 0:
-                    st[1] = 0.05*(y + 0.1)
-                ll = minimize(f1, st, constraints=[
-                    {
-                        'type':'ineq',
-                        'fun':lambda x:x[0]
-                    },
-                    {
-                        'type': 'ineq',
-                        'fun': lambda x: x[1]
-                    }
-                ])
-                ll = ll.x[0]
-
-        def f1(cd):
-            return np.log(self.gr(y, nu, cd[0]) / self.gr(cd[1], nu, cd[0])) ** 2 + \
-                   (self.F_ncx(cd[1], dof, cd[0]) - self.F_ncx(y, dof, cd[0]) - (1. - alpha)) ** 2
-        st = np.array([y + zz, y + 2*zz], dtype=np.float64)
-        lu = minimize(f1, st, constraints=[
-            {
-                'type': 'ineq',
-                'fun': lambda x: x[0]
-            },
-            {
-                'type': 'ineq',
-                'fun': lambda x: x[1]
-            }
-        ])
-        lu = lu.x[0]
-
-        return ll, lu
-
-
-
-    def F_ncx(self, u, dof, lam):
-        if lam > 0:
-            return ncx2.cdf(u**2, dof, lam**2)
-        else:
-            return chi2.cdf(u**2, dof)
-
-
-
-    def F_inv_ncx(self, prob, dof, lam):
-        if lam > 0:
-            return np.sqrt(ncx2.ppf(prob, dof, lam**2))
+        if self.quadratic_v is None:
+            self.quadratic_v = GroupedQuadratic(np.vstack([np.hstack((self.source_samples[j]['var_phi_v'].reshape((self.reduced_source_sizes_v[j], -1)),
+                                                                      self.source_samples[j]['rho_v'])) for j in range(self.m)]),
+                                                np.concatenate([self.source_samples[j]['grp_szs_v'] for j in range(self.m)]),
+                                                self.reduced_source_sizes_v, self.source_sizes)
+        self.quadratic_v.set_target(np.append(target_A.flatten(), target_b), n)
+        return self.solve_weights(self.quadratic_v, self.l_bounds_lstdv, self.u_bounds_lstdv, self.reduced_source_sizes_v, 'v')
+
+
+
+    def solve_weights(self, quadratic, l_bounds, u_bounds, reduced_source_sizes, suffix):
+        # The target policy moves little between two calls, so the previous solution and active set, clipped to the new
+        # bounds, are a close starting point
+        previous = self.last_solutions[suffix]
+        if self.warm_start and previous is not None:
+            w0, active0 = previous.x, previous.active
         else:
-            return np.sqrt(chi2.ppf(prob, dof))
-
-
+            w0, active0 = np.ones(reduced_source_sizes.sum(), dtype=np.float64), None
+        start = time.time()
+        res = solve_box_qp(quadratic, l_bounds, u_bounds, w0, active0)
+        self.solver_stats[suffix].append((res.nit, res.ncg, time.time() - start))
+        self.last_solutions[suffix] = res
+        return self.expand_weights(res.x, reduced_source_sizes, suffix)
 
-    def lambound(self, y, dof, alpha):
-        lam = 1.
-        obj = 1.
-        while obj > 0.:
-            lam *= 2.
-            obj = self.F_ncx(y, dof, lam) - alpha
-        return lam
 
 
+    def expand_weights(self, w, reduced_source_sizes, suffix):
+        # From one weight per group of identical samples back to one per source sample, in sampling order
+        reduced_w_idx = np.hstack((0., reduced_source_sizes)).cumsum().astype(np.int64)
+        all_w = np.zeros(self.source_sizes.sum(), dtype=np.float64)
+        w_idx = np.hstack((0., self.source_sizes)).cumsum().astype(np.int64)
+        for j in range(self.m):
+            all_w[w_idx[j]:w_idx[j + 1]] = w[reduced_w_idx[j]:reduced_w_idx[j + 1]][self.source_samples[j]['grp_idx_' + suffix]]
 
-    def lamfind(self, y, dof, alpha):
-        if alpha < 1e-4 or self.F_ncx(y, dof, 0.) < alpha:
-            print("Bad lam find")
-            return
-        lbig = self.lambound(y, dof, alpha)
-        res = brentq(lambda x: self.F_ncx(y, dof, x) - alpha, 0., lbig)
-        return res
+        return all_w
 
 
 
-    def gr(self, u, nu, lam):
-        ul = u*lam
-        if ul > 0:
-            pdf = ul**(-nu)*iv(nu, ul)*np.exp(-0.5*(u**2+lam**2))
-            if math.isnan(pdf):
-                pdf = 0.
-        else:
-            pdf = 0.5**nu*np.exp(-0.5*(u**2+lam**2))/gam_fun(nu+1.)
-        return pdf
\ No newline at end of file
+    def build_CI(self, y, alpha=0.1, dof=1.):
+        # Confidence interval on the noncentrality of a chi variable observed at y, for a single y or elementwise for an
+        # array of them, from the interpolation table of NoncentralChiCI
+        ll, lu = noncentral_chi_ci(y, alpha, dof)
+        return ll[()], lu[()]
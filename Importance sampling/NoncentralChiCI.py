@@ -0,0 +1,153 @@
+import numpy as np
+from scipy.optimize import brentq, root
+from scipy.interpolate import CubicSpline
+from scipy.special import ive, gammaln
+from scipy.stats import ncx2, chi2, norm
+
+
+# Confidence interval on the noncentrality lam of a noncentral chi variable with dof degrees of freedom from one
+# observation y, as built by MinWeightsEstimator.build_CI. The upper end is the lam for which [y, c] is the acceptance
+# region of probability 1 - alpha with equal densities at its ends, the lower one the lam for which [c, y] is, or [0, y]
+# when the density at 0 is the larger, and 0 when y is below the 1 - alpha quantile of lam = 0
+
+
+
+def F_ncx(u, dof, lam):
+    u = np.asarray(u, dtype=np.float64)
+    lam = np.asarray(lam, dtype=np.float64)
+    return np.where(lam > 0., ncx2.cdf(u ** 2, dof, np.maximum(lam, np.finfo(np.float64).tiny) ** 2), chi2.cdf(u ** 2, dof))
+
+
+
+def F_inv_ncx(prob, dof, lam):
+    if lam > 0:
+        return np.sqrt(ncx2.ppf(prob, dof, lam ** 2))
+    else:
+        return np.sqrt(chi2.ppf(prob, dof))
+
+
+
+def log_gr(u, nu, lam):
+    # Log of the density of the noncentral chi up to a constant, with nu = (dof - 2) / 2. The Bessel function is taken
+    # exponentially scaled, so that it does not overflow for large u * lam
+    ul = np.abs(u) * lam
+    safe_ul = np.maximum(ul, np.finfo(np.float64).tiny)
+    with np.errstate(divide='ignore'):
+        return np.where(ul > 0., -nu * np.log(safe_ul) + np.log(ive(nu, safe_ul)) + safe_ul,
+                        nu * np.log(0.5) - gammaln(nu + 1.)) - 0.5 * (u ** 2 + lam ** 2)
+
+
+
+def lamfind(y, dof, prob):
+    # lam for which y is the prob quantile, 0 when y is below the quantile of lam = 0
+    if F_ncx(y, dof, 0.) <= prob:
+        return 0.
+    lbig = 2.
+    while F_ncx(y, dof, lbig) > prob:
+        lbig *= 2.
+    return brentq(lambda x: F_ncx(y, dof, x) - prob, 0., lbig, xtol=1e-14)
+
+
+
+def equal_density_end(y, dof, alpha, start, side):
+    # Solves for (lam, c) the equal densities at y and c and the probability 1 - alpha between them, c being above y
+    # for side = 1 and below it for side = -1
+    nu = (dof - 2.) / 2.
+
+    def residuals(cd):
+        return [log_gr(y, nu, cd[0]) - log_gr(cd[1], nu, cd[0]),
+                side * (F_ncx(cd[1], dof, cd[0]) - F_ncx(y, dof, cd[0])) - (1. - alpha)]
+
+    res = root(residuals, start, method='hybr', options={'xtol': 1e-13})
+    return res.x
+
+
+
+def exact_ci(y, alpha=0.1, dof=1.):
+    zz = -norm.ppf(alpha / 2.)
+    return exact_lower(y, alpha, dof, zz), equal_density_end(y, dof, alpha, np.array([y + zz, y + 2 * zz], dtype=np.float64), 1.)[0]
+
+
+
+def exact_lower(y, alpha, dof, zz):
+    nu = (dof - 2.) / 2.
+    if y <= F_inv_ncx(1. - alpha, dof, 0.):
+        return 0.
+    ly = lamfind(y, dof, 1. - alpha)
+    if log_gr(0., nu, ly) >= log_gr(y, nu, ly):
+        return ly
+    start = np.array([y - zz, y - 2 * zz], dtype=np.float64)
+    if start[0] <= 0:
+        start[0] = 0.1 * (y + 0.1)
+    if start[1] <= 0:
+        start[1] = 0.05 * (y + 0.1)
+    return equal_density_end(y, dof, alpha, start, -1.)[0]
+
+
+
+class NoncentralChiCI:
+    # Interpolation table of exact_ci on [0, y_max] for one alpha and dof. The lower end is 0 up to the 1 - alpha
+    # quantile u0 of lam = 0, then the 1 - alpha quantile lam up to y_switch, where the density at 0 stops being the
+    # larger, and the equal density solution after it. Each piece gets its own spline, so none spans a kink, and the
+    # square of the lower end is interpolated on the first one, as it grows like sqrt(y - u0) from u0. The grid is
+    # refined to step / 10 within a step of the ends of the pieces, and the y beyond y_max are solved exactly
+    def __init__(self, alpha, dof, y_max=20., step=0.1):
+        self.alpha = alpha
+        self.dof = dof
+        self.y_max = y_max
+        self.step = step
+        nu = (dof - 2.) / 2.
+        zz = -norm.ppf(alpha / 2.)
+        self.u0 = F_inv_ncx(1. - alpha, dof, 0.)
+
+        def switch(y):
+            ly = lamfind(y, dof, 1. - alpha)
+            return log_gr(0., nu, ly) - log_gr(y, nu, ly)
+
+        self.y_switch = brentq(switch, self.u0 + 1e-6, y_max) if switch(y_max) < 0. else y_max
+        y_quantile = self.grid(self.u0, self.y_switch)
+        self.lower_quantile = CubicSpline(y_quantile, [lamfind(y, dof, 1. - alpha) ** 2 for y in y_quantile])
+        # At y_switch c reaches 0, where both solutions meet
+        y_equal = self.grid(self.y_switch, y_max)
+        self.lower_equal = CubicSpline(y_equal, [lamfind(self.y_switch, dof, 1. - alpha)] +
+                                       [exact_lower(y, alpha, dof, zz) for y in y_equal[1:]])
+        y_upper = self.grid(0., y_max)
+        self.upper = CubicSpline(y_upper, [equal_density_end(y, dof, alpha, np.array([y + zz, y + 2 * zz], dtype=np.float64), 1.)[0]
+                                           for y in y_upper])
+
+
+
+    def grid(self, start, stop):
+        # The refined points are offsets strictly inside the first and last intervals of the coarse grid, as knots a
+        # rounding error apart would make the splines oscillate
+        n = max(int(np.ceil((stop - start) / self.step)), 3)
+        coarse = np.linspace(start, stop, n + 1)
+        offsets = (coarse[1] - coarse[0]) * np.arange(1, 10) / 10.
+        return np.sort(np.concatenate((coarse, start + offsets, stop - offsets)))
+
+
+
+    def __call__(self, y):
+        shape = np.shape(y)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        ll = np.zeros_like(y)
+        quantile = np.logical_and(y > self.u0, y <= self.y_switch)
+        ll[quantile] = np.sqrt(np.maximum(self.lower_quantile(y[quantile]), 0.))
+        equal = y > self.y_switch
+        ll[equal] = self.lower_equal(y[equal])
+        lu = self.upper(y)
+        for i in np.nonzero(y > self.y_max)[0]:
+            ll[i], lu[i] = exact_ci(y[i], self.alpha, self.dof)
+        return ll.reshape(shape), lu.reshape(shape)
+
+
+
+ci_tables = {}
+
+
+def noncentral_chi_ci(y, alpha=0.1, dof=1.):
+    # Vectorized exact_ci, through the table of alpha and dof built the first time they are seen
+    key = (alpha, dof)
+    if key not in ci_tables:
+        ci_tables[key] = NoncentralChiCI(alpha, dof)
+    return ci_tables[key](y)
@@ -29,6 +29,15 @@ class PolicyMC:
 
 
 
+    def produce_action_idx(self, state_idx):
+        # Index version of produce_action for the discrete model, state_idx can be an array of state indices
+        state_idx = np.asarray(state_idx, dtype=np.int64)
+        samps = np.random.random_sample(state_idx.shape)
+        action_idx = (self.choice_cdf[state_idx] <= samps[..., None]).sum(axis=-1)
+        return np.minimum(action_idx, self.choice_cdf.shape[1] - 1)
+
+
+
     def action_pdf(self, action, state):
         if action.size == 1 and state.size == 2:
             mu = (self.alpha1 * self.factory.max_act if state[1] >= 0 else -self.alpha2 * self.factory.min_act) * state[1] / self.factory.max_speed
@@ -66,14 +75,8 @@ class PolicyMC:
 
 
     def build_choice_matrix(self):
-        self.choice_matrix = np.zeros((self.factory.state_reps.shape[0], self.factory.action_reps.shape[0]), dtype=np.float64)
-        a1_mask = self.factory.state_reps[:,1] >= 0
-        a2_mask = np.logical_not(a1_mask)
-        mu = (a1_mask * self.alpha1 + a2_mask * self.alpha2)*(self.factory.state_reps[:,1] / self.factory.max_speed)
-        self.choice_matrix[:,0] = (1 + erf((self.factory.action_bins[1] - mu)/(self.factory.action_noise*np.sqrt(2.))))/2.
-        self.choice_matrix[:,-1] = (1 - erf((self.factory.action_bins[-2] - mu) / (self.factory.action_noise * np.sqrt(2.))))/2.
-        mu_rep = np.dstack([mu]*(self.factory.action_reps.shape[0] - 2))
-        self.choice_matrix[:,1:-1] = (erf((self.factory.action_bins[2:-1] - mu_rep) / (self.factory.action_noise * np.sqrt(2.))) - erf((self.factory.action_bins[1:-2] - mu_rep) / (self.factory.action_noise * np.sqrt(2.))))/2.
+        self.choice_matrix = self.factory.build_choice_matrices(np.array([[self.alpha1, self.alpha2]]))[0]
+        self.choice_cdf = self.choice_matrix.cumsum(axis=1)
                     
 
 
@@ -95,7 +98,7 @@ class PolicyMC:
 
 class PolicyFactoryMC:
     def __init__(self, model, action_noise, max_speed, min_act, max_act, action_bins=None, action_reps=None, state_reps=None,
-                 state_to_idx=None):
+                 state_to_idx=None, dtype=np.float64):
         self.model = model
         self.action_noise = action_noise
         self.max_speed = max_speed
@@ -105,6 +108,8 @@ class PolicyFactoryMC:
         self.action_reps = action_reps
         self.state_reps = state_reps
         self.state_to_idx = state_to_idx
+        # Storage precision of the choice matrices, they are computed in float64 anyway
+        self.dtype = dtype
         
         
         
@@ -113,5 +118,20 @@ class PolicyFactoryMC:
 
 
 
+    def build_choice_matrices(self, alphas):
+        # Choice matrices of the policies with parameters alphas[k] = (alpha1, alpha2), stacked along the first axis
+        alphas = np.asarray(alphas, dtype=np.float64).reshape((-1, 2))
+        choice_matrices = np.zeros((alphas.shape[0], self.state_reps.shape[0], self.action_reps.shape[0]), dtype=np.float64)
+        a1_mask = self.state_reps[:,1] >= 0
+        a2_mask = np.logical_not(a1_mask)
+        mu = (a1_mask * alphas[:, 0:1] + a2_mask * alphas[:, 1:2])*(self.state_reps[:,1] / self.max_speed)
+        choice_matrices[:,:,0] = (1 + erf((self.action_bins[1] - mu)/(self.action_noise*np.sqrt(2.))))/2.
+        choice_matrices[:,:,-1] = (1 - erf((self.action_bins[-2] - mu) / (self.action_noise * np.sqrt(2.))))/2.
+        mu_rep = mu[:, :, None]
+        choice_matrices[:,:,1:-1] = (erf((self.action_bins[2:-1] - mu_rep) / (self.action_noise * np.sqrt(2.))) - erf((self.action_bins[1:-2] - mu_rep) / (self.action_noise * np.sqrt(2.))))/2.
+        return choice_matrices.astype(self.dtype, copy=False)
+
+
+
     def rescale_action(self, x):
         return (self.max_act - self.min_act) * x / 2.0
\ No newline at end of file
@@ -0,0 +1,503 @@
+import numpy as np
+import math
+import os
+import hashlib
+import threading
+from scipy.special import erf
+
+
+# Lipschitz constants of the transition model of a source task with respect to its power, for every (s, a, s'), as
+# used by the weights estimators. min_env and max_env are the same task with the power at the ends of
+# [min_power, max_power]
+
+
+
+class BinGeometry:
+    # Means of the position and velocity gaussians for which the mass of each inner bin changes the fastest. They only
+    # depend on the bins and the noise, so they are solved once per grid and shared by every source and estimator
+    def __init__(self, position_bins, velocity_bins, position_noise, velocity_noise, tol=1e-12, max_iter=100):
+        self.tol = tol
+        self.max_iter = max_iter
+        self.mu_peak_pos = self.peak_locations(position_bins, position_noise, 0.1)
+        self.mu_peak_vel = self.peak_locations(velocity_bins, velocity_noise, 0.01)
+
+
+
+    def peak_locations(self, bins, noise, offset):
+        # Newton on every inner bin at once for the root below b1 of
+        # (log(b2 - x) - log(b1 - x) + (b1^2 - b2^2) / (2 noise^2)) / ((b1 - b2) / noise^2) - x,
+        # starting from b1 - offset as the scalar root finding did. Steps that would cross b1 are halved
+        mu_peak = np.zeros(bins.shape[0] - 1, dtype=np.float64)
+        b1 = bins[1:-2]
+        b2 = bins[2:-1]
+        k = (b1 - b2) / noise ** 2
+        c = (b1 ** 2 - b2 ** 2) / (2. * noise ** 2)
+        x = b1 - offset
+        for _ in range(self.max_iter):
+            f = (np.log(b2 - x) - np.log(b1 - x) + c) / k - x
+            df = (1. / (b1 - x) - 1. / (b2 - x)) / k - 1.
+            x_new = x - f / df
+            x_new = np.where(x_new < b1, x_new, (x + b1) / 2.)
+            converged = np.all(np.abs(x_new - x) <= self.tol * (1. + np.abs(x)))
+            x = x_new
+            if converged:
+                break
+        mu_peak[1:-1] = x
+        return mu_peak
+
+
+
+bin_geometries = {}
+
+
+def bin_geometry(env):
+    # BinGeometry of the grid of env, built the first time the grid is seen
+    key = (env.position_bins.tobytes(), env.velocity_bins.tobytes(), env.position_noise, env.velocity_noise)
+    if key not in bin_geometries:
+        bin_geometries[key] = BinGeometry(env.position_bins, env.velocity_bins, env.position_noise, env.velocity_noise)
+    return bin_geometries[key]
+
+
+
+def lipschitz_bounds(env, min_env, max_env, min_power, max_power, geometry=None):
+    # Same bound as lipschitz_bounds_reference with every (s, a, s') at once: the position and velocity factors are
+    # built as (S, A, n_pos) and (S, A, n_vel) arrays, each branch of the reference loop becoming a np.where
+    if geometry is None:
+        geometry = bin_geometry(env)
+    mu_peak_pos = geometry.mu_peak_pos
+    mu_peak_vel = geometry.mu_peak_vel
+    n_states = env.state_reps.shape[0]
+    n_actions = env.action_reps.shape[0]
+    pos_bins = env.position_bins
+    vel_bins = env.velocity_bins
+    pos_noise = env.position_noise
+    vel_noise = env.velocity_noise
+    states = np.repeat(env.state_reps, n_actions, axis=0)
+    actions = np.tile(env.action_reps, n_states).reshape((-1, 1))
+    mu_min = min_env.clean_step(states, actions).reshape((n_states, n_actions, 2, 1))
+    mu_max = max_env.clean_step(states, actions).reshape((n_states, n_actions, 2, 1))
+    del states, actions
+    # Everything below is (S, A, n) with n the number of bins considered
+    act = env.action_reps[None, :, None]
+    pos_sum = env.state_reps.sum(axis=1)[:, None, None]
+    vel = env.state_reps[:, 1][:, None, None]
+    gravity = (env.rescale(0.0025) * np.cos(3 * env.inverse_transform(env.state_reps[:, 0])))[:, None, None]
+
+    def outside(x, base):
+        # Whether the power moving the mean onto x falls out of [min_power, max_power]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eps_peak = (x - base + gravity) / act
+        return np.logical_or(eps_peak < min_power, eps_peak > max_power)
+
+    def density(x, mu, noise):
+        return np.exp(-(x - mu) ** 2 / (2. * noise ** 2))
+
+    def cdf(x, mu, noise):
+        return erf((x - mu) / (np.sqrt(2.) * noise))
+
+    def inner_peaks(bins, mu_peak):
+        b1 = bins[1:-2]
+        b2 = bins[2:-1]
+        bm = (b1 + b2) / 2.
+        mu_peak = mu_peak[1:-1]
+        mu_peak1 = np.where(mu_peak < b1, mu_peak, 2 * bm - mu_peak)
+        mu_peak2 = np.where(mu_peak < b1, 2 * bm - mu_peak, mu_peak)
+        return b1, b2, bm, mu_peak, mu_peak1, mu_peak2
+
+    def factors(bins, noise, mu_peak, mu_lo, mu_hi, base, keep_first, keep_last, keep_inner):
+        # M_e (derivative of the bin mass) and M_P (bin mass) bounds, the keep_* masks being the extra conditions
+        # under which the velocity switches to the probe envs
+        M_e = np.empty((n_states, n_actions, bins.shape[0] - 1), dtype=np.float64)
+        M_P = np.empty_like(M_e)
+        M_e[:, :, :1] = np.where(np.logical_and(outside(bins[1], base), keep_first),
+                                 np.maximum(density(bins[1], mu_lo, noise), density(bins[1], mu_hi, noise)), 1.)
+        M_P[:, :, :1] = np.where(np.logical_and(outside(bins[0], base), keep_first),
+                                 np.maximum((1. + cdf(bins[1], mu_lo, noise)) / 2., (1. + cdf(bins[1], mu_hi, noise)) / 2.),
+                                 (1. + erf((bins[1] - bins[0]) / (np.sqrt(2.) * noise))) / 2.)
+        M_e[:, :, -1:] = np.where(np.logical_and(outside(bins[-2], base), keep_last),
+                                  np.maximum(density(bins[-2], mu_lo, noise), density(bins[-2], mu_hi, noise)), 1.)
+        M_P[:, :, -1:] = np.where(np.logical_and(outside(bins[-1], base), keep_last),
+                                  np.maximum((1. - cdf(bins[-2], mu_lo, noise)) / 2., (1. - cdf(bins[-2], mu_hi, noise)) / 2.),
+                                  (1. - erf((bins[-2] - bins[-1]) / (np.sqrt(2.) * noise))) / 2.)
+        b1, b2, bm, peak, peak1, peak2 = inner_peaks(bins, mu_peak)
+        M_e[:, :, 1:-1] = np.where(np.logical_and(np.logical_and(outside(peak1, base), outside(peak2, base)), keep_inner),
+                                   np.maximum(np.abs(density(b1, mu_lo, noise) - density(b2, mu_lo, noise)),
+                                              np.abs(density(b1, mu_hi, noise) - density(b2, mu_hi, noise))),
+                                   np.abs(density(b1, peak, noise) - density(b2, peak, noise)))
+        M_P[:, :, 1:-1] = np.where(np.logical_and(outside(bm, base), keep_inner),
+                                   np.maximum((cdf(b2, mu_lo, noise) - cdf(b1, mu_lo, noise)) / 2.,
+                                              (cdf(b2, mu_hi, noise) - cdf(b1, mu_hi, noise)) / 2.),
+                                   (erf((b2 - bm) / (np.sqrt(2.) * noise)) - erf((b1 - bm) / (np.sqrt(2.) * noise))) / 2.)
+        return M_e, M_P
+
+    M_e_pos, M_P_pos = factors(pos_bins, pos_noise, mu_peak_pos, mu_min[:, :, 0], mu_max[:, :, 0], pos_sum, True, True, True)
+    # The velocity bound falls back to the peak whenever one of the probe envs bumps into the left wall
+    real_vel_min = np.clip(vel + act * 0. - gravity, env.min_speed, env.max_speed)
+    real_vel_max = np.clip(vel + act * 0.5 - gravity, env.min_speed, env.max_speed)
+    keep_edges = np.logical_and(np.logical_not(np.logical_and(real_vel_min < 0, mu_min[:, :, 0] <= pos_bins[1])),
+                                np.logical_not(np.logical_and(real_vel_max < 0, mu_max[:, :, 0] <= pos_bins[1])))
+    keep_inner = np.logical_and(np.logical_not(np.logical_and(real_vel_min < 0, mu_min[:, :, 0] == pos_bins[1])),
+                                np.logical_not(np.logical_and(real_vel_max < 0, mu_max[:, :, 0] == pos_bins[1])))
+    M_e_vel, M_P_vel = factors(vel_bins, vel_noise, mu_peak_vel, mu_min[:, :, 1], mu_max[:, :, 1], vel, keep_edges,
+                               keep_edges, keep_inner)
+    abs_act = np.abs(env.action_reps)[None, :, None, None]
+    L = (abs_act / (np.sqrt(2. * np.pi) * vel_noise)) * (M_e_vel[:, :, :, None] * M_P_pos[:, :, None, :]) + \
+        (abs_act / (np.sqrt(2. * np.pi) * pos_noise)) * (M_P_vel[:, :, :, None] * M_e_pos[:, :, None, :])
+    return L.reshape((n_states, n_actions, -1))
+
+
+
+def lipschitz_bounds_key(env, min_env, max_env, min_power, max_power, dtype):
+    # Hash of everything lipschitz_bounds depends on, the power of env itself not being one of them
+    h = hashlib.sha1()
+    for array in [env.position_bins, env.velocity_bins, env.action_reps]:
+        h.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    h.update(repr([(e.min_position, e.max_position, e.min_speed, e.max_speed, e.min_action, e.max_action, e.model,
+                    e.position_noise, e.velocity_noise) for e in [env, min_env, max_env]] +
+                  [min_env.power, max_env.power, min_power, max_power, np.dtype(dtype).str]).encode())
+    return h.hexdigest()
+
+
+
+def cached_lipschitz_bounds(env, min_env, max_env, min_power, max_power, cache_dir, dtype=np.float64):
+    # lipschitz_bounds and its max over (s, a) as read-only memory maps of .npy files in cache_dir, built by the first
+    # process that needs them. Files are written under a name unique to the process and thread, so concurrent jobs
+    # never map a partial one nor move each other's
+    path = os.path.join(cache_dir, 'L_P_' + lipschitz_bounds_key(env, min_env, max_env, min_power, max_power, dtype))
+    files = [os.path.join(path, name + '.npy') for name in ['L_P_eps_s_a_s_prime', 'L_P_eps_s_prime']]
+    if not all(os.path.exists(file) for file in files):
+        L = lipschitz_bounds(env, min_env, max_env, min_power, max_power).astype(dtype, copy=False)
+        os.makedirs(path, exist_ok=True)
+        for file, array in zip(files, [L, L.max(axis=(0, 1)).astype(np.float64)]):
+            tmp_file = file[:-len('.npy')] + '.{}.{}.tmp.npy'.format(os.getpid(), threading.get_ident())
+            np.save(tmp_file, array)
+            os.replace(tmp_file, file)
+        del L
+    return tuple(np.load(file, mmap_mode='r') for file in files)
+
+
+
+def fill_lipschitz_bounds_cache(env, min_env, max_env, min_power, max_power, cache_dir, dtype=np.float64):
+    # cached_lipschitz_bounds for a worker process, which only leaves the files in cache_dir for its parent to map
+    cached_lipschitz_bounds(env, min_env, max_env, min_power, max_power, cache_dir, dtype)
+
+
+
+# Largest number of values of a tile of delta_d_q that is alive at once
+delta_d_q_tile_size = 1 << 22
+
+
+
+def delta_d_q_entries(X, Y, delta_pi, target_pi, s, a, s_prime, a_prime):
+    # delta_d_q[s, a, s', a'] = X[s, a, s'] * delta_pi[s', a'] + Y[s, a, s'] * target_pi[s', a'], with X the source
+    # zeta_distr * P and Y delta_d_v, so the (S, A, S, A) tensor is only expanded where it is read. Clipped delta_d_q at
+    # the given (s, a, s', a') quadruples
+    return np.clip(X[s, a, s_prime] * delta_pi[s_prime, a_prime] + Y[s, a, s_prime] * target_pi[s_prime, a_prime], 0., 1.)
+
+
+
+def delta_d_q_row_sums(X, Y, delta_pi, target_pi, tile_size=None):
+    # Sum over (s', a') of the clipped delta_d_q, streamed over tiles of s' so that peak memory does not grow with S^2 A^2
+    if tile_size is None:
+        tile_size = max(1, delta_d_q_tile_size // (X.shape[0] * X.shape[1] * delta_pi.shape[1]))
+    row_sums = np.zeros(X.shape[:2], dtype=np.float64)
+    for start in range(0, X.shape[2], tile_size):
+        tile = slice(start, start + tile_size)
+        d = X[:, :, tile, None] * delta_pi[None, None, tile, :]
+        d += Y[:, :, tile, None] * target_pi[None, None, tile, :]
+        np.clip(d, 0., 1., out=d)
+        row_sums += d.sum(axis=(2, 3), dtype=np.float64)
+    return row_sums
+
+
+
+def lipschitz_bounds_reference(env, min_env, max_env, min_power, max_power, geometry=None):
+    # Original per-(s, a, s') loop, kept to check lipschitz_bounds against. The peak locations come from the same
+    # BinGeometry, as the per-state scalar root finding of the original failed on the inner bins
+    if geometry is None:
+        geometry = bin_geometry(env)
+    mu_peak_pos_e = geometry.mu_peak_pos
+    mu_peak_vel_e = geometry.mu_peak_vel
+    L = np.zeros(env.transition_shape, dtype=np.float64)
+    for s in range(env.state_reps.shape[0]):
+        for a in range(env.action_reps.shape[0]):
+            M_e_pos = np.zeros(env.position_reps.shape[0], dtype=np.float64)
+            M_e_vel = np.zeros(env.velocity_reps.shape[0], dtype=np.float64)
+            M_P_pos = np.zeros(env.position_reps.shape[0], dtype=np.float64)
+            M_P_vel = np.zeros(env.velocity_reps.shape[0], dtype=np.float64)
+            mu_min_source = min_env.clean_step(env.state_reps[s], env.action_reps[a:a + 1])
+            mu_max_source = max_env.clean_step(env.state_reps[s], env.action_reps[a:a + 1])
+            for pos_prime in range(env.position_reps.shape[0]):
+                if pos_prime == 0:
+                    eps_peak = \
+                        (env.position_bins[1] - env.state_reps[s].sum() +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if eps_peak < min_power or eps_peak > max_power:
+                        M_e_pos[pos_prime] = max(
+                            np.exp(-(env.position_bins[1] - mu_min_source[0]) ** 2 /
+                                   (2. * env.position_noise ** 2)),
+                            np.exp(-(env.position_bins[1] - mu_max_source[0]) ** 2 /
+                                   (2. * env.position_noise ** 2)))
+                    else:
+                        M_e_pos[pos_prime] = 1.
+                    eps_peak = \
+                        (env.position_bins[0] - env.state_reps[s].sum() +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if eps_peak < min_power or eps_peak > max_power:
+                        M_P_pos[pos_prime] = max(
+                            (1. + erf((env.position_bins[1] - mu_min_source[0]) /
+                                      (np.sqrt(2.) * env.position_noise))) / 2.,
+                            (1. + erf((env.position_bins[1] - mu_max_source[0]) /
+                                      (np.sqrt(2.) * env.position_noise))) / 2.)
+                    else:
+                        M_P_pos[pos_prime] = (1. + erf(
+                            (env.position_bins[1] - env.position_bins[0]) /
+                            (np.sqrt(2.) * env.position_noise))) / 2.
+                elif pos_prime == env.position_reps.shape[0] - 1:
+                    eps_peak = \
+                        (env.position_bins[-2] - env.state_reps[s].sum() +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if eps_peak < min_power or eps_peak > max_power:
+                        M_e_pos[pos_prime] = max(
+                            np.exp(-(env.position_bins[-2] - mu_min_source[0]) ** 2 /
+                                   (2. * env.position_noise ** 2)),
+                            np.exp(-(env.position_bins[-2] - mu_max_source[0]) ** 2 /
+                                   (2. * env.position_noise ** 2)))
+                    else:
+                        M_e_pos[pos_prime] = 1.
+                    eps_peak = \
+                        (env.position_bins[-1] - env.state_reps[s].sum() +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if eps_peak < min_power or eps_peak > max_power:
+                        M_P_pos[pos_prime] = max(
+                            (1. - erf((env.position_bins[-2] - mu_min_source[0]) /
+                                      (np.sqrt(2.) * env.position_noise))) / 2.,
+                            (1. - erf((env.position_bins[-2] - mu_max_source[0]) /
+                                      (np.sqrt(2.) * env.position_noise))) / 2.)
+                    else:
+                        M_P_pos[pos_prime] = (1. - erf(
+                            (env.position_bins[-2] - env.position_bins[-1]) /
+                            (np.sqrt(2.) * env.position_noise))) / 2.
+                else:
+                    p1 = env.position_bins[pos_prime]
+                    p2 = env.position_bins[pos_prime + 1]
+                    pm = (p1 + p2) / 2.
+                    mu_peak = mu_peak_pos_e[pos_prime]
+                    if mu_peak < p1:
+                        mu_peak1 = mu_peak
+                        mu_peak2 = 2 * pm - mu_peak
+                    else:
+                        mu_peak2 = mu_peak
+                        mu_peak1 = 2 * pm - mu_peak
+                    eps_peak1 = \
+                        (mu_peak1 - env.state_reps[s].sum() +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    eps_peak2 = \
+                        (mu_peak2 - env.state_reps[s].sum() +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if (eps_peak1 < min_power or eps_peak1 > max_power) and (
+                            eps_peak2 < min_power or eps_peak2 > max_power):
+                        M_e_pos[pos_prime] = max(np.abs(np.exp(-(p1 - mu_min_source[0]) ** 2 /
+                                                               (2 * env.position_noise ** 2)) -
+                                                        np.exp(-(p2 - mu_min_source[0]) ** 2 /
+                                                               (2 * env.position_noise ** 2))),
+                                                 np.abs(np.exp(-(p1 - mu_max_source[0]) ** 2 /
+                                                               (2 * env.position_noise ** 2))
+                                                        - np.exp(-(p2 - mu_max_source[0]) ** 2 /
+                                                                 (
+                                                                 2 * env.position_noise ** 2))))
+                    else:
+                        M_e_pos[pos_prime] = \
+                            np.abs(
+                                np.exp(-(p1 - mu_peak) ** 2 / (2 * env.position_noise ** 2)) -
+                                np.exp(-(p2 - mu_peak) ** 2 / (2 * env.position_noise ** 2)))
+                    eps_peak = \
+                        (pm - env.state_reps[s].sum() +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if eps_peak < min_power or eps_peak > max_power:
+                        M_P_pos[pos_prime] = \
+                            max((erf(
+                                (p2 - mu_min_source[0]) / (np.sqrt(2.) * env.position_noise)) -
+                                 erf((p1 - mu_min_source[0]) / (
+                                 np.sqrt(2.) * env.position_noise))) / 2.,
+                                (erf((p2 - mu_max_source[0]) / (
+                                np.sqrt(2.) * env.position_noise)) -
+                                 erf((p1 - mu_max_source[0]) / (
+                                 np.sqrt(2.) * env.position_noise))) / 2.)
+                    else:
+                        M_P_pos[pos_prime] = (erf(
+                            (p2 - pm) / (np.sqrt(2.) * env.position_noise)) -
+                                              erf((p1 - pm) / (
+                                              np.sqrt(2.) * env.position_noise))) / 2.
+            for vel_prime in range(env.velocity_reps.shape[0]):
+                real_vel_min_source = \
+                    env.state_reps[s][1] + env.action_reps[a] * 0. - \
+                    env.rescale(0.0025) * math.cos(
+                        3 * env.inverse_transform(env.state_reps[s][0]))
+                real_vel_max_source = \
+                    env.state_reps[s][1] + env.action_reps[a] * 0.5 - \
+                    env.rescale(0.0025) * math.cos(
+                        3 * env.inverse_transform(env.state_reps[s][0]))
+                real_vel_min_source, real_vel_max_source = np.clip([real_vel_min_source, real_vel_max_source],
+                                                                   env.min_speed,
+                                                                   env.max_speed)
+                if vel_prime == 0:
+                    eps_peak = \
+                        (env.velocity_bins[1] - env.state_reps[s][1] +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if (eps_peak < min_power or eps_peak > max_power) and \
+                            (not (real_vel_min_source < 0 and mu_min_source[0] <=
+                                env.position_bins[1]) and
+                                 not (real_vel_max_source < 0 and mu_max_source[0] <=
+                                     env.position_bins[1])):
+                        M_e_vel[vel_prime] = max(
+                            np.exp(-(env.velocity_bins[1] - mu_min_source[1]) ** 2 /
+                                   (2. * env.velocity_noise ** 2)),
+                            np.exp(-(env.velocity_bins[1] - mu_max_source[1]) ** 2 /
+                                   (2. * env.velocity_noise ** 2)))
+                    else:
+                        M_e_vel[vel_prime] = 1.
+                    eps_peak = \
+                        (env.velocity_bins[0] - env.state_reps[s][1] +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if (eps_peak < min_power or eps_peak > max_power) and \
+                            (not (real_vel_min_source < 0 and mu_min_source[0] <=
+                                env.position_bins[1]) and
+                                 not (real_vel_max_source < 0 and mu_max_source[0] <=
+                                     env.position_bins[1])):
+                        M_P_vel[vel_prime] = max(
+                            (1. + erf((env.velocity_bins[1] - mu_min_source[1]) /
+                                      (np.sqrt(2.) * env.velocity_noise))) / 2.,
+                            (1. + erf((env.velocity_bins[1] - mu_max_source[1]) /
+                                      (np.sqrt(2.) * env.velocity_noise))) / 2.)
+                    else:
+                        M_P_vel[vel_prime] = (1. + erf(
+                            (env.velocity_bins[1] - env.velocity_bins[0]) /
+                            (np.sqrt(2.) * env.velocity_noise))) / 2.
+                elif vel_prime == env.velocity_reps.shape[0] - 1:
+                    eps_peak = \
+                        (env.velocity_bins[-2] - env.state_reps[s][1] +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if (eps_peak < min_power or eps_peak > max_power) and \
+                            (not (real_vel_min_source < 0 and mu_min_source[0] <=
+                                env.position_bins[1]) and
+                                 not (real_vel_max_source < 0 and mu_max_source[0] <=
+                                     env.position_bins[1])):
+                        M_e_vel[vel_prime] = max(
+                            np.exp(-(env.velocity_bins[-2] - mu_min_source[1]) ** 2 /
+                                   (2. * env.velocity_noise ** 2)),
+                            np.exp(-(env.velocity_bins[-2] - mu_max_source[1]) ** 2 /
+                                   (2. * env.velocity_noise ** 2)))
+                    else:
+                        M_e_vel[vel_prime] = 1.
+                    eps_peak = \
+                        (env.velocity_bins[-1] - env.state_reps[s][1] +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if (eps_peak < min_power or eps_peak > max_power) and \
+                            (not (real_vel_min_source < 0 and mu_min_source[0] <=
+                                env.position_bins[1]) and
+                                 not (real_vel_max_source < 0 and mu_max_source[0] <=
+                                     env.position_bins[1])):
+                        M_P_vel[vel_prime] = max(
+                            (1. - erf((env.velocity_bins[-2] - mu_min_source[1]) /
+                                      (np.sqrt(2.) * env.velocity_noise))) / 2.,
+                            (1. - erf((env.velocity_bins[-2] - mu_max_source[1]) /
+                                      (np.sqrt(2.) * env.velocity_noise))) / 2.)
+                    else:
+                        M_P_vel[vel_prime] = (1. - erf(
+                            (env.velocity_bins[-2] - env.velocity_bins[-1]) /
+                            (np.sqrt(2.) * env.velocity_noise))) / 2.
+                else:
+                    v1 = env.velocity_bins[vel_prime]
+                    v2 = env.velocity_bins[vel_prime + 1]
+                    vm = (v1 + v2) / 2.
+                    mu_peak = mu_peak_vel_e[vel_prime]
+                    if mu_peak < v1:
+                        mu_peak1 = mu_peak
+                        mu_peak2 = 2 * vm - mu_peak
+                    else:
+                        mu_peak2 = mu_peak
+                        mu_peak1 = 2 * vm - mu_peak
+                    eps_peak1 = \
+                        (mu_peak1 - env.state_reps[s][1] +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    eps_peak2 = \
+                        (mu_peak2 - env.state_reps[s][1] +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if (eps_peak1 < min_power or eps_peak1 > max_power) and (
+                            eps_peak2 < min_power or eps_peak2 > max_power) and \
+                            (not (real_vel_min_source < 0 and mu_min_source[0] ==
+                                env.position_bins[1]) and
+                                 not (real_vel_max_source < 0 and mu_max_source[0] ==
+                                     env.position_bins[1])):
+                        M_e_vel[vel_prime] = \
+                            max(np.abs(np.exp(
+                                -(v1 - mu_min_source[1]) ** 2 / (2 * env.velocity_noise ** 2)) -
+                                       np.exp(-(v2 - mu_min_source[1]) ** 2 / (
+                                       2 * env.velocity_noise ** 2))),
+                                np.abs(np.exp(-(v1 - mu_max_source[1]) ** 2 / (
+                                2 * env.velocity_noise ** 2)) -
+                                       np.exp(-(v2 - mu_max_source[1]) ** 2 / (
+                                       2 * env.velocity_noise ** 2))))
+                    else:
+                        M_e_vel[vel_prime] = \
+                            np.abs(
+                                np.exp(-(v1 - mu_peak) ** 2 / (2 * env.velocity_noise ** 2)) -
+                                np.exp(-(v2 - mu_peak) ** 2 / (2 * env.velocity_noise ** 2)))
+                    eps_peak = \
+                        (vm - env.state_reps[s][1] +
+                         env.rescale(0.0025) * math.cos(
+                             3 * env.inverse_transform(env.state_reps[s][0]))) / \
+                        env.action_reps[a]
+                    if (eps_peak < min_power or eps_peak > max_power) and \
+                            (not (real_vel_min_source < 0 and mu_min_source[0] ==
+                                env.position_bins[1]) and
+                                 not (real_vel_max_source < 0 and mu_max_source[0] ==
+                                     env.position_bins[1])):
+                        M_P_vel[vel_prime] = \
+                            max((erf(
+                                (v2 - mu_min_source[1]) / (np.sqrt(2.) * env.velocity_noise)) -
+                                 erf((v1 - mu_min_source[1]) / (
+                                 np.sqrt(2.) * env.velocity_noise))) / 2.,
+                                (erf((v2 - mu_max_source[1]) / (
+                                np.sqrt(2.) * env.velocity_noise)) -
+                                 erf((v1 - mu_max_source[1]) / (
+                                 np.sqrt(2.) * env.velocity_noise))) / 2.)
+                    else:
+                        M_P_vel[vel_prime] = \
+                            (erf((v2 - vm) / (np.sqrt(2.) * env.velocity_noise)) -
+                             erf((v1 - vm) / (np.sqrt(2.) * env.velocity_noise))) / 2.
+            L[s, a] = \
+                ((np.abs(env.action_reps[a]) / (
+                np.sqrt(2. * np.pi) * env.velocity_noise)) * M_e_vel.reshape((-1, 1)).dot(
+                    M_P_pos.reshape((1, -1))) +
+                 (np.abs(env.action_reps[a]) / (
+                 np.sqrt(2. * np.pi) * env.position_noise)) * M_P_vel.reshape((-1, 1)).dot(
+                     M_e_pos.reshape((1, -1)))).flatten()
+    return L
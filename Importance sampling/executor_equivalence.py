@@ -0,0 +1,103 @@
+import gym
+import numpy as np
+import sys
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing.dummy import Pool
+from PolicyFactoryMC import PolicyFactoryMC
+from LSTD_Q_Estimator import LSTD_Q_Estimator
+from LSTD_V_Estimator import LSTD_V_Estimator
+from MinEstimator import MinWeightsEstimator
+from MinMaxWeightsEstimator import MinMaxWeightsEstimator
+
+# Checks that the weights estimators give the same arrays and weights whether their sources are processed in turn, on
+# threads, with a cache of the Lipschitz bounds filled by threads or by processes, or from that cache once filled.
+# Usage: python executor_equivalence.py [n_bins] [n_action_bins] [n_source_samples] [n_target_samples]
+
+seed = 9876
+gamma = 0.99
+min_pos = -10.
+max_pos = 10.
+min_act = -1.
+max_act = 1.
+power_sources = [0.0025*20/1.8, 0.0015*20/1.8, 0.003*20/1.8]
+power_target = 0.002*20/1.8
+alpha_sources = [(0.63, 0.16), (0.4, 0.3), (0.2, 0.5)]
+alpha_1_target, alpha_2_target = 0.5, 0.1
+action_noise = (max_act - min_act)*0.2
+n_bins = int(sys.argv[1]) if len(sys.argv) > 1 else 20 + 1
+n_action_bins = int(sys.argv[2]) if len(sys.argv) > 2 else 10 + 1
+n_source_samples = int(sys.argv[3]) if len(sys.argv) > 3 else 3000
+n_target_samples = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+
+
+def make_task(power):
+    return gym.make('MountainCarContinuous-v0', min_position=min_pos, max_position=max_pos, min_action=min_act,
+                    max_action=max_act, power=power, seed=seed, model='S', discrete=True, n_position_bins=n_bins,
+                    n_velocity_bins=n_bins, n_action_bins=n_action_bins, position_noise=0.025, velocity_noise=0.025)
+
+
+def run(estimator_class, **kwargs):
+    weights_est = estimator_class(gamma, **kwargs)
+    weights_est.set_flags(True, True, True)
+    weights_est.add_sources([dict(ss) for ss in source_samples], source_tasks, source_policies, all_phi_Q, all_phi_V)
+    weights_est.prepare_lstd(target_policy, target_task.env.power)
+    if estimator_class is MinWeightsEstimator:
+        weights_est.prepare_gradient(target_policy, target_task.env.power, target_task.env.Q[fsi, ai], target_task.env.V[fsi])
+        A, b = lstd_q.produce_matrices(target_samples)
+        weights_q = weights_est.estimate_weights_lstdq(n_target_samples, A, b)
+        A, b = lstd_v.produce_matrices(target_samples)
+        weights_v = weights_est.estimate_weights_lstdv(n_target_samples, A, b)
+    else:
+        weights_est.prepare_gradient(target_policy, target_task.env.power, target_task.env.Q, target_task.env.V[fsi])
+        weights_q = weights_est.estimate_weights_lstdq(n_target_samples)
+        weights_v = weights_est.estimate_weights_lstdv(n_target_samples)
+    results = {k: np.array(v) for k, v in vars(weights_est).items() if isinstance(v, np.ndarray)}
+    results['weights Q'] = np.asarray(weights_q)
+    results['weights V'] = np.asarray(weights_v)
+    return results
+
+
+if __name__ == '__main__':
+    source_tasks = [make_task(power) for power in power_sources]
+    target_task = make_task(power_target)
+    pf = PolicyFactoryMC(model='S', action_noise=action_noise, max_speed=target_task.env.max_speed, min_act=min_act,
+                         max_act=max_act, action_bins=target_task.env.action_bins, action_reps=target_task.env.action_reps,
+                         state_reps=target_task.env.state_reps, state_to_idx=target_task.env.state_to_idx)
+    source_policies = [pf.create_policy(alpha_1, alpha_2) for alpha_1, alpha_2 in alpha_sources]
+    target_policy = pf.create_policy(alpha_1_target, alpha_2_target)
+    lstd_q = LSTD_Q_Estimator(3, 3, 3, 0.4, True, gamma, 0., min_pos, max_pos, target_task.env.min_speed,
+                              target_task.env.max_speed, min_act, max_act)
+    lstd_v = LSTD_V_Estimator(3, 3, 0.4, True, gamma, 0., min_pos, max_pos, target_task.env.min_speed,
+                              target_task.env.max_speed)
+    np.random.seed(seed)
+    source_samples = []
+    for source_task, source_policy in zip(source_tasks, source_policies):
+        source_task.env.set_policy(source_policy, gamma)
+        source_samples.append(source_task.env.sample_step(n_source_samples))
+    target_task.env.set_policy(target_policy, gamma)
+    target_samples = target_task.env.sample_step(n_target_samples)
+    all_phi_Q = lstd_q.set_grid(target_task.env.state_reps, target_task.env.action_reps)
+    all_phi_V = lstd_v.set_grid(target_task.env.state_reps)
+    fsi = np.concatenate([ss['fsi'] for ss in source_samples])
+    ai = np.concatenate([ss['ai'] for ss in source_samples])
+
+    all_equal = True
+    for estimator_class in [MinWeightsEstimator, MinMaxWeightsEstimator]:
+        serial = run(estimator_class)
+        cache_dirs = [tempfile.mkdtemp() for _ in range(3)]
+        with ThreadPoolExecutor(4) as thread_executor, Pool(3) as thread_pool, ProcessPoolExecutor(2) as process_executor:
+            for name, kwargs in [('threads', dict(executor=thread_executor)),
+                                 ('threads, cache', dict(executor=thread_executor, cache_dir=cache_dirs[0])),
+                                 ('thread pool, cache', dict(executor=thread_pool, cache_dir=cache_dirs[1])),
+                                 ('processes, cache', dict(executor=thread_executor, process_executor=process_executor,
+                                                           cache_dir=cache_dirs[2])),
+                                 ('filled cache', dict(cache_dir=cache_dirs[2]))]:
+                results = run(estimator_class, **kwargs)
+                differing = [k for k in serial if not np.array_equal(serial[k], results[k])]
+                all_equal = all_equal and not differing
+                print('{0:<24} {1:<18} differing arrays: {2}'.format(estimator_class.__name__, name, differing))
+        for cache_dir in cache_dirs:
+            shutil.rmtree(cache_dir)
+    sys.exit(0 if all_equal else 1)
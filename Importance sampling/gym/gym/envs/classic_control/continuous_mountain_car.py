@@ -21,7 +21,14 @@ from gym.utils import seeding
 import numpy as np
 from scipy.stats import norm, beta
 from scipy.special import erf
+from scipy import sparse
+from scipy.linalg import lu_factor, lu_solve
+from scipy.sparse.linalg import splu, gmres, bicgstab, LinearOperator
 import time
+import os
+import hashlib
+import warnings
+from collections import OrderedDict
 import multiprocessing as mp
 import multiprocessing.sharedctypes as sct
 from multiprocessing.dummy import Pool
@@ -31,12 +38,15 @@ class Continuous_MountainCarEnv(gym.Env):
         'render.modes': ['human', 'rgb_array'],
         'video.frames_per_second': 30
     }
+    # Part of the model cache key, bumped whenever the way the model matrices are built changes
+    model_version = 2
 
 
 
     def __init__(self, min_position=-1.2, max_position=0.6, min_action=-1.0, max_action=1.0, power=0.0015, position_noise=0.01,
                  velocity_noise=0.01, seed=None, model='G', discrete=False, n_position_bins=None, n_velocity_bins=None,
-                 n_action_bins=None):
+                 n_action_bins=None, transition_format='dense', transition_tol=1e-12, solver=None, solver_tol=1e-10,
+                 policy_cache_size=8, sampler='cdf', cache_dir=None, dtype=np.float64):
         self.min_action = min_action
         self.max_action = max_action
         self.min_position = min_position
@@ -57,6 +67,39 @@ class Continuous_MountainCarEnv(gym.Env):
         self.n_position_bins = n_position_bins
         self.n_velocity_bins = n_velocity_bins
         self.n_action_bins = n_action_bins
+        # 'dense' keeps the (S, A, S) transition_matrix, 'sparse' keeps a CSR matrix with one row per (s, a) pair
+        # (row s*A + a) where entries below transition_tol are dropped and the rows renormalized, 'factored' keeps the
+        # (S, A, n_pos) position_factor and (S, A, n_vel) velocity_factor whose outer product gives each row
+        assert transition_format in ['dense', 'sparse', 'factored']
+        self.transition_format = transition_format
+        self.transition_tol = transition_tol
+        # Linear solver used by set_policy: 'lu' factorizes the dense system, 'sparse' uses a sparse LU, 'gmres' and
+        # 'bicgstab' only need mat-vecs with the transition model
+        if solver is None:
+            solver = 'sparse' if transition_format == 'sparse' else 'lu'
+        assert solver in ['lu', 'sparse', 'gmres', 'bicgstab']
+        self.solver = solver
+        self.solver_tol = solver_tol
+        self.solver_iterations = 0
+        self.evaluation_guess = None
+        # 'cdf' inverts cumulative sums of the sampled rows, 'alias' uses Walker alias tables, built once for the
+        # transition model and at every set_policy for the policy. The cumulative sums of the transition model are
+        # also tabulated once, at the first draw
+        assert sampler in ['cdf', 'alias']
+        self.sampler = sampler
+        self.transition_cdf = None
+        self.transition_alias = None
+        self.policy_alias = None
+        # Results of set_policy for the last policy_cache_size policies, least recently used first
+        self.policy_cache_size = policy_cache_size
+        self.policy_cache = OrderedDict()
+        self.policy_cache_hits = 0
+        self.policy_cache_misses = 0
+        # Directory where the model matrices are stored as .npy files under a hash of the env parameters, so later
+        # constructions of the same env memory-map them instead of rebuilding them
+        self.cache_dir = cache_dir
+        # Storage precision of the transition and reward model, R and everything set_policy solves stay in float64
+        self.dtype = np.dtype(dtype)
         if self.discrete:
             assert self.model == 'S' and self.n_position_bins is not None and self.n_velocity_bins is not None and self.n_action_bins is not None
             self.position_bins = np.linspace(self.min_position, self.max_position, self.n_position_bins)
@@ -101,7 +144,7 @@ class Continuous_MountainCarEnv(gym.Env):
             state_idx = self.state_to_idx[self.state[0]][self.state[1]]
             action_idx = self.action_to_idx[action[0]]
             next_state = np.random.choice(np.arange(self.state_reps.shape[0]),
-                                          p=self.transition_matrix[state_idx, action_idx, :])
+                                          p=self.transition_rows(np.array([state_idx]), np.array([action_idx]))[0])
             next_state = self.state_reps[next_state]
         else:
             next_state = self.clean_step(self.state, action)
@@ -117,6 +160,27 @@ class Continuous_MountainCarEnv(gym.Env):
 
 
 
+    def step_idx(self, state_idx, action_idx):
+        # _step on state and action indices, which skips the float-keyed lookups and the checks of np.random.choice
+        next_state_idx, reward, done = self.step_many(np.array([state_idx]), np.array([action_idx]))
+        self.state = self.state_reps[next_state_idx[0]].copy()
+        return next_state_idx[0], reward[0], bool(done[0]), {}
+
+
+
+    def step_many(self, state_idx, action_idx):
+        # One transition for each of the (state_idx[i], action_idx[i]) pairs, drawn with the same sampler as sample_step
+        state_idx = np.asarray(state_idx, dtype=np.int64)
+        action_idx = np.asarray(action_idx, dtype=np.int64)
+        next_state_idx = self.sample_next_states(state_idx, action_idx)
+        # reward_model returns a scalar on a single pair
+        rewards = np.atleast_1d(self.reward_model(self.state_reps[state_idx], self.action_reps[action_idx].reshape((-1, 1)),
+                                                  self.state_reps[next_state_idx]))
+        done = self.state_reps[next_state_idx, 0] >= self.goal_position
+        return next_state_idx, rewards, done
+
+
+
     def _height(self, xs):
         return np.sin(3 * xs)*.45+.55
 
@@ -256,18 +320,357 @@ class Continuous_MountainCarEnv(gym.Env):
 
 
 
-    def set_policy(self, policy, gamma):
+    def set_policy(self, policy, gamma, warm_start=False):
+        key = (policy.alpha1, policy.alpha2, policy.factory.action_noise, self.power, self.position_noise, self.velocity_noise, gamma)
         self.policy = policy
-        P_pi = np.transpose(self.transition_matrix, axes=(2, 0, 1)).copy()
-        P_pi = (P_pi * policy.choice_matrix).sum(axis=2).T
-        self.P_pi_inv = np.linalg.inv(np.eye(self.transition_matrix.shape[0]) - gamma * P_pi)
-        self.P_inf = (1. - gamma) * self.P_pi_inv.T.dot(np.ones(self.P_pi_inv.shape[0], dtype=np.float64))
-        self.delta_distr = (1. - gamma) * self.P_pi_inv.T.dot(self.initial_state_distr)
-        self.zeta_distr = (policy.choice_matrix.T * self.delta_distr).T
+        self.gamma = gamma
+        self.policy_key = key
+        self.solver_iterations = 0
+        if key in self.policy_cache:
+            self.policy_cache_hits += 1
+            entry = self.policy_cache.pop(key)
+            self.policy_cache[key] = entry
+            for k, v in entry.items():
+                setattr(self, k, v)
+            return
+        self.policy_cache_misses += 1
+        self._P_pi_inv = None
+        # A warm start restarts a Krylov solver from the previous solutions, which is much cheaper than a
+        # factorization when the policy only moved a little
+        warm_start = warm_start and self.evaluation_guess is not None
+        if warm_start:
+            self.evaluation_method = self.solver if self.solver in ['gmres', 'bicgstab'] else 'gmres'
+        else:
+            self.evaluation_method = self.solver
+        self.factorize_evaluation()
         R_pi = (self.R* policy.choice_matrix).sum(axis=1)
-        self.V = self.P_pi_inv.dot(R_pi)
+        aux = self.solve_evaluation(np.vstack((np.ones(self.state_reps.shape[0], dtype=np.float64), self.initial_state_distr)).T,
+                                    transpose=True, x0=self.evaluation_guess[1] if warm_start else None)
+        self.P_inf = (1. - gamma) * aux[:, 0]
+        self.delta_distr = (1. - gamma) * aux[:, 1]
+        if self.dtype != np.float64:
+            # A float32 model is only stochastic up to rounding, which the solve amplifies by 1/(1 - gamma)
+            self.delta_distr /= self.delta_distr.sum()
+        self.V = self.solve_evaluation(R_pi, x0=self.evaluation_guess[0] if warm_start else None)
+        self.evaluation_guess = (self.V, aux)
+        self.zeta_distr = (policy.choice_matrix.T * self.delta_distr).T
+        if self.sampler == 'alias':
+            self.policy_alias = self.alias_tables(policy.choice_matrix)
         self.J = self.V.dot(self.initial_state_distr)
-        self.Q = self.R + gamma*(self.transition_matrix*self.V).sum(axis=2)
+        self.Q = self.R + gamma*self.transition_dot(self.V)
+        if self.policy_cache_size > 0:
+            self.policy_cache[key] = {k: getattr(self, k) for k in ['V', 'Q', 'J', 'P_inf', 'delta_distr', 'zeta_distr',
+                                                                    'evaluation_method', 'evaluation_factor', '_P_pi_inv',
+                                                                    'policy_alias']}
+            if len(self.policy_cache) > self.policy_cache_size:
+                self.policy_cache.popitem(last=False)
+
+
+
+    def evaluate_policies(self, policy_factory, alphas, gamma, return_zeta=False, batch_size=32):
+        # J and V (and zeta_distr) of every policy in alphas without touching the current policy. The dense solvers
+        # factorize a whole batch of systems at once, the others go one policy at a time
+        choice_matrices = policy_factory.build_choice_matrices(alphas)
+        n_policies = choice_matrices.shape[0]
+        n_states = self.state_reps.shape[0]
+        V = np.zeros((n_policies, n_states), dtype=np.float64)
+        delta_distr = np.zeros((n_policies, n_states), dtype=np.float64)
+        R_pi = (self.R * choice_matrices).sum(axis=2)
+        if self.solver == 'lu':
+            for start in range(0, n_policies, batch_size):
+                end = min(start + batch_size, n_policies)
+                if self.transition_format == 'dense':
+                    P_pi = np.einsum('nsa,sap->nsp', choice_matrices[start:end], self.transition_matrix, dtype=np.float64)
+                else:
+                    P_pi = np.stack([self.policy_transition_matrix(choice_matrices[k], dense=True) for k in range(start, end)])
+                A = np.eye(n_states) - gamma * P_pi
+                del P_pi
+                V[start:end] = np.linalg.solve(A, R_pi[start:end, :, None])[:, :, 0]
+                aux = np.broadcast_to(self.initial_state_distr[None, :, None], (end - start, n_states, 1))
+                delta_distr[start:end] = np.linalg.solve(np.transpose(A, axes=(0, 2, 1)), aux)[:, :, 0]
+                del A, aux
+        else:
+            for k in range(n_policies):
+                P_pi = sparse.csc_matrix(self.policy_transition_matrix(choice_matrices[k]))
+                lu = splu(sparse.identity(n_states, format='csc') - gamma * P_pi)
+                V[k] = lu.solve(R_pi[k])
+                delta_distr[k] = lu.solve(self.initial_state_distr, trans='T')
+        delta_distr *= 1. - gamma
+        J = V.dot(self.initial_state_distr)
+        if return_zeta:
+            return J, V, choice_matrices * delta_distr[:, :, None]
+        return J, V
+
+
+
+    def clear_policy_cache(self):
+        self.policy_cache.clear()
+        self.policy_cache_hits = 0
+        self.policy_cache_misses = 0
+
+
+
+    @property
+    def P_pi_inv(self):
+        # (I - gamma*P_pi)^-1 of the current policy, only built when somebody asks for it
+        if self._P_pi_inv is None:
+            P_pi = self.policy_transition_matrix(self.policy.choice_matrix, dense=True)
+            self._P_pi_inv = np.linalg.inv(np.eye(self.state_reps.shape[0]) - self.gamma * P_pi)
+            if self.policy_key in self.policy_cache:
+                self.policy_cache[self.policy_key]['_P_pi_inv'] = self._P_pi_inv
+        return self._P_pi_inv
+
+
+
+    def factorize_evaluation(self):
+        n_states = self.state_reps.shape[0]
+        if self.evaluation_method == 'lu':
+            P_pi = self.policy_transition_matrix(self.policy.choice_matrix, dense=True)
+            self.evaluation_factor = lu_factor(np.eye(n_states) - self.gamma * P_pi)
+        elif self.evaluation_method == 'sparse':
+            P_pi = sparse.csc_matrix(self.policy_transition_matrix(self.policy.choice_matrix))
+            self.evaluation_factor = splu(sparse.identity(n_states, format='csc') - self.gamma * P_pi)
+        else:
+            self.evaluation_factor = None
+
+
+
+    def solve_evaluation(self, b, transpose=False, x0=None):
+        # Solves (I - gamma*P_pi) x = b, or its transpose, for the policy passed to set_policy, x0 being only used by
+        # the iterative solvers
+        if self.evaluation_method == 'lu':
+            return lu_solve(self.evaluation_factor, b, trans=1 if transpose else 0)
+        if self.evaluation_method == 'sparse':
+            return self.evaluation_factor.solve(b, trans='T' if transpose else 'N')
+        choice_matrix = self.policy.choice_matrix
+        if transpose:
+            def matvec(x):
+                return x.ravel() - self.gamma * self.transition_rdot(choice_matrix * x.reshape((-1, 1)))
+        else:
+            def matvec(x):
+                return x.ravel() - self.gamma * (self.transition_dot(x.ravel()) * choice_matrix).sum(axis=1)
+        A = LinearOperator((self.state_reps.shape[0], self.state_reps.shape[0]), matvec=matvec, dtype=np.float64)
+        if b.ndim == 1:
+            return self.iterative_solve(A, b, x0=x0)
+        return np.column_stack([self.iterative_solve(A, b[:, k], x0=None if x0 is None else x0[:, k]) for k in range(b.shape[1])])
+
+
+
+    def iterative_solve(self, A, b, method=None, x0=None):
+        if method is None:
+            method = self.evaluation_method
+
+        def count(_):
+            self.solver_iterations += 1
+
+        try:
+            if method == 'gmres':
+                x, info = gmres(A, b, x0=x0, rtol=self.solver_tol, atol=0., restart=min(100, b.shape[0]), callback=count,
+                                callback_type='pr_norm')
+            else:
+                x, info = bicgstab(A, b, x0=x0, rtol=self.solver_tol, atol=0., callback=count)
+        except TypeError:
+            if method == 'gmres':
+                x, info = gmres(A, b, x0=x0, tol=self.solver_tol, restart=min(100, b.shape[0]), callback=count)
+            else:
+                x, info = bicgstab(A, b, x0=x0, tol=self.solver_tol, callback=count)
+        if info < 0 and method == 'bicgstab':
+            # BiCGSTAB breaks down on some of the transposed systems, GMRES does not
+            return self.iterative_solve(A, b, method='gmres', x0=x0)
+        if info != 0:
+            warnings.warn('%s did not converge in set_policy (info=%d)' % (method, info))
+        return x
+
+
+
+    def policy_transition_matrix(self, choice_matrix, dense=False):
+        # sum_a w(s,a) P(s'|s,a), choice_matrix can be any (S, A) weighting
+        if self.transition_format == 'sparse':
+            n_states, n_actions = choice_matrix.shape
+            W = sparse.csr_matrix((choice_matrix.ravel().astype(np.float64), (np.repeat(np.arange(n_states), n_actions), np.arange(n_states*n_actions))),
+                                  shape=(n_states, n_states*n_actions))
+            P_pi = W.dot(self.sparse_transition_matrix).tocsr()
+            return P_pi.toarray() if dense else P_pi
+        if self.transition_format == 'factored':
+            return np.einsum('sa,sap,sav->svp', choice_matrix, self.position_factor, self.velocity_factor,
+                             dtype=np.float64).reshape((self.state_reps.shape[0], -1))
+        P_pi = np.transpose(self.transition_matrix, axes=(2, 0, 1)).copy()
+        return (P_pi * choice_matrix).sum(axis=2, dtype=np.float64).T
+
+
+
+    def transition_dot(self, x):
+        # sum_s' P(s'|s,a) x(s') for every (s, a)
+        if self.transition_format == 'sparse':
+            return self.sparse_transition_matrix.dot(x).reshape((self.state_reps.shape[0], self.action_reps.shape[0]))
+        if self.transition_format == 'factored':
+            x = x.reshape((self.velocity_reps.shape[0], self.position_reps.shape[0]))
+            return (self.velocity_factor.dot(x) * self.position_factor).sum(axis=2)
+        return (self.transition_matrix*x).sum(axis=2)
+
+
+
+    def transition_rdot(self, w):
+        # sum_{s,a} w(s,a) P(s'|s,a) for every s'
+        if self.transition_format == 'sparse':
+            return self.sparse_transition_matrix.T.dot(w.ravel())
+        if self.transition_format == 'factored':
+            return np.einsum('sa,sap,sav->vp', w, self.position_factor, self.velocity_factor).ravel()
+        return (self.transition_matrix*w[:, :, None]).sum(axis=(0, 1))
+
+
+
+    def transition_probs(self, state_idx, action_idx, next_state_idx):
+        state_idx, action_idx, next_state_idx = np.broadcast_arrays(state_idx, action_idx, next_state_idx)
+        if self.transition_format == 'sparse':
+            rows = (state_idx * self.action_reps.shape[0] + action_idx).ravel()
+            probs = np.asarray(self.sparse_transition_matrix[rows, next_state_idx.ravel()]).ravel()
+            return probs.reshape(state_idx.shape)
+        if self.transition_format == 'factored':
+            n_pos = self.position_reps.shape[0]
+            return self.position_factor[state_idx, action_idx, next_state_idx % n_pos] * \
+                   self.velocity_factor[state_idx, action_idx, next_state_idx // n_pos]
+        return self.transition_matrix[state_idx, action_idx, next_state_idx]
+
+
+
+    def transition_rows(self, state_idx, action_idx):
+        if self.transition_format == 'sparse':
+            return self.sparse_transition_matrix[state_idx * self.action_reps.shape[0] + action_idx].toarray()
+        if self.transition_format == 'factored':
+            rows = self.velocity_factor[state_idx, action_idx, :, None] * self.position_factor[state_idx, action_idx, None, :]
+            return rows.reshape(rows.shape[:-2] + (-1,))
+        return self.transition_matrix[state_idx, action_idx, :]
+
+
+
+    def transition_tensor(self):
+        # Full (S, A, S) tensor, only for the callers that genuinely need every entry
+        if self.transition_format == 'sparse':
+            return self.sparse_transition_matrix.toarray().reshape(self.transition_shape)
+        if self.transition_format == 'factored':
+            return self.transition_rows(np.arange(self.state_reps.shape[0])[:, None], np.arange(self.action_reps.shape[0])[None, :])
+        return self.transition_matrix
+
+
+
+    def reward_tensor(self):
+        # Full (S, A, S) reward tensor matching transition_tensor, the same in every format, including the entries where
+        # P is 0 (MinMaxWeightsEstimator weighs them by bounds that are not)
+        if self.transition_format == 'sparse':
+            # r only holds the rewards on the support of the transition matrix, the other ones are rebuilt here
+            return self.reward_table(self.state_reps[:, 0]).astype(self.dtype, copy=False)
+        if self.transition_format == 'factored':
+            return self.position_r[:, :, np.arange(self.state_reps.shape[0]) % self.position_reps.shape[0]]
+        return self.r
+
+
+
+    def alias_tables(self, probs):
+        # Walker alias tables of every row of probs (Vose's construction). Each row is sorted once, then the smallest
+        # unprocessed entry is topped up by the current largest one, so all rows advance together in k - 1 steps
+        probs = probs.reshape((-1, probs.shape[-1]))
+        n_rows, k = probs.shape
+        order = np.argsort(probs, axis=1, kind='mergesort')
+        rows = np.arange(n_rows)
+        q = probs[rows[:, None], order] * (k / probs.sum(axis=1))[:, None]
+        accept = np.ones((n_rows, k), dtype=np.float64)
+        alias = np.tile(np.arange(k), (n_rows, 1))
+        small = np.zeros(n_rows, dtype=np.int64)
+        large = np.full(n_rows, k - 1, dtype=np.int64)
+        for _ in range(k - 1):
+            # Once the current large entry drops below 1 it is the one to be topped up, by the next largest
+            large_done = q[rows, large] < 1.
+            donor = large - large_done
+            taker = np.where(large_done, large, small)
+            accept[rows, taker] = q[rows, taker]
+            alias[rows, taker] = donor
+            q[rows, donor] -= 1. - q[rows, taker]
+            small += np.logical_not(large_done)
+            large -= large_done
+        sorted_accept = accept
+        accept = np.empty_like(sorted_accept)
+        accept[rows[:, None], order] = np.clip(sorted_accept, 0., 1.)
+        alias_idx = np.empty_like(alias)
+        alias_idx[rows[:, None], order] = order[rows[:, None], alias]
+        return accept, alias_idx
+
+
+
+    def alias_sample(self, tables, rows, samps=None):
+        # One uniform per draw, its integer part picks the column and its fractional part the coin
+        accept, alias = tables
+        if samps is None:
+            samps = np.random.random_sample(rows.shape[0])
+        u = samps * accept.shape[1]
+        cols = np.minimum(u.astype(np.int64), accept.shape[1] - 1)
+        return np.where(u - cols < accept[rows, cols], cols, alias[rows, cols])
+
+
+
+    def build_transition_alias(self):
+        if self.transition_format == 'factored':
+            self.transition_alias = (self.alias_tables(self.position_factor), self.alias_tables(self.velocity_factor))
+        elif self.transition_format == 'dense':
+            self.transition_alias = self.alias_tables(self.transition_matrix)
+
+
+
+    def build_transition_cdf(self):
+        # Cumulative sums of every row of the dense or factored transition model, in its storage dtype as the per-draw
+        # sums were
+        if self.transition_format == 'factored':
+            self.transition_cdf = (self.position_factor.cumsum(axis=2), self.velocity_factor.cumsum(axis=2))
+        elif self.transition_format == 'dense':
+            self.transition_cdf = self.transition_matrix.cumsum(axis=2)
+
+
+
+    def cdf_sample(self, cdf, state_idx, action_idx, samps):
+        # Number of entries of each row cdf[state_idx[i], action_idx[i]] not above samps[i], capped to the last column,
+        # by a binary search of all the rows at once
+        k = cdf.shape[2]
+        lo = np.zeros(state_idx.shape[0], dtype=np.int64)
+        hi = np.full(state_idx.shape[0], k, dtype=np.int64)
+        for _ in range(int(np.ceil(np.log2(k + 1)))):
+            mid = (lo + hi) // 2
+            below = cdf[state_idx, action_idx, np.minimum(mid, k - 1)] <= samps
+            searching = lo < hi
+            lo = np.where(np.logical_and(searching, below), mid + 1, lo)
+            hi = np.where(np.logical_and(searching, np.logical_not(below)), mid, hi)
+        return np.minimum(lo, k - 1)
+
+
+
+    def sample_next_states(self, state_idx, action_idx, samps=None):
+        # samps holds the uniforms to use, one row per draw made for each sample (two in the factored format)
+        n_draws = 2 if self.transition_format == 'factored' else 1
+        if samps is None:
+            samps = np.random.random_sample((n_draws, state_idx.shape[0]))
+        if self.sampler == 'alias' and self.transition_format != 'sparse':
+            if self.transition_alias is None:
+                self.build_transition_alias()
+            rows = state_idx * self.action_reps.shape[0] + action_idx
+            if self.transition_format == 'factored':
+                pos_idx = self.alias_sample(self.transition_alias[0], rows, samps[0])
+                vel_idx = self.alias_sample(self.transition_alias[1], rows, samps[1])
+                return vel_idx * self.position_reps.shape[0] + pos_idx
+            return self.alias_sample(self.transition_alias, rows, samps[0])
+        if self.transition_format == 'sparse':
+            # Rows are contiguous in the CSR data, so row + cdf is increasing and one searchsorted serves all rows
+            rows = state_idx * self.action_reps.shape[0] + action_idx
+            pos = np.searchsorted(self.sparse_transition_cdf, rows + samps[0], side='right')
+            pos = np.minimum(pos, self.sparse_transition_matrix.indptr[rows + 1] - 1)
+            return self.sparse_transition_matrix.indices[pos].astype(np.int64)
+        if self.transition_cdf is None:
+            self.build_transition_cdf()
+        if self.transition_format == 'factored':
+            # Position and velocity are independent given (s, a), so each is drawn from its own marginal
+            pos_idx = self.cdf_sample(self.transition_cdf[0], state_idx, action_idx, samps[0])
+            vel_idx = self.cdf_sample(self.transition_cdf[1], state_idx, action_idx, samps[1])
+            return vel_idx * self.position_reps.shape[0] + pos_idx
+        # Rows stored in float32 can sum to slightly less than 1, hence the cap to the last state
+        return self.cdf_sample(self.transition_cdf, state_idx, action_idx, samps[0])
 
 
 
@@ -281,16 +684,57 @@ class Continuous_MountainCarEnv(gym.Env):
         idx = np.random.choice(self.zeta_distr.size, p=self.zeta_distr.flatten(), size=n_samples)
         state_idx = (idx / self.action_reps.shape[0]).astype(np.int64)
         action_idx = (idx % self.action_reps.shape[0]).astype(np.int64)
-        first_states = self.state_reps[state_idx]
-        actions = self.action_reps[action_idx].reshape((-1,1))
-        cum_p = np.hstack((np.zeros((n_samples, 1), dtype=np.float64), self.transition_matrix[state_idx,action_idx,:].cumsum(axis=1)))
-        samps = np.random.random_sample(n_samples).reshape((-1,1))
-        next_state_idx = (cum_p <= samps).sum(axis=1) - 1
+        next_state_idx = self.sample_next_states(state_idx, action_idx)
         #assert np.all(next_state_idx >= 0)
-        cum_p = np.hstack((np.zeros((n_samples, 1), dtype=np.float64), self.policy.choice_matrix[next_state_idx, :].cumsum(axis=1)))
-        samps = np.random.random_sample(n_samples).reshape((-1, 1))
-        next_action_idx = (cum_p <= samps).sum(axis=1) - 1
+        next_action_idx = self.sample_next_actions(next_state_idx)
         #assert np.all(next_action_idx >= 0)
+        return self.make_samples(state_idx, action_idx, next_state_idx, next_action_idx)
+
+
+
+    def iter_sample_steps(self, n_samples, chunk_size):
+        # Yields the samples of sample_step(n_samples) in blocks of at most chunk_size. sample_step consumes the
+        # global generator one kind of draw at a time, so each kind reads its own copy of the generator advanced to
+        # where sample_step would have started it, and the concatenated blocks are the same samples
+        n_draws = [1, 2 if self.transition_format == 'factored' else 1, 1]
+        generator = np.random.RandomState()
+        generator.set_state(np.random.get_state())
+        streams = []
+        for d in range(sum(n_draws)):
+            stream = np.random.RandomState()
+            stream.set_state(generator.get_state())
+            streams.append(stream)
+            for start in range(0, n_samples, chunk_size):
+                generator.random_sample(min(chunk_size, n_samples - start))
+        # The global generator ends up where sample_step would leave it
+        np.random.set_state(generator.get_state())
+        del generator
+        for start in range(0, n_samples, chunk_size):
+            size = min(chunk_size, n_samples - start)
+            idx = streams[0].choice(self.zeta_distr.size, p=self.zeta_distr.flatten(), size=size)
+            state_idx = (idx / self.action_reps.shape[0]).astype(np.int64)
+            action_idx = (idx % self.action_reps.shape[0]).astype(np.int64)
+            samps = np.vstack([streams[1 + d].random_sample(size) for d in range(n_draws[1])])
+            next_state_idx = self.sample_next_states(state_idx, action_idx, samps)
+            next_action_idx = self.sample_next_actions(next_state_idx, streams[-1].random_sample(size))
+            yield self.make_samples(state_idx, action_idx, next_state_idx, next_action_idx)
+
+
+
+    def sample_next_actions(self, next_state_idx, samps=None):
+        if samps is None:
+            samps = np.random.random_sample(next_state_idx.shape[0])
+        if self.sampler == 'alias':
+            return self.alias_sample(self.policy_alias, next_state_idx, samps)
+        cum_p = np.hstack((np.zeros((next_state_idx.shape[0], 1), dtype=np.float64), self.policy.choice_matrix[next_state_idx, :].cumsum(axis=1)))
+        # Rows stored in float32 can sum to slightly less than 1
+        return np.minimum((cum_p <= samps.reshape((-1, 1))).sum(axis=1) - 1, cum_p.shape[1] - 2)
+
+
+
+    def make_samples(self, state_idx, action_idx, next_state_idx, next_action_idx):
+        first_states = self.state_reps[state_idx]
+        actions = self.action_reps[action_idx].reshape((-1,1))
         next_states = self.state_reps[next_state_idx]
         next_actions = self.action_reps[next_action_idx].reshape((-1,1))
         rewards = self.reward_model(first_states, actions, next_states)
@@ -396,48 +840,56 @@ class Continuous_MountainCarEnv(gym.Env):
 
     def build_model_matrices(self):
         self.state_reps = np.dstack(np.meshgrid(self.position_reps, self.velocity_reps)).reshape(-1, 2)
-        self.transition_matrix = np.zeros((self.state_reps.shape[0], self.action_reps.shape[0], self.state_reps.shape[0]), dtype=np.float64)
-        self.R = np.zeros((self.transition_matrix.shape[0], self.transition_matrix.shape[1]), dtype=np.float64)
         self.state_to_idx = {self.position_reps[i]:
                                  {self.velocity_reps[j]:i + j*self.position_reps.shape[0]
                                   for j in range(self.velocity_reps.shape[0])}
                              for i in range(self.position_reps.shape[0])}
         self.action_to_idx = {self.action_reps[i]:i for i in range(self.action_reps.shape[0])}
+        self.transition_shape = (self.state_reps.shape[0], self.action_reps.shape[0], self.state_reps.shape[0])
+        if self.cache_dir is not None and self.load_model_matrices():
+            return
         idx_grid = np.dstack(np.meshgrid(np.arange(self.state_reps.shape[0]), np.arange(self.action_reps.shape[0]), indexing='ij')).reshape(-1, 2)
         mu = self.clean_step(self.state_reps[idx_grid[:, 0]],
                              self.action_reps[idx_grid[:, 1]].reshape((-1, 1))).reshape((self.state_reps.shape[0], self.action_reps.shape[0], 2))
-        pos_mask_1 = np.arange(self.state_reps.shape[0]) % self.position_reps.shape[0] == 0
-        self.transition_matrix[:,:,pos_mask_1] = np.dstack([(1 + erf((self.position_bins[1] - mu[:,:,0])/(self.position_noise*np.sqrt(2.))))/2.]*pos_mask_1.sum())
-        pos_mask_2 = np.arange(self.state_reps.shape[0]) % self.position_reps.shape[0] == self.position_reps.shape[0] - 1
-        self.transition_matrix[:,:,pos_mask_2] = np.dstack([(1 - erf((self.position_bins[-2] - mu[:, :, 0]) / (self.position_noise * np.sqrt(2.)))) / 2.] * pos_mask_2.sum())
-        pos_mask_3 = np.logical_not(np.logical_or(pos_mask_1, pos_mask_2))
-        mu_pos_rep = np.dstack([mu[:,:,0]]*pos_mask_3.sum())
-        pos_bins_rep_right = np.tile(self.position_bins[2:-1], self.velocity_reps.shape[0])
-        pos_bins_rep_left = np.tile(self.position_bins[1:-2], self.velocity_reps.shape[0])
-        self.transition_matrix[:, :, pos_mask_3] = (erf((pos_bins_rep_right - mu_pos_rep) / (self.position_noise * np.sqrt(2.))) - erf((pos_bins_rep_left - mu_pos_rep) / (self.position_noise * np.sqrt(2.))))/ 2.
-        del pos_mask_1, pos_mask_2, pos_mask_3, mu_pos_rep, pos_bins_rep_right, pos_bins_rep_left
-
-        vel_mask_1 = (np.arange(self.state_reps.shape[0]) / self.position_reps.shape[0]).astype(np.int64) == 0
-        self.transition_matrix[:, :, vel_mask_1] *= np.dstack([(1 + erf((self.velocity_bins[1] - mu[:, :, 1]) / (self.velocity_noise * np.sqrt(2.)))) / 2.] * vel_mask_1.sum())
-        vel_mask_2 = (np.arange(self.state_reps.shape[0]) / self.position_reps.shape[0]).astype(np.int64) == self.position_reps.shape[0] - 1
-        self.transition_matrix[:, :, vel_mask_2] *= np.dstack([(1 - erf((self.velocity_bins[-2] - mu[:, :, 1]) / (self.velocity_noise * np.sqrt(2.)))) / 2.] * vel_mask_2.sum())
-        vel_mask_3 = np.logical_not(np.logical_or(vel_mask_1, vel_mask_2))
-        mu_vel_rep = np.dstack([mu[:, :, 1]] * vel_mask_3.sum())
-        vel_bins_rep_right = np.repeat(self.velocity_bins[2:-1], self.position_reps.shape[0])
-        vel_bins_rep_left = np.repeat(self.velocity_bins[1:-2], self.position_reps.shape[0])
-        self.transition_matrix[:, :, vel_mask_3] *= (erf((vel_bins_rep_right - mu_vel_rep) / (self.velocity_noise * np.sqrt(2.))) - erf((vel_bins_rep_left - mu_vel_rep) / (self.velocity_noise * np.sqrt(2.)))) / 2.
-        del vel_mask_1, vel_mask_2, vel_mask_3, mu_vel_rep, vel_bins_rep_right, vel_bins_rep_left, mu
-
-        goal_pos_mask = self.state_reps[:,0] >= self.goal_position
-        aux = np.eye(self.state_reps.shape[0], dtype=np.float64)[goal_pos_mask,:]
-        self.transition_matrix[goal_pos_mask,:,:] = np.transpose(np.dstack([aux]*self.action_reps.shape[0]), axes=(0,2,1))
-        del goal_pos_mask, aux
-
-        idx_cube = np.dstack(np.meshgrid(np.arange(idx_grid.shape[0]), np.arange(self.state_reps.shape[0]), indexing='ij')).reshape(-1, 2)
-        idx_cube = np.hstack((idx_grid[idx_cube[:,0]], idx_cube[:,1].reshape(-1,1)))
-        self.r = self.reward_model(self.state_reps[idx_cube[:,0]], self.action_reps[idx_cube[:,1]].reshape((-1,1)), self.state_reps[idx_cube[:,2]]).reshape(self.transition_matrix.shape)
-        self.R = (self.r * self.transition_matrix).sum(axis=2)
-        del idx_grid, idx_cube
+        if self.transition_format == 'sparse':
+            self.build_sparse_model_matrices(mu)
+            del idx_grid, mu
+        elif self.transition_format == 'factored':
+            self.build_factored_model_matrices(mu)
+            del idx_grid, mu
+        else:
+            self.transition_matrix = np.zeros((self.state_reps.shape[0], self.action_reps.shape[0], self.state_reps.shape[0]), dtype=np.float64)
+            self.R = np.zeros((self.transition_matrix.shape[0], self.transition_matrix.shape[1]), dtype=np.float64)
+            pos_mask_1 = np.arange(self.state_reps.shape[0]) % self.position_reps.shape[0] == 0
+            self.transition_matrix[:,:,pos_mask_1] = np.dstack([(1 + erf((self.position_bins[1] - mu[:,:,0])/(self.position_noise*np.sqrt(2.))))/2.]*pos_mask_1.sum())
+            pos_mask_2 = np.arange(self.state_reps.shape[0]) % self.position_reps.shape[0] == self.position_reps.shape[0] - 1
+            self.transition_matrix[:,:,pos_mask_2] = np.dstack([(1 - erf((self.position_bins[-2] - mu[:, :, 0]) / (self.position_noise * np.sqrt(2.)))) / 2.] * pos_mask_2.sum())
+            pos_mask_3 = np.logical_not(np.logical_or(pos_mask_1, pos_mask_2))
+            mu_pos_rep = np.dstack([mu[:,:,0]]*pos_mask_3.sum())
+            pos_bins_rep_right = np.tile(self.position_bins[2:-1], self.velocity_reps.shape[0])
+            pos_bins_rep_left = np.tile(self.position_bins[1:-2], self.velocity_reps.shape[0])
+            self.transition_matrix[:, :, pos_mask_3] = (erf((pos_bins_rep_right - mu_pos_rep) / (self.position_noise * np.sqrt(2.))) - erf((pos_bins_rep_left - mu_pos_rep) / (self.position_noise * np.sqrt(2.))))/ 2.
+            del pos_mask_1, pos_mask_2, pos_mask_3, mu_pos_rep, pos_bins_rep_right, pos_bins_rep_left
+
+            vel_mask_1 = (np.arange(self.state_reps.shape[0]) / self.position_reps.shape[0]).astype(np.int64) == 0
+            self.transition_matrix[:, :, vel_mask_1] *= np.dstack([(1 + erf((self.velocity_bins[1] - mu[:, :, 1]) / (self.velocity_noise * np.sqrt(2.)))) / 2.] * vel_mask_1.sum())
+            vel_mask_2 = (np.arange(self.state_reps.shape[0]) / self.position_reps.shape[0]).astype(np.int64) == self.velocity_reps.shape[0] - 1
+            self.transition_matrix[:, :, vel_mask_2] *= np.dstack([(1 - erf((self.velocity_bins[-2] - mu[:, :, 1]) / (self.velocity_noise * np.sqrt(2.)))) / 2.] * vel_mask_2.sum())
+            vel_mask_3 = np.logical_not(np.logical_or(vel_mask_1, vel_mask_2))
+            mu_vel_rep = np.dstack([mu[:, :, 1]] * vel_mask_3.sum())
+            vel_bins_rep_right = np.repeat(self.velocity_bins[2:-1], self.position_reps.shape[0])
+            vel_bins_rep_left = np.repeat(self.velocity_bins[1:-2], self.position_reps.shape[0])
+            self.transition_matrix[:, :, vel_mask_3] *= (erf((vel_bins_rep_right - mu_vel_rep) / (self.velocity_noise * np.sqrt(2.))) - erf((vel_bins_rep_left - mu_vel_rep) / (self.velocity_noise * np.sqrt(2.)))) / 2.
+            del vel_mask_1, vel_mask_2, vel_mask_3, mu_vel_rep, vel_bins_rep_right, vel_bins_rep_left, mu
+
+            goal_pos_mask = self.state_reps[:,0] >= self.goal_position
+            aux = np.eye(self.state_reps.shape[0], dtype=np.float64)[goal_pos_mask,:]
+            self.transition_matrix[goal_pos_mask,:,:] = np.transpose(np.dstack([aux]*self.action_reps.shape[0]), axes=(0,2,1))
+            del goal_pos_mask, aux
+
+            self.r = self.reward_table(self.state_reps[:, 0])
+            self.R = np.einsum('san,san->sa', self.r, self.transition_matrix)
+            del idx_grid
 
         self.initial_state_distr = np.zeros(self.state_reps.shape[0], dtype=np.float64)
         initial_bins_idx = np.argwhere(np.logical_and(self.min_initial_state <= self.position_bins, self.position_bins  <= self.max_initial_state)).ravel()
@@ -451,6 +903,223 @@ class Continuous_MountainCarEnv(gym.Env):
         else:
             aux[np.where(self.position_reps == init_rep[0])[0]] = 1.
         self.initial_state_distr[self.state_reps[:, 1] == init_rep[1]] = aux
+        self.cast_model_arrays()
+        if self.cache_dir is not None:
+            self.save_model_matrices()
+
+
+
+    def model_cache_key(self):
+        # Hash of everything the model matrices depend on
+        h = hashlib.sha1()
+        for bins in [self.position_bins, self.velocity_bins, self.action_bins]:
+            h.update(np.ascontiguousarray(bins, dtype=np.float64).tobytes())
+        h.update(repr((self.min_position, self.max_position, self.min_action, self.max_action, self.max_speed,
+                       self.power, self.position_noise, self.velocity_noise, self.goal_position, self.min_initial_state,
+                       self.max_initial_state, self.model, self.transition_format, self.transition_tol, self.dtype.str,
+                       self.model_version)).encode())
+        return h.hexdigest()
+
+
+
+    def cast_model_arrays(self):
+        # Done once the model is built, so R and the sampling CDFs are computed from the float64 values
+        if self.dtype == np.float64:
+            return
+        if self.transition_format == 'sparse':
+            self.sparse_transition_matrix.data = self.sparse_transition_matrix.data.astype(self.dtype)
+            self.r.data = self.r.data.astype(self.dtype)
+        elif self.transition_format == 'factored':
+            self.position_factor = self.position_factor.astype(self.dtype)
+            self.velocity_factor = self.velocity_factor.astype(self.dtype)
+            self.position_r = self.position_r.astype(self.dtype)
+        else:
+            self.transition_matrix = self.transition_matrix.astype(self.dtype)
+            self.r = self.r.astype(self.dtype)
+
+
+
+    def model_array_names(self):
+        names = ['state_reps', 'initial_state_distr', 'R']
+        if self.transition_format == 'sparse':
+            # r shares the sparsity pattern of the transition matrix
+            return names + ['P_data', 'P_indices', 'P_indptr', 'r_data', 'sparse_transition_cdf']
+        elif self.transition_format == 'factored':
+            return names + ['position_factor', 'velocity_factor', 'position_r']
+        return names + ['transition_matrix', 'r']
+
+
+
+    def model_arrays(self):
+        arrays = {'state_reps': self.state_reps, 'initial_state_distr': self.initial_state_distr, 'R': self.R}
+        if self.transition_format == 'sparse':
+            arrays['P_data'] = self.sparse_transition_matrix.data
+            arrays['P_indices'] = self.sparse_transition_matrix.indices
+            arrays['P_indptr'] = self.sparse_transition_matrix.indptr
+            arrays['r_data'] = self.r.data
+            arrays['sparse_transition_cdf'] = self.sparse_transition_cdf
+        elif self.transition_format == 'factored':
+            arrays['position_factor'] = self.position_factor
+            arrays['velocity_factor'] = self.velocity_factor
+            arrays['position_r'] = self.position_r
+        else:
+            arrays['transition_matrix'] = self.transition_matrix
+            arrays['r'] = self.r
+        return arrays
+
+
+
+    def set_model_arrays(self, arrays):
+        self.state_reps = arrays['state_reps']
+        self.initial_state_distr = arrays['initial_state_distr']
+        self.R = arrays['R']
+        if self.transition_format == 'sparse':
+            shape = (self.transition_shape[0]*self.transition_shape[1], self.transition_shape[2])
+            self.transition_matrix = None
+            self.sparse_transition_matrix = sparse.csr_matrix((arrays['P_data'], arrays['P_indices'], arrays['P_indptr']),
+                                                              shape=shape, copy=False)
+            self.r = sparse.csr_matrix((arrays['r_data'], arrays['P_indices'], arrays['P_indptr']), shape=shape, copy=False)
+            self.sparse_transition_cdf = arrays['sparse_transition_cdf']
+        elif self.transition_format == 'factored':
+            self.transition_matrix = None
+            self.sparse_transition_matrix = None
+            self.r = None
+            self.position_factor = arrays['position_factor']
+            self.velocity_factor = arrays['velocity_factor']
+            self.position_r = arrays['position_r']
+        else:
+            self.transition_matrix = arrays['transition_matrix']
+            self.r = arrays['r']
+
+
+
+    def load_model_matrices(self):
+        # Returns False when the cache does not hold this model yet, the loaded arrays are read-only memory maps
+        path = os.path.join(self.cache_dir, self.model_cache_key())
+        arrays = {}
+        for name in self.model_array_names():
+            file = os.path.join(path, name + '.npy')
+            if not os.path.exists(file):
+                return False
+            arrays[name] = np.load(file, mmap_mode='r')
+        self.set_model_arrays(arrays)
+        return True
+
+
+
+    def save_model_matrices(self):
+        path = os.path.join(self.cache_dir, self.model_cache_key())
+        os.makedirs(path, exist_ok=True)
+        for name, array in self.model_arrays().items():
+            # Written under a temporary name first so that concurrent workers never map a partial file
+            tmp_file = os.path.join(path, '{}.{}.tmp.npy'.format(name, os.getpid()))
+            np.save(tmp_file, np.asarray(array))
+            os.replace(tmp_file, os.path.join(path, name + '.npy'))
+
+
+
+    def reward_factors(self, next_positions):
+        # reward_model as a sum of an action cost and a goal bonus on the next position, both zeroed when the first
+        # state is already past the goal, so reward tensors can be broadcast without gathering every (s, a, s') triple
+        action_r = -(2.**(4.*np.abs(np.clip(self.action_reps, self.min_action, self.max_action))))*0.1
+        goal_r = np.where(next_positions >= self.goal_position, 100.*0.1, 0.)
+        return action_r, goal_r
+
+
+
+    def reward_table(self, next_positions):
+        # (S, A, len(next_positions)) rewards of every first state and action
+        action_r, goal_r = self.reward_factors(next_positions)
+        first_goal = self.state_reps[:, 0] >= self.goal_position
+        return np.where(first_goal[:, None, None], 0., action_r[None, :, None] + goal_r[None, None, :])
+
+
+
+    def bin_probabilities(self, mu, bins, noise):
+        # Gaussian mass of each bin around mu, the first and last bins being open-ended
+        mu = mu[..., None]
+        probs = np.empty(mu.shape[:-1] + (bins.shape[0] - 1,), dtype=np.float64)
+        probs[..., 0] = ((1 + erf((bins[1] - mu) / (noise * np.sqrt(2.)))) / 2.)[..., 0]
+        probs[..., -1] = ((1 - erf((bins[-2] - mu) / (noise * np.sqrt(2.)))) / 2.)[..., 0]
+        probs[..., 1:-1] = (erf((bins[2:-1] - mu) / (noise * np.sqrt(2.))) - erf((bins[1:-2] - mu) / (noise * np.sqrt(2.)))) / 2.
+        return probs
+
+
+
+    def transition_factors(self, mu):
+        # Position and velocity marginals of every (s, a) pair, goal states being absorbing
+        n_pos = self.position_reps.shape[0]
+        n_vel = self.velocity_reps.shape[0]
+        goal_idx = np.where(self.state_reps[:, 0] >= self.goal_position)[0]
+        pos_probs = self.bin_probabilities(mu[:, :, 0], self.position_bins, self.position_noise)
+        vel_probs = self.bin_probabilities(mu[:, :, 1], self.velocity_bins, self.velocity_noise)
+        pos_probs[goal_idx] = np.eye(n_pos, dtype=np.float64)[goal_idx % n_pos][:, None, :]
+        vel_probs[goal_idx] = np.eye(n_vel, dtype=np.float64)[goal_idx // n_pos][:, None, :]
+        return pos_probs, vel_probs
+
+
+
+    def build_factored_model_matrices(self, mu):
+        self.position_factor, self.velocity_factor = self.transition_factors(mu)
+        self.transition_matrix = None
+        self.sparse_transition_matrix = None
+        # The reward only looks at the next position, so it is evaluated once per position bin
+        self.r = None
+        self.position_r = self.reward_table(self.position_reps)
+        self.R = np.einsum('san,san->sa', self.position_r, self.position_factor)
+
+
+
+    def build_sparse_model_matrices(self, mu):
+        n_states = self.state_reps.shape[0]
+        n_actions = self.action_reps.shape[0]
+        n_pos = self.position_reps.shape[0]
+        all_pos_probs, all_vel_probs = self.transition_factors(mu)
+        rows = []
+        cols = []
+        data = []
+        # Each row is the outer product of a position and a velocity vector, so it is built one action at a time from
+        # the truncated factors without ever holding a dense (S, S) block
+        for a in range(n_actions):
+            pos_probs = all_pos_probs[:, a].copy()
+            vel_probs = all_vel_probs[:, a].copy()
+            pos_probs[pos_probs < self.transition_tol] = 0.
+            vel_probs[vel_probs < self.transition_tol] = 0.
+            pos_probs = sparse.csr_matrix(pos_probs)
+            vel_probs = sparse.csr_matrix(vel_probs)
+            nnz_pos = np.diff(pos_probs.indptr)
+            nnz_vel = np.diff(vel_probs.indptr)
+            row_szs = nnz_pos * nnz_vel
+            row_idx = np.repeat(np.arange(n_states), row_szs)
+            offset = np.arange(row_szs.sum()) - np.repeat(np.cumsum(row_szs) - row_szs, row_szs)
+            pos_entries = pos_probs.indptr[row_idx] + offset % nnz_pos[row_idx]
+            vel_entries = vel_probs.indptr[row_idx] + offset // nnz_pos[row_idx]
+            probs = pos_probs.data[pos_entries] * vel_probs.data[vel_entries]
+            mask = probs >= self.transition_tol
+            rows.append(row_idx[mask] * n_actions + a)
+            cols.append((vel_probs.indices[vel_entries] * n_pos + pos_probs.indices[pos_entries])[mask])
+            data.append(probs[mask])
+            del pos_probs, vel_probs, row_idx, offset, pos_entries, vel_entries, probs, mask
+        del all_pos_probs, all_vel_probs
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        data = np.concatenate(data)
+        data /= np.bincount(rows, weights=data, minlength=n_states*n_actions)[rows]
+        self.transition_matrix = None
+        self.sparse_transition_matrix = sparse.csr_matrix((data, (rows, cols)), shape=(n_states*n_actions, n_states))
+        self.sparse_transition_matrix.sort_indices()
+        del rows, cols, data
+
+        P = self.sparse_transition_matrix
+        row_idx = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+        cum_p = P.data.cumsum()
+        self.sparse_transition_cdf = row_idx + cum_p - np.repeat(np.hstack(([0.], cum_p))[P.indptr[:-1]], np.diff(P.indptr))
+        action_r, goal_r = self.reward_factors(self.state_reps[:, 0])
+        first_goal = self.state_reps[:, 0] >= self.goal_position
+        rewards = np.where(first_goal[row_idx // n_actions], 0., action_r[row_idx % n_actions] + goal_r[P.indices])
+        self.r = sparse.csr_matrix((rewards, P.indices.copy(), P.indptr.copy()), shape=P.shape)
+        self.R = np.asarray(P.multiply(self.r).sum(axis=1)).reshape((n_states, n_actions))
+        del row_idx, cum_p, rewards, action_r, goal_r, first_goal
 
 
 
@@ -0,0 +1,39 @@
+import gym
+import numpy as np
+import sys
+from TransitionBounds import lipschitz_bounds, lipschitz_bounds_reference
+
+# Compares the vectorized lipschitz_bounds with the per-(s, a, s') loop of lipschitz_bounds_reference on a square and
+# a non-square grid, plus the one given on the command line.
+# Usage: python lipschitz_bounds_check.py [n_position_bins n_velocity_bins n_action_bins]
+
+seed = 9876
+min_pos = -10.
+max_pos = 10.
+min_act = -1.
+max_act = 1.
+power_source = 0.0025*20/1.8
+min_power, max_power = 0., 0.5
+power_min_source = 0.0015*20/1.8
+power_max_source = 0.003*20/1.8
+grids = [(11, 11, 6), (9, 13, 5)]
+if len(sys.argv) > 3:
+    grids.append(tuple(int(arg) for arg in sys.argv[1:4]))
+rtol = 1e-12
+
+
+def make_task(power, n_position_bins, n_velocity_bins, n_action_bins):
+    return gym.make('MountainCarContinuous-v0', min_position=min_pos, max_position=max_pos, min_action=min_act,
+                    max_action=max_act, power=power, seed=seed, model='S', discrete=True, n_position_bins=n_position_bins,
+                    n_velocity_bins=n_velocity_bins, n_action_bins=n_action_bins, position_noise=0.025, velocity_noise=0.025)
+
+
+all_close = True
+for grid in grids:
+    env, min_env, max_env = [make_task(power, *grid).env for power in [power_source, power_min_source, power_max_source]]
+    L = lipschitz_bounds(env, min_env, max_env, min_power, max_power)
+    L_reference = lipschitz_bounds_reference(env, min_env, max_env, min_power, max_power)
+    err = np.abs(L - L_reference).max() / max(np.abs(L_reference).max(), 1e-300)
+    all_close = all_close and err <= rtol
+    print('grid {0}x{1}x{2}  max rel difference: {3:.3e}'.format(grid[0], grid[1], grid[2], err))
+sys.exit(0 if all_close else 1)
@@ -131,16 +131,21 @@ n_target_samples = 5000
 n_action_bins = 10 + 1
 n_position_bins = 20 + 1
 n_velocity_bins = 20 + 1
+# Directory of the on-disk cache of the model matrices and of the bounds of the weights estimator, None rebuilds them
+# at every start
+model_cache_dir = None
 
 # Creation of source tasks
 source_tasks = [gym.make('MountainCarContinuous-v0', min_position=min_pos, max_position=max_pos, min_action=min_act,
                          max_action=max_act, power=power_source, seed=seed, model='S', discrete=True, n_position_bins=n_position_bins,
-                         n_velocity_bins=n_velocity_bins, n_action_bins=n_action_bins, position_noise=0.025, velocity_noise=0.025)
+                         n_velocity_bins=n_velocity_bins, n_action_bins=n_action_bins, position_noise=0.025, velocity_noise=0.025,
+                         cache_dir=model_cache_dir)
                 for power_source in power_sources]
 # Creation of target task
 target_task = gym.make('MountainCarContinuous-v0', min_position=min_pos, max_position=max_pos, min_action=min_act,
                        max_action=max_act, power=power_target, seed=seed, model='S', discrete=True, n_position_bins=n_position_bins,
-                       n_velocity_bins=n_velocity_bins, n_action_bins=n_action_bins, position_noise=0.025, velocity_noise=0.025)
+                       n_velocity_bins=n_velocity_bins, n_action_bins=n_action_bins, position_noise=0.025, velocity_noise=0.025,
+                       cache_dir=model_cache_dir)
 # Policy factory
 pf = PolicyFactoryMC(model='S', action_noise=action_noise, max_speed=target_task.env.max_speed, min_act=min_act, max_act=max_act,
                      action_bins=target_task.env.action_bins, action_reps=target_task.env.action_reps,
@@ -155,31 +160,19 @@ lstd_q = LSTD_Q_Estimator(3, 3, 3, 0.4, True, gamma, 0., min_pos, max_pos, targe
                           min_act, max_act)
 lstd_v = LSTD_V_Estimator(3, 3, 0.4, True, gamma, 0., min_pos, max_pos, target_task.env.min_speed, target_task.env.max_speed)
 grad_est = GradientEstimator(gamma=gamma, baseline_type=1)
-weights_est = MinWeightsEstimator(gamma)
+# Threads running the per-source stages of the weights estimator, whose numpy work releases the GIL
+weights_pool = Pool(min(len(power_sources), mp.cpu_count()))
+weights_est = MinWeightsEstimator(gamma, cache_dir=model_cache_dir, executor=weights_pool)
 
 #epis = collect_episodes(target_task, 10, max_episode_length, seed, target_policy, False)
 
 '''xs = np.linspace(0., 1., 11)
 ys = np.linspace(0., 1., 11)
+alphas = np.dstack(np.meshgrid(xs, ys, indexing='ij')).reshape(-1, 2)
 Js = np.empty((7,11,11), dtype=np.float64)
-for x_idx, x in enumerate(xs):
-    for y_idx, y in enumerate(ys):
-        print(x, y)
-        pol = pf.create_policy(x, y)
-        source_tasks[0].env.set_policy(pol, gamma)
-        source_tasks[1].env.set_policy(pol, gamma)
-        source_tasks[2].env.set_policy(pol, gamma)
-        source_tasks[3].env.set_policy(pol, gamma)
-        source_tasks[4].env.set_policy(pol, gamma)
-        source_tasks[5].env.set_policy(pol, gamma)
-        target_task.env.set_policy(pol, gamma)
-        Js[0,x_idx, y_idx] = source_tasks[0].env.J
-        Js[1,x_idx, y_idx] = source_tasks[1].env.J
-        Js[2,x_idx, y_idx] = source_tasks[2].env.J
-        Js[3,x_idx, y_idx] = source_tasks[3].env.J
-        Js[4,x_idx, y_idx] = source_tasks[4].env.J
-        Js[5,x_idx, y_idx] = source_tasks[5].env.J
-        Js[6,x_idx, y_idx] = target_task.env.J
+for i, task in enumerate(source_tasks + [target_task]):
+    print(i)
+    Js[i] = task.env.evaluate_policies(pf, alphas, gamma)[0].reshape((11, 11))
 np.save('Js', Js)
 Js = np.load('Js.npy')
 xs, ys = np.meshgrid(xs, ys)
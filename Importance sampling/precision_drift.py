@@ -0,0 +1,86 @@
+import gym
+import numpy as np
+import sys
+from PolicyFactoryMC import PolicyFactoryMC
+from LSTD_Q_Estimator import LSTD_Q_Estimator
+from LSTD_V_Estimator import LSTD_V_Estimator
+from MinEstimator import MinWeightsEstimator
+
+# Drift of J and of the estimated weights when the model and estimator tensors are held in float32 instead of float64.
+# Usage: python precision_drift.py [n_bins] [n_action_bins] [n_source_samples] [n_target_samples]
+
+seed = 9876
+gamma = 0.99
+min_pos = -10.
+max_pos = 10.
+min_act = -1.
+max_act = 1.
+power_source = 0.0025*20/1.8
+power_target = 0.002*20/1.8
+alpha_1_source, alpha_2_source = 0.63, 0.16
+alpha_1_target, alpha_2_target = 0.5, 0.1
+action_noise = (max_act - min_act)*0.2
+n_bins = int(sys.argv[1]) if len(sys.argv) > 1 else 20 + 1
+n_action_bins = int(sys.argv[2]) if len(sys.argv) > 2 else 10 + 1
+n_source_samples = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+n_target_samples = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+
+
+def build(dtype):
+    tasks = [gym.make('MountainCarContinuous-v0', min_position=min_pos, max_position=max_pos, min_action=min_act,
+                      max_action=max_act, power=power, seed=seed, model='S', discrete=True, n_position_bins=n_bins,
+                      n_velocity_bins=n_bins, n_action_bins=n_action_bins, position_noise=0.025, velocity_noise=0.025,
+                      dtype=dtype)
+             for power in [power_source, power_target]]
+    pf = PolicyFactoryMC(model='S', action_noise=action_noise, max_speed=tasks[1].env.max_speed, min_act=min_act,
+                         max_act=max_act, action_bins=tasks[1].env.action_bins, action_reps=tasks[1].env.action_reps,
+                         state_reps=tasks[1].env.state_reps, state_to_idx=tasks[1].env.state_to_idx, dtype=dtype)
+    lstd_q = LSTD_Q_Estimator(3, 3, 3, 0.4, True, gamma, 0., min_pos, max_pos, tasks[1].env.min_speed,
+                              tasks[1].env.max_speed, min_act, max_act, dtype=dtype)
+    lstd_v = LSTD_V_Estimator(3, 3, 0.4, True, gamma, 0., min_pos, max_pos, tasks[1].env.min_speed,
+                              tasks[1].env.max_speed, dtype=dtype)
+    return tasks, pf, lstd_q, lstd_v
+
+
+def drift(name, x64, x32):
+    x64 = np.asarray(x64, dtype=np.float64)
+    x32 = np.asarray(x32, dtype=np.float64)
+    err = np.abs(x64 - x32).max()
+    print('{0:<10} max abs drift: {1:.3e}  max rel drift: {2:.3e}'.format(name, err, err / max(np.abs(x64).max(), 1e-300)))
+
+
+results = {}
+samples = None
+for dtype in [np.float64, np.float32]:
+    (source_task, target_task), pf, lstd_q, lstd_v = build(dtype)
+    source_policy = pf.create_policy(alpha_1_source, alpha_2_source)
+    target_policy = pf.create_policy(alpha_1_target, alpha_2_target)
+    alphas = np.dstack(np.meshgrid(np.linspace(0., 1., 11), np.linspace(0., 1., 11), indexing='ij')).reshape(-1, 2)
+    J_grid = target_task.env.evaluate_policies(pf, alphas, gamma)[0]
+
+    target_task.env.set_policy(target_policy, gamma)
+    J_target = target_task.env.J
+    source_task.env.set_policy(source_policy, gamma)
+    if samples is None:
+        # Both precisions are fed the same float64 samples, so only the tensors differ
+        np.random.seed(seed)
+        samples = (source_task.env.sample_step(n_source_samples), target_task.env.sample_step(n_target_samples))
+    source_samples, target_samples = samples
+
+    idx_grid = np.dstack(np.meshgrid(np.arange(source_task.env.state_reps.shape[0]),
+                                     np.arange(source_task.env.action_reps.shape[0]), indexing='ij')).reshape(-1, 2)
+    all_phi_Q = lstd_q.map_to_feature_space(source_task.env.state_reps[idx_grid[:, 0]], source_task.env.action_reps[idx_grid[:, 1]])
+    all_phi_V = lstd_v.map_to_feature_space(source_task.env.state_reps)
+    weights_est = MinWeightsEstimator(gamma, dtype=dtype)
+    weights_est.set_flags(False, True, True)
+    weights_est.add_sources([dict(source_samples)], [source_task], [source_policy], all_phi_Q, all_phi_V)
+    weights_est.prepare_lstd(target_policy, target_task.env.power)
+    A, b = lstd_q.produce_matrices(target_samples)
+    weights_q = weights_est.estimate_weights_lstdq(n_target_samples, A, b)
+    A, b = lstd_v.produce_matrices(target_samples)
+    weights_v = weights_est.estimate_weights_lstdv(n_target_samples, A, b)
+    results[dtype] = {'J': J_target, 'J grid': J_grid, 'bounds Q': weights_est.u_bounds_lstdq, 'weights Q': weights_q,
+                      'weights V': weights_v}
+
+for key in results[np.float64]:
+    drift(key, results[np.float64][key], results[np.float32][key])
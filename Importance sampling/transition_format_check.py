@@ -0,0 +1,41 @@
+import gym
+import numpy as np
+import sys
+
+# Compares the transition and reward tensors of the factored and sparse formats with the dense ones on a square and a
+# non-square grid, plus the one given on the command line. The reward tensors must be equal, P being 0 or not.
+# Usage: python transition_format_check.py [n_position_bins n_velocity_bins n_action_bins]
+
+seed = 9876
+min_pos = -10.
+max_pos = 10.
+min_act = -1.
+max_act = 1.
+power = 0.0025*20/1.8
+grids = [(11, 11, 6), (9, 13, 5)]
+if len(sys.argv) > 3:
+    grids.append(tuple(int(arg) for arg in sys.argv[1:4]))
+# The sparse format drops the entries below transition_tol (1e-12) and renormalizes its rows
+atol = 1e-10
+
+
+def make_task(transition_format, n_position_bins, n_velocity_bins, n_action_bins):
+    return gym.make('MountainCarContinuous-v0', min_position=min_pos, max_position=max_pos, min_action=min_act,
+                    max_action=max_act, power=power, seed=seed, model='S', discrete=True, n_position_bins=n_position_bins,
+                    n_velocity_bins=n_velocity_bins, n_action_bins=n_action_bins, position_noise=0.025, velocity_noise=0.025,
+                    transition_format=transition_format)
+
+
+all_close = True
+for grid in grids:
+    dense_env = make_task('dense', *grid).env
+    P_dense = dense_env.transition_tensor()
+    r_dense = dense_env.reward_tensor()
+    for transition_format in ['factored', 'sparse']:
+        env = make_task(transition_format, *grid).env
+        err = np.abs(env.transition_tensor() - P_dense).max()
+        r_equal = np.array_equal(env.reward_tensor(), r_dense)
+        all_close = all_close and err <= atol and r_equal
+        print('grid {0}x{1}x{2}  {3:<8}  max abs difference of P: {4:.3e}  r equal: {5}'.format(
+            grid[0], grid[1], grid[2], transition_format, err, r_equal))
+sys.exit(0 if all_close else 1)